@@ -0,0 +1,120 @@
+"""
+Учёт активности пользователей (users.last_activity и user_activity_stats.last_activity).
+
+touch() только запоминает время последней активности в памяти. Раз в ACTIVITY_FLUSH_INTERVAL
+секунд все изменившиеся пользователи пишутся одним запросом через unnest, сколько бы раз
+за это время их ни отмечали (сообщение, callback, /start, шаги FSM).
+
+Уведомления пересчитываются (notificator.resume_user_notifications) только для тех, кто
+пересёк границу неактивности: до этой активности молчал дольше, чем notificator.inactivity_boundary(),
+т.е. мог попасть на паузу рассылки.
+"""
+import asyncio
+from datetime import datetime
+from os import getenv
+
+import apps.logger as logger
+from modules import acquire
+
+# как часто (сек) пишем накопленную активность в БД
+ACTIVITY_FLUSH_INTERVAL = float(getenv('activity_flush_interval', 5))
+
+# user_id -> время последней активности (UTC без часового пояса, как timezone('UTC', now()) в БД)
+_pending = {}
+_flush_lock = asyncio.Lock()
+_flusher_task = None
+_flusher_loop = None
+
+
+def touch(user_id: int) -> None:
+    """Отмечает активность пользователя (запись в БД - в фоне)"""
+    _pending[user_id] = datetime.utcnow()
+    _ensure_flusher(asyncio.get_running_loop())
+
+
+def _ensure_flusher(loop):
+    global _flusher_task, _flusher_loop
+    if _flusher_loop is loop and _flusher_task is not None and not _flusher_task.done():
+        return
+    _flusher_loop = loop
+    _flusher_task = logger.create_background_task(_flusher(), loop)
+
+
+async def _flusher():
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        if _pending:
+            # shield: остановка (close) не обрывает запись на середине
+            await asyncio.shield(flush())
+
+
+async def flush():
+    """Пишет накопленную активность и возобновляет уведомления вернувшимся пользователям"""
+    global _pending
+    async with _flush_lock:
+        if not _pending:
+            return
+        batch, _pending = _pending, {}
+        try:
+            returned = await _write(batch)
+        except Exception as error:
+            await logger.error(f"Не удалось обновить last_activity ({len(batch)} польз.): {error}")
+            # более свежие отметки, сделанные во время записи, важнее
+            _pending = {**batch, **_pending}
+            return
+
+    from apps.notifier import notificator
+
+    for user_id in returned:
+        try:
+            await notificator.resume_user_notifications(user_id)
+        except Exception as error:
+            await logger.error(f"Не удалось пересчитать уведомления пользователя {user_id}: {error}")
+
+
+async def _write(batch) -> list:
+    """Одним запросом обновляет users и user_activity_stats; возвращает пересёкших границу неактивности"""
+    from apps.funcs import ensure_last_activity_support
+    from apps.notifier import notificator
+
+    user_ids = list(batch)
+    async with acquire() as db:
+        await ensure_last_activity_support(db=db)
+        # все части запроса видят данные до обновления, поэтому previous_activity - прежнее значение
+        rows = await db.fetch("""
+            WITH activity AS (
+                SELECT * FROM unnest($1::bigint[], $2::timestamp[]) AS a(user_id, seen_at)
+            ),
+            touched_users AS (
+                UPDATE users u
+                SET last_activity = a.seen_at
+                FROM activity a
+                WHERE u.id = a.user_id
+            ),
+            touched_stats AS (
+                INSERT INTO user_activity_stats (user_id, last_activity)
+                SELECT user_id, seen_at FROM activity
+                ON CONFLICT (user_id) DO UPDATE
+                SET last_activity = EXCLUDED.last_activity
+            )
+            SELECT a.user_id, s.last_activity AS previous_activity
+            FROM activity a
+            LEFT JOIN user_activity_stats s ON s.user_id = a.user_id
+        """, user_ids, [batch[user_id] for user_id in user_ids])
+
+    boundary = notificator.inactivity_boundary()
+    # last_activity хранится в UTC - сравниваем по тем же часам, независимо от TimeZone сессии и сервера
+    now = datetime.utcnow()
+    return [
+        row['user_id'] for row in rows
+        if row['previous_activity'] is None or now - row['previous_activity'] > boundary
+    ]
+
+
+async def close():
+    """Останавливает фоновую запись и дописывает остаток (вызывать до закрытия пула БД)"""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        _flusher_task = None
+    await flush()
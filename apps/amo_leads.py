@@ -1,9 +1,9 @@
-import aiohttp
 import asyncio
 from os import getenv
 # 
 from . import logger
-from modules import create_connect, get_host, auth, AMO_TOKEN, AMO_DOMAIN
+from . import http_clients
+from modules import get_host, auth, AMO_TOKEN, AMO_DOMAIN
 from apps.bot_info import bot_info
 
 
@@ -79,24 +79,24 @@ async def update_lead(session, lead_id, name, data):
 
 # добавляет/обновляет заявку
 async def process_lead(data, lead_id=None):
-    async with aiohttp.ClientSession() as session:
-        # если не передай id заявки
-        if lead_id is None:
-            # пытаемся добавить пустую заявку. Если не получилось
-            if (lead_id := await create_lead(session=session)) is None:
-                # возвращаем None
-                return None
-            # если получилось
-            else:
-                # добавляем лид в БД
-                await add_lead(user_id=data.get("user_id"), lead_id=lead_id, status=status_id)
-        # обновляем данные в заявке
-        update_response = await update_lead(session=session,
-            lead_id=lead_id, 
-            name=f"Заявка #{lead_id} на консультацию в команду из ТГ-бота @{bot_info.get_username()}", 
-            data=data)
-
-        return lead_id if update_response is not None else None
+    session = http_clients.session("amo")
+    # если не передай id заявки
+    if lead_id is None:
+        # пытаемся добавить пустую заявку. Если не получилось
+        if (lead_id := await create_lead(session=session)) is None:
+            # возвращаем None
+            return None
+        # если получилось
+        else:
+            # добавляем лид в БД
+            await add_lead(user_id=data.get("user_id"), lead_id=lead_id, status=status_id)
+    # обновляем данные в заявке
+    update_response = await update_lead(session=session,
+        lead_id=lead_id, 
+        name=f"Заявка #{lead_id} на консультацию в команду из ТГ-бота @{bot_info.get_username()}", 
+        data=data)
+
+    return lead_id if update_response is not None else None
 
 
 
@@ -108,14 +108,13 @@ async def add_lead(user_id, lead_id, status):
         "lead_id": lead_id,
         "status": status
         }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{get_host()}/amo_leads/add_lead", json=input_data) as response:
-            # Проверка успешности запроса
-            if response.status == 200:
-                return True
-            else:
-                await logger.error(f'Ошибка при создании заявки в БД. Ответ сервера: statuscode={response.status}')
-                return False
+    async with http_clients.session("backend").post(f"{get_host()}/amo_leads/add_lead", json=input_data) as response:
+        # Проверка успешности запроса
+        if response.status == 200:
+            return True
+        else:
+            await logger.error(f'Ошибка при создании заявки в БД. Ответ сервера: statuscode={response.status}')
+            return False
 
 # отправка сообщения от юзера для занесения в БД
 async def send_amo_msg(lead_id, msg, is_user=True):
@@ -125,14 +124,13 @@ async def send_amo_msg(lead_id, msg, is_user=True):
         "lead_id": lead_id,
         "is_user": is_user
         }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{get_host()}/amo_leads/send_message", json=input_data) as response:
-            # Проверка успешности запроса
-            if response.status == 200:
-                return True
-            else:
-                await logger.error(f'Ошибка при отправке сообщения от юзера в бекенд. Ответ сервера: statuscode={response.status}')
-                return False
+    async with http_clients.session("backend").post(f"{get_host()}/amo_leads/send_message", json=input_data) as response:
+        # Проверка успешности запроса
+        if response.status == 200:
+            return True
+        else:
+            await logger.error(f'Ошибка при отправке сообщения от юзера в бекенд. Ответ сервера: statuscode={response.status}')
+            return False
 
 # проверка на активную заявку в АМО
 async def check_active_lead(user_id):
@@ -140,15 +138,14 @@ async def check_active_lead(user_id):
         "key": auth,
         "user_id": user_id
         }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{get_host()}/amo_leads/is_have_amo_lead", json=input_data) as response:
-            # Проверка успешности запроса
-            if response.status == 200:
-                server_answer = await response.json()
-                return server_answer.get("lead_id")
-            else:
-                await logger.error(f"Не удалось сделать запрос на сервер для определения активной заявки в АМО для юзера {user_id}")
-                return None
+    async with http_clients.session("backend").post(f"{get_host()}/amo_leads/is_have_amo_lead", json=input_data) as response:
+        # Проверка успешности запроса
+        if response.status == 200:
+            server_answer = await response.json()
+            return server_answer.get("lead_id")
+        else:
+            await logger.error(f"Не удалось сделать запрос на сервер для определения активной заявки в АМО для юзера {user_id}")
+            return None
 
 
 if __name__ == "__main__":
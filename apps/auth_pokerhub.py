@@ -3,6 +3,7 @@ import aiohttp
 from aiogram import Router
 #
 import apps.logger as logger
+import apps.http_clients as http_clients
 from apps.funcs import send_message, add_history, touch_user_activity
 router = Router()
 
@@ -27,15 +28,15 @@ async def get_user_data_auth(auth_code):
     if not auth_code:
         return {}
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://pokerhub.pro/api/tg/get-tokens",
-                json={"tokens": [auth_code]},
-                headers={'Content-Type': 'application/json; charset=utf-8'},
-                timeout=30
-                ) as response:
-                user_data = await response.json()
-                return user_data[0] if user_data else {}
+        session = http_clients.session("pokerhub")
+        async with session.post(
+            "https://pokerhub.pro/api/tg/get-tokens",
+            json={"tokens": [auth_code]},
+            headers={'Content-Type': 'application/json; charset=utf-8'},
+            timeout=30
+            ) as response:
+            user_data = await response.json()
+            return user_data[0] if user_data else {}
     except Exception as error:
         await logger.error(f"Не удалось запросить данные о юзере с ПХ: {error}")
         return {}
@@ -83,21 +84,21 @@ async def auth_pokerhub(call, bot):
     # print(payload)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                data = await response.json()
-                status = data.get("status", None)
-                if status and (answer_msg:=keycodes_answers.get(status, None)):
-                    try:
-                        await bot.delete_message(call.from_user.id, call.message.message_id)
-                    except:
-                        pass
-                    await send_message(bot=bot,
-                        user_id=user_id,
-                        msg_data={"text": answer_msg}
-                        )
-                else:
-                    await logger.error(f"Неучтённый статускод ответа ПХ: {response.status}. Ответ json={await response.json()}")
+        session = http_clients.session("pokerhub")
+        async with session.post(url, json=payload) as response:
+            data = await response.json()
+            status = data.get("status", None)
+            if status and (answer_msg:=keycodes_answers.get(status, None)):
+                try:
+                    await bot.delete_message(call.from_user.id, call.message.message_id)
+                except:
+                    pass
+                await send_message(bot=bot,
+                    user_id=user_id,
+                    msg_data={"text": answer_msg}
+                    )
+            else:
+                await logger.error(f"Неучтённый статускод ответа ПХ: {response.status}. Ответ json={await response.json()}")
     except aiohttp.ClientError as e:
         await logger.error(f"Ошибка при отправке запроса к ПХ: {e}")
         await send_message(
@@ -126,17 +127,17 @@ async def auth_pokerhub(call, bot):
     # print(payload)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                try:
-                    await bot.delete_message(call.from_user.id, call.message.message_id)
-                except:
-                    pass
-                await send_message(bot=bot,
-                    user_id=user_id,
-                    msg_data={"text": "Авторизация успешно отменена"}
-                    )
-                await logger.debug(f"Пользователь {user_id} отменил авторизацию на ПХ. Статускод ответа: {response.status}")
+        session = http_clients.session("pokerhub")
+        async with session.post(url, json=payload) as response:
+            try:
+                await bot.delete_message(call.from_user.id, call.message.message_id)
+            except:
+                pass
+            await send_message(bot=bot,
+                user_id=user_id,
+                msg_data={"text": "Авторизация успешно отменена"}
+                )
+            await logger.debug(f"Пользователь {user_id} отменил авторизацию на ПХ. Статускод ответа: {response.status}")
     except aiohttp.ClientError as e:
         await logger.error(f"Ошибка при отправке запроса к ПХ: {e}")
         await send_message(
@@ -6,7 +6,6 @@ import mysql.connector
 # 
 from modules import ENCRYPTION_KEY, ENCRYPTION_IV, MYSQL_CONFIG
 import apps.logger as logger
-from modules import create_connect
 from apps.funcs import send_message, check_subs
 
 results = [
@@ -1,23 +1,40 @@
 import asyncio
 import os
 import hashlib
+import json
 from aiogram import types
 from aiogram.types import FSInputFile, InputMediaPhoto, InputMediaVideo, InputMediaDocument, ReplyKeyboardRemove
 from modules import bot, dp
 import apps.logger as logger
 from apps.bot_info import bot_info
-from modules import create_connect
+from apps.resilience import backoff_delay
+from modules import UPLOADED_FILES_LISTEN, acquire, connect_db
 # 
 from modules import message_manager
 
+# размер куска при хешировании файла
+HASH_CHUNK_SIZE = 1024 * 1024
+# кэш хешей файлов: путь -> ((st_mtime_ns, st_size), md5)
+_file_hashes = {}
+# копия таблицы uploaded_files в памяти: label -> {file_id, content_type, hash}
+_uploaded_files = {}
+_uploaded_files_loaded = False
+# канал NOTIFY, через который процессы бота сообщают друг другу о новых file_id
+UPLOADED_FILES_CHANNEL = 'uploaded_files'
+_listen_connection = None
+_listening = False
+_reconnect_task = None
+# максимальная пауза (сек) между попытками переподключить LISTEN
+UPLOADED_FILES_RECONNECT_MAX_DELAY = 60
+
 async def send_file_by_label(bot, chat_id: int, label: str, filepath: str = None, content_type: str = 'document', text=None, filename=None, files_group=None, thumbnail_path=None, reply_markup=None):
     """Отправляем файл или медиагруппу по label, используя file_id из БД, если возможно"""
     
     # Если передана медиагруппа (список файлов)
     if files_group:
         media_group = []
-        files_to_upload = []
-        file_ids_to_save = []
+        # индекс в медиагруппе -> (file_label, content_type, hash) для файлов, которые загружаем заново
+        uploads = {}
 
         # Логируем порядок файлов для отладки
         await logger.info(f"Processing files_group for user {chat_id}, label={label}: {[(f['file_path'], f['tg_filename']) for f in files_group]}")
@@ -28,6 +45,7 @@ async def send_file_by_label(bot, chat_id: int, label: str, filepath: str = None
             thumbnail_path = file.get("thumbnail", None)
             file_content_type = file.get("content_type", 'document')
             file_label = f"{label}_{file_path}"  # Уникальный label для каждого файла
+            caption = text if index == 0 else None
 
             # Проверяем, существует ли файл
             if not file_path or not os.path.exists(file_path):
@@ -43,7 +61,7 @@ async def send_file_by_label(bot, chat_id: int, label: str, filepath: str = None
 
             # Проверяем file_id в БД
             db_file = await get_file_id(label=file_label)
-            real_hash = calculate_file_hash(filepath=file_path)
+            real_hash = await get_file_hash(filepath=file_path)
 
             if db_file:
                 file_id = db_file.get('file_id', None)
@@ -52,65 +70,38 @@ async def send_file_by_label(bot, chat_id: int, label: str, filepath: str = None
 
                 # Проверяем хеш и тип контента
                 if file_hash and file_id and real_hash == file_hash and file_content_type == db_content_type:
-                    media = create_media_object(file_id, file_content_type, text if index == 0 else None, thumbnail)
-                    media_group.append(media)
-                    file_ids_to_save.append((file_label, file_id, file_content_type, file_hash))
-                    await logger.info(f"Added file_id {file_id} for {file_label} to media_group at index {index}")
+                    media_group.append(create_media_object(file_id, file_content_type, caption, thumbnail))
+                    await logger.debug(f"Added file_id {file_id} for {file_label} to media_group at index {index}")
                     continue
 
-            # Если file_id не найден или файл изменился, добавляем для загрузки
-            files_to_upload.append((file_path, filename, file_content_type, thumbnail, file_label, real_hash))
-            await logger.info(f"Added file {file_path} to files_to_upload at index {index}")
-
-        # Если все файлы имеют валидные file_id
-        if not files_to_upload and media_group:
-            try:
-                await logger.info(f"Sending media_group with {len(media_group)} items: {[m.media for m in media_group]}")
-                messages = await bot.send_media_group(chat_id=chat_id, media=media_group)
-                for message in messages:
-                    await message_manager.add_message(user_id=chat_id, message_id=message.message_id)
-                # Отправляем клавиатуру отдельным сообщением, если она есть
-                if reply_markup and text:
-                    await bot.send_message(
-                        chat_id=chat_id,
-                        text=text,
-                        parse_mode='HTML',
-                        reply_markup=reply_markup
-                    )
-                return True
-            except Exception as error:
-                await logger.error(f"Ошибка при отправке медиагруппы юзеру {chat_id} по file_id. label={label}\nОшибка: {error}")
-                return False
+            # Если file_id не найден или файл изменился - загружаем только этот файл, на его месте в группе
+            media_group.append(create_media_object(FSInputFile(file_path, filename=filename), file_content_type, caption, thumbnail))
+            uploads[index] = (file_label, file_content_type, real_hash)
+            await logger.debug(f"Added file {file_path} to upload at index {index}")
 
-        # Загружаем файлы, если есть что загружать
-        if files_to_upload:
-            for file_path, filename, file_content_type, thumbnail, file_label, real_hash in files_to_upload:
-                file = FSInputFile(file_path, filename=filename)
-                media = create_media_object(file, file_content_type, text if len(media_group) == 0 else None, thumbnail)
-                media_group.append(media)
-                await logger.info(f"Added file {file_path} to media_group at index {len(media_group)-1}")
-
-            try:
-                await logger.info(f"Sending media_group with {len(media_group)} items: {[m.media for m in media_group]}")
-                messages = await bot.send_media_group(chat_id=chat_id, media=media_group)
-                # Сохраняем file_id для загруженных файлов
-                for (file_path, filename, file_content_type, thumbnail, file_label, real_hash), message in zip(files_to_upload, messages):
+        try:
+            await logger.info(f"Sending media_group with {len(media_group)} items ({len(uploads)} uploads)")
+            messages = await bot.send_media_group(chat_id=chat_id, media=media_group)
+            # Telegram возвращает сообщения в порядке медиагруппы - сопоставляем по индексу
+            for index, message in enumerate(messages):
+                if index in uploads:
+                    file_label, file_content_type, real_hash = uploads[index]
                     file_id = get_file_id_from_message(message, file_content_type)
                     await save_file_id(label=file_label, file_id=file_id, content_type=file_content_type, file_hash=real_hash)
-                    await message_manager.add_message(user_id=chat_id, message_id=message.message_id)
                     await logger.info(f"Saved file_id {file_id} for {file_label}")
-                # Отправляем клавиатуру отдельным сообщением, если она есть
-                if reply_markup and text:
-                    await bot.send_message(
-                        chat_id=chat_id,
-                        text=text,
-                        parse_mode='HTML',
-                        reply_markup=reply_markup
-                    )
-                return True
-            except Exception as error:
-                await logger.error(f"Ошибка при отправке медиагруппы юзеру {chat_id} через file upload. label={label}\nОшибка: {error}")
-                return False
+                await message_manager.add_message(user_id=chat_id, message_id=message.message_id)
+            # Отправляем клавиатуру отдельным сообщением, если она есть
+            if reply_markup and text:
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=text,
+                    parse_mode='HTML',
+                    reply_markup=reply_markup
+                )
+            return True
+        except Exception as error:
+            await logger.error(f"Ошибка при отправке медиагруппы юзеру {chat_id}. label={label}\nОшибка: {error}")
+            return False
 
     # Если передан одиночный файл
     elif filepath:
@@ -129,7 +120,7 @@ async def send_file_by_label(bot, chat_id: int, label: str, filepath: str = None
 
         # Проверяем file_id в БД
         file = await get_file_id(label=f"{label}_{filepath}")
-        real_hash = calculate_file_hash(filepath=filepath)
+        real_hash = await get_file_hash(filepath=filepath)
 
         if file:
             file_id = file.get('file_id', None)
@@ -196,20 +187,115 @@ def get_file_id_from_message(message, content_type: str):
         case _:
             return message.document.file_id
 
+async def load_uploaded_files():
+    """Загружает таблицу uploaded_files в память (при старте бота, она маленькая и почти не меняется)"""
+    global _uploaded_files_loaded
+    query = """SELECT label, file_id, content_type, hash FROM uploaded_files;"""
+    async with acquire() as db:
+        rows = await db.fetch(query)
+    _uploaded_files.clear()
+    for row in rows:
+        _uploaded_files[row['label']] = {
+            'file_id': row['file_id'],
+            'content_type': row['content_type'],
+            'hash': row['hash'],
+        }
+    _uploaded_files_loaded = True
+    await logger.info(f"Загружено file_id из uploaded_files: {len(_uploaded_files)}")
+
 async def get_file_id(label: str):
-    """Ищем в базе данных file_id по label"""
-    query = """SELECT file_id, content_type, hash FROM uploaded_files WHERE label = $1;"""
-    db = await create_connect()
-    row = await db.fetchrow(query, label)
-    await db.close()
-    return row if row else None
+    """Ищем file_id по label (в памяти, без запроса к БД)"""
+    if not _uploaded_files_loaded:
+        await load_uploaded_files()
+    return _uploaded_files.get(label)
 
 async def save_file_id(label: str, file_id: str, content_type: str, file_hash: str):
-    """Сохраняем file_id в базу данных"""
+    """Сохраняем file_id в базу данных и в копию в памяти, сообщаем остальным процессам"""
     query = """INSERT INTO uploaded_files (label, file_id, content_type, hash) VALUES ($1, $2, $3, $4) ON CONFLICT (label) DO UPDATE SET file_id = $2, content_type = $3, hash = $4;"""
-    db = await create_connect()
-    await db.execute(query, label, file_id, content_type, file_hash)
-    await db.close()
+    row = {'file_id': file_id, 'content_type': content_type, 'hash': file_hash}
+    async with acquire() as db:
+        await db.execute(query, label, file_id, content_type, file_hash)
+        # в память - только то, что точно записано в БД
+        _uploaded_files[label] = row
+        await db.execute("SELECT pg_notify($1, $2);", UPLOADED_FILES_CHANNEL, json.dumps({'label': label, **row}))
+
+def _on_uploaded_file_notify(connection, pid, channel, payload):
+    try:
+        data = json.loads(payload)
+        _uploaded_files[data.pop('label')] = data
+    except Exception:
+        # не разобрали уведомление - перечитаем таблицу при следующем запросе
+        _invalidate_uploaded_files()
+
+def _invalidate_uploaded_files(*args):
+    global _uploaded_files_loaded
+    _uploaded_files_loaded = False
+
+
+def _on_listen_connection_lost(connection):
+    """Соединение LISTEN потеряно: уведомления могли пропасть - перечитаем таблицу и переподключимся"""
+    global _listen_connection, _reconnect_task
+    if connection is not _listen_connection:
+        # соединение закрыто в stop_uploaded_files_listener
+        return
+    _listen_connection = None
+    _invalidate_uploaded_files()
+    if _listening and (_reconnect_task is None or _reconnect_task.done()):
+        _reconnect_task = logger.create_background_task(_reconnect())
+
+
+async def _listen():
+    global _listen_connection
+    connection = await connect_db()
+    try:
+        await connection.add_listener(UPLOADED_FILES_CHANNEL, _on_uploaded_file_notify)
+        connection.add_termination_listener(_on_listen_connection_lost)
+    except Exception:
+        # подписаться не удалось - соединение больше не нужно
+        await connection.close()
+        raise
+    _listen_connection = connection
+
+
+async def _reconnect():
+    attempt = 0
+    while _listening and _listen_connection is None:
+        attempt += 1
+        await asyncio.sleep(backoff_delay(attempt, base=1, cap=UPLOADED_FILES_RECONNECT_MAX_DELAY))
+        try:
+            await _listen()
+            # пока соединения не было, уведомления пропадали - перечитываем таблицу целиком
+            await load_uploaded_files()
+            await logger.info(f"Подписка на изменения uploaded_files восстановлена (попытка {attempt})")
+        except Exception as error:
+            # подписка могла восстановиться, а таблица - не перечитаться: перечитаем при следующем запросе
+            _invalidate_uploaded_files()
+            await logger.error(f"Не удалось восстановить подписку на uploaded_files (попытка {attempt}): {error}")
+
+
+async def start_uploaded_files_listener():
+    """Подписывается на изменения uploaded_files от других процессов бота (UPLOADED_FILES_LISTEN)"""
+    global _listening, _reconnect_task
+    if not UPLOADED_FILES_LISTEN or _listening:
+        return
+    _listening = True
+    try:
+        await _listen()
+    except Exception as error:
+        await logger.error(f"Не удалось подписаться на изменения uploaded_files: {error}")
+        _reconnect_task = logger.create_background_task(_reconnect())
+
+
+async def stop_uploaded_files_listener():
+    global _listen_connection, _listening, _reconnect_task
+    _listening = False
+    if _reconnect_task is not None:
+        _reconnect_task.cancel()
+        _reconnect_task = None
+    if _listen_connection is not None:
+        connection, _listen_connection = _listen_connection, None
+        await connection.close()
+
 
 async def send_and_save_file(bot, chat_id: int, file: str, content_type: str, text, thumbnail, reply_markup):
     """Отправляем одиночный файл"""
@@ -247,8 +333,25 @@ async def send_and_save_file(bot, chat_id: int, file: str, content_type: str, te
     except Exception as error:
         return False, str(error)
 
+async def get_file_hash(filepath: str) -> str:
+    """
+    MD5 хеш файла с кэшем по (st_mtime_ns, st_size): пока файл не менялся, повторно не
+    читаем его. Хешируем в отдельном потоке, чтобы большие видео не блокировали бота
+    """
+    stat = os.stat(filepath)
+    stat_key = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_hashes.get(filepath)
+    if cached and cached[0] == stat_key:
+        return cached[1]
+
+    file_hash = await asyncio.to_thread(calculate_file_hash, filepath)
+    _file_hashes[filepath] = (stat_key, file_hash)
+    return file_hash
+
 def calculate_file_hash(filepath: str) -> str:
-    """Вычисляет MD5 хеш файла"""
+    """Вычисляет MD5 хеш файла (читает кусками, не загружая файл целиком в память)"""
+    md5_hash = hashlib.md5()
     with open(filepath, 'rb') as file:
-        md5_hash = hashlib.md5(file.read())
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            md5_hash.update(chunk)
     return md5_hash.hexdigest()
\ No newline at end of file
@@ -5,9 +5,7 @@
 
 import html
 import copy
-import aiohttp
 import asyncio
-import json
 from datetime import datetime, timedelta
 from aiogram.utils.keyboard import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
@@ -20,13 +18,23 @@ from cryptography.fernet import Fernet
 from apps import bot_info
 import apps.logger as logger
 import apps.file_id_uploader as file_uploader
-from modules import MAX_CHARS_USERS_HISTORY, create_connect, get_key_b64, FSMStates, dp, headers, get_host
-from modules import JIVO_INTEGRATOR_URL
+import apps.user_profiles as user_profiles
+import apps.write_behind as write_behind
+import apps.activity_tracker as activity_tracker
+import apps.http_clients as http_clients
+import apps.history_batcher as history_batcher
+from apps import resilience
+from apps.funnel_compiler import CompiledNode
+from modules import MAX_CHARS_USERS_HISTORY, acquire, get_key_b64, FSMStates, dp
+from modules import JIVO_INTEGRATOR_URL, JIVO_SEND_ATTEMPTS, JIVO_BREAKER_FAILURES, JIVO_BREAKER_RESET
+from modules import JIVO_QUEUE_LEASE, JIVO_QUEUE_CLAIM_LIMIT
 # для заявки АМО
 import apps.amo_leads as amo_leads
 
 # получаем ключ из переменных окружения
 key_b64 = get_key_b64()
+# шифр для id юзера создаём один раз, а не на каждое шифрование
+cipher = Fernet(key_b64)
 
 # словарь соответствий этапов воронки бота
 bot_lead_stages = {
@@ -94,6 +102,7 @@ bot_lead_stages = {
     "doge2_username_done": "doge2.5-done",
     "doge2_followup_program": "doge2.6",
     "doge2_followup_cases": "doge2.7",
+}
 
 # этот класс нужен для безопасного использования format, чтобы не возникали исключения
 # в случаях, когда плейсхолдера переданного в параметры format() в строке нет
@@ -103,208 +112,310 @@ class SafeDict(dict):
 
 # При вызове обновляет данные в БД в funnel, записывая все этапы воронок из bot_lead_stages
 async def update_funnel_db():
-    db = await create_connect()
-    await db.execute("""DELETE FROM funnel;""")
-    for key, label in bot_lead_stages.items():
-        await db.execute("""INSERT INTO funnel (label, key) VALUES ($1, $2);""", label, key)
-    await db.close()
+    async with acquire() as db:
+        await db.execute("""DELETE FROM funnel;""")
+        for key, label in bot_lead_stages.items():
+            await db.execute("""INSERT INTO funnel (label, key) VALUES ($1, $2);""", label, key)
     await logger.info(f"В БД в funnel обновлены данные по этапам воронки ({len(bot_lead_stages.keys())})")
 
-async def add_msg_to_jivo_integration_queue(user_id, text):
+async def add_msg_to_jivo_integration_queue(user_id, text, source="ph", file_type=None, file_path=None, file_name=None):
     """
     Для добавления сообщения в jivo_integration_queue.
     Задача от Академика:
     Сейчас когда ПХ шлет "тригерное сообщение" игроку, мы его в Jivo видим как новый чат.
     Можно сделать так, чтобы мы этого не видели?
     Т.е. новый чат-диалог создавался только в случае если человек ответил нам?
+
+    source="relay" - сообщение юзера, которое не удалось доставить в JIVO (отправится повторно)
     """
-    db = await create_connect()
-    await db.execute(
-        """INSERT INTO jivo_integration_queue (user_id, text)
-            VALUES ($1, $2)""", user_id, text)
-    await db.close()
+    async with acquire() as db:
+        await db.execute(
+            """INSERT INTO jivo_integration_queue (user_id, text, source, file_type, file_path, file_name)
+                VALUES ($1, $2, $3, $4, $5, $6)""", user_id, text, source, file_type, file_path, file_name)
 
-async def get_msgs_to_jivo_integration_queue(user_id):
+# сколько времени должно пройти, чтобы не учитывать сообщение из jivo_integration_queue
+JIVO_QUEUE_TTL = timedelta(weeks=2)
+
+
+async def claim_jivo_integration_queue(user_id, sources=("ph", "relay")):
     """
-    Получает сообщения из jivo_integration_queue для юзера,
-    которые is_active и у которых не прошло 2 недели с момента их отправки в ТГ
-    (это нужно для задачи от Академика, описание в функции add_msg_to_jivo_integration_queue)
+    Берёт в работу (lease на JIVO_QUEUE_LEASE секунд) до JIVO_QUEUE_CLAIM_LIMIT сообщений юзера из
+    jivo_integration_queue, которые is_active и у которых не прошло 2 недели с момента их отправки в ТГ
+    (это нужно для задачи от Академика, описание в функции add_msg_to_jivo_integration_queue).
+    Строки, которые уже взял другой процесс, пропускаются.
+    Возвращает (сообщения по порядку, есть-ли ещё сообщения юзера в работе у другого процесса)
     """
+    since = datetime.utcnow() - JIVO_QUEUE_TTL
+    async with acquire() as db:
+        # короткая транзакция: строки помечаются и сразу отпускаются, отправка идёт без блокировок
+        rows = await db.fetch(
+            """
+            UPDATE jivo_integration_queue q
+            SET claimed_until = NOW() + make_interval(secs => $4)
+            WHERE q.id IN (
+                SELECT id FROM jivo_integration_queue
+                WHERE user_id = $1
+                  AND is_active = TRUE
+                  AND create_at >= $2
+                  AND source = ANY($3::varchar[])
+                  AND (claimed_until IS NULL OR claimed_until < NOW())
+                ORDER BY id ASC
+                LIMIT $5
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING q.id, q.text, q.create_at, q.source, q.file_type, q.file_path, q.file_name
+            """,
+            user_id, since, list(sources), JIVO_QUEUE_LEASE, JIVO_QUEUE_CLAIM_LIMIT
+        )
+        busy = await db.fetchval(
+            """
+            SELECT EXISTS (
+                SELECT 1 FROM jivo_integration_queue
+                WHERE user_id = $1
+                  AND is_active = TRUE
+                  AND create_at >= $2
+                  AND source = ANY($3::varchar[])
+                  AND claimed_until >= NOW()
+                  AND id <> ALL($4::bigint[])
+            )
+            """,
+            user_id, since, list(sources), [row['id'] for row in rows]
+        )
+    # возвращаем список словарей
+    return sorted((dict(row) for row in rows), key=lambda row: row['id']), busy
 
-    # сколько времени должно пройти, чтобы не учитывать сообщение
-    delta_time = datetime.utcnow() - timedelta(weeks=2)
-    db = await create_connect()
-    rows = await db.fetch(
-        """
-        SELECT text, create_at FROM jivo_integration_queue
-        WHERE user_id = $1
-          AND is_active = TRUE
-          AND create_at >= $2
-          ORDER BY id ASC
-        """,
-        user_id,
-        delta_time
-    )
+async def release_jivo_integration_queue(claimed_ids, delivered_ids):
+    """
+    Снимает lease со взятых в работу записей, доставленные деактивирует (ставит is_active в false)
+    """
+    if not claimed_ids:
+        return
+    async with acquire() as db:
+        await db.execute(
+            """
+            UPDATE jivo_integration_queue
+            SET is_active = is_active AND NOT (id = ANY($2::bigint[])),
+                claimed_until = NULL
+            WHERE id = ANY($1::bigint[])
+            """,
+            list(claimed_ids),
+            list(delivered_ids)
+        )
 
-    await db.close()
-    # возвращаем список словарей
-    return [dict(row) for row in rows] if rows else []
+async def expire_jivo_integration_queue() -> int:
+    """
+    Деактивирует записи старше 2 недель (их уже не отправляем), возвращает их количество
+    """
+    async with acquire() as db:
+        result = await db.execute(
+            """
+            UPDATE jivo_integration_queue
+            SET is_active = FALSE
+            WHERE is_active = TRUE
+              AND create_at < $1
+            """,
+            datetime.utcnow() - JIVO_QUEUE_TTL
+        )
+    return int(result.split()[-1])
 
-async def deactivate_msgs_for_user(user_id, end_date):
+async def get_users_with_jivo_relay_queue(limit):
     """
-    Деактивирует (ставит is_active в false) записи для юзера от начала и до даты end_date
+    Юзеры, у которых есть сообщения, отложенные из-за недоступности JIVO (source = 'relay')
     """
-    db = await create_connect()
-    await db.execute(
-        """
-        UPDATE jivo_integration_queue
-        SET is_active = FALSE
-        WHERE user_id = $1
-          AND create_at <= $2
-        """,
-        user_id,
-        end_date
-    )
+    async with acquire() as db:
+        rows = await db.fetch(
+            """
+            SELECT DISTINCT user_id FROM jivo_integration_queue
+            WHERE is_active = TRUE
+              AND source = 'relay'
+              AND create_at >= $1
+            LIMIT $2
+            """,
+            datetime.utcnow() - JIVO_QUEUE_TTL,
+            limit
+        )
+    return [row['user_id'] for row in rows]
 
-    await db.close()
 
+# интегратор JIVO: после серии сбоев запросы на время не выполняются, а сообщения откладываются
+jivo_breaker = resilience.CircuitBreaker("JIVO", failure_threshold=JIVO_BREAKER_FAILURES, reset_timeout=JIVO_BREAKER_RESET)
 
-async def send_to_jivo(user_id, text=None, file_type=None, file_path=None, file_name=None, **kwargs):
-    try:
 
-        data = {
-            "message": {
-                "type": file_type if file_type else "text",
-                "file": file_path,
-                "file_name": file_name,
-                "text": text
-            },
-            "sender": {
-                "id": str(user_id)
-            },
-            "service": {
-                "source": "telegram",
-                "object": "bot",
-                "object_id": str(bot_info.bot_info.get_id())
-            }
+async def post_to_jivo(user_id, text=None, file_type=None, file_path=None, file_name=None, **kwargs):
+    """
+    Доставляет сообщение в JIVO (до JIVO_SEND_ATTEMPTS попыток с растущей задержкой).
+    Возвращает ответ интегратора, False - интегратор отклонил сообщение, None - нечего отправлять.
+    Если интегратор недоступен - исключение resilience.CircuitOpenError или из RETRYABLE_ERRORS
+    """
+    data = {
+        "message": {
+            "type": file_type if file_type else "text",
+            "file": file_path,
+            "file_name": file_name,
+            "text": text
+        },
+        "sender": {
+            "id": str(user_id)
+        },
+        "service": {
+            "source": "telegram",
+            "object": "bot",
+            "object_id": str(bot_info.bot_info.get_id())
         }
+    }
+
+    if not text and not file_path:
+        await logger.error(f"Нет данных для отправки сообщения! Данные: {data}")
+        return None
 
-        if not text and not file_path:
-            await logger.error(f"Нет данных для отправки сообщения! Данные: {data}")
-            return None
-
-        # Добавляем параметры из kwargs
-        data['sender'].update(kwargs)
-
-        # Принимаем 3 попытки отправить сообщение в jivo
-        for _ in range(1, 3):
-            async with aiohttp.ClientSession() as session:
-                # async with session.post("https://tg-intensive.firestorm.team/jivo/api/v1/jivo/send_message", json=data) as response:
-                async with session.post(f"{JIVO_INTEGRATOR_URL}/api/v1/jivo/send_message", json=data) as response:
-                    if response.status == 200:
-                        await logger.info(f"Сообщение доставлено в JIVO, статускод: {response.status}, ответ от сервера: {await response.text()}")
-                        result = await response.json()
-                        return result
-                    else:
-                        await logger.error(f"Сообщение не доставлено в JIVO, попытка #{_}. Статускод: {response.status}, ошибка: {await response.text()}")
-                        await asyncio.sleep(0.6)
-                        continue
+    # Добавляем параметры из kwargs
+    data['sender'].update(kwargs)
+
+    async def post():
+        # async with session.post("https://tg-intensive.firestorm.team/jivo/api/v1/jivo/send_message", json=data) as response:
+        async with http_clients.session("jivo").post(f"{JIVO_INTEGRATOR_URL}/api/v1/jivo/send_message", json=data) as response:
+            if response.status == 200:
+                await logger.info(f"Сообщение доставлено в JIVO, статускод: {response.status}, ответ от сервера: {await response.text()}")
+                return await response.json()
+            error = f"Статускод: {response.status}, ошибка: {await response.text()}"
+            # 5xx и 429 - интегратор временно не справляется, повторяем
+            if response.status >= 500 or response.status == 429:
+                raise resilience.RetryableError(error)
+            await logger.error(f"Сообщение не доставлено в JIVO. {error}")
+            return False
+
+    return await resilience.retry(post, breaker=jivo_breaker, attempts=JIVO_SEND_ATTEMPTS)
+
+
+async def send_to_jivo(user_id, text=None, file_type=None, file_path=None, file_name=None, spill_as="relay", **kwargs):
+    """
+    Доставляет сообщение в JIVO. Если интегратор недоступен, сообщение откладывается
+    в jivo_integration_queue с source=spill_as (spill_as=None - не откладывать) и
+    будет отправлено повторно. Возвращает ответ интегратора или False/None
+    """
+    try:
+        return await post_to_jivo(user_id, text=text, file_type=file_type, file_path=file_path, file_name=file_name, **kwargs)
+    except (resilience.CircuitOpenError, *resilience.RETRYABLE_ERRORS) as error:
+        await logger.error(f"Сообщение не доставлено в JIVO: {error}")
+        if spill_as:
+            try:
+                await add_msg_to_jivo_integration_queue(
+                    user_id=user_id, text=text, source=spill_as,
+                    file_type=file_type, file_path=file_path, file_name=file_name
+                )
+                await logger.info(f"Сообщение юзера {user_id} отложено в jivo_integration_queue до восстановления JIVO")
+            except Exception as spill_error:
+                await logger.error(f"Не удалось отложить сообщение юзера {user_id} в jivo_integration_queue: {spill_error}. text={text}, file_path={file_path}")
         return False
     except Exception as error:
-        await logger.error(f"Произошла ошибка при попытке доставить сообщение в JIVO: {error}. data={data}")
+        await logger.error(f"Произошла ошибка при попытке доставить сообщение в JIVO: {error}. user_id={user_id}, text={text}, file_path={file_path}")
         return None
 
 # Функция вызывается при успешной доставке сообщения юзеру, и добавления его в веб-панель в историю сообщений
 async def add_msg_to_history(chat_id, author_id, content, type="text", name=None):
-    body = {
-        'content': content,
-        'chat_id': chat_id,
-        'author_id': author_id,
-        'type': type,
-        'name': name
-    }
-
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.post(get_host()+'/messages_history/add-message', json=body) as response:
-            text = await response.text()
-            try:
-                r = json.loads(text)
-                return True
-            except json.JSONDecodeError as error:
-                await logger.error(f"Не удалось сохранить сообщение в истории: {error}. Текст сообщения: {text}")
-                return False
+    """
+    Отправка отложенная и пачками (apps/history_batcher.py), порядок сообщений
+    одного чата сохраняется. True - сообщение поставлено в очередь
+    """
+    await history_batcher.add(chat_id=chat_id, author_id=author_id, content=content, type=type, name=name)
+    return True
 
 # для записи сообщений от бота (чтобы видеть продвижение по воронке)
 async def save_user_funnel(user_id, label):
     """
     label - это то как сообщение названо в МИРО (из таблицы соответствий)
     name - это то как в MAP названо сообщение
+    Запись отложенная (apps/write_behind.py)
     """
     if not label:
         return
-    db = await create_connect()
-    await db.execute(
-        """INSERT INTO user_funnel (user_id, label, name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (user_id, label)
-            DO NOTHING""",
-        user_id, bot_lead_stages.get(label, label), label
-        )
-    await db.close()
-
-
-async def run_action(action, user_id, bot):
-    """
-    Заглушка для тестов и базовая реализация.
-    В реальной системе эта функция вызывает действия в воронке, но
-    для тестов достаточно вернуть True/False и не ломать импорт.
-    """
-    return True
+    await write_behind.add_user_funnel(user_id=user_id, label=bot_lead_stages.get(label, label), name=label)
 
 # Сохраняет в БД инфу, что юзер прошёл воронку
 async def save_funnel_passed(user_id, funnel_name):
-    db = await create_connect()
     await logger.info(f"Юзер {user_id} прошёл воронку. Уведомления он более получать не будет!")
-    await db.execute(
-            """
-            INSERT INTO funnel_passed (user_id, funnel_name, passed)
-            VALUES ($1, $2, $3)
-            """,
-            user_id,
-            funnel_name,
-            True
-        )
-    await db.close()
+    async with acquire() as db:
+        await db.execute(
+                """
+                INSERT INTO funnel_passed (user_id, funnel_name, passed)
+                VALUES ($1, $2, $3)
+                """,
+                user_id,
+                funnel_name,
+                True
+            )
+        # прошедшим воронку уведомления больше не шлём (раньше это делал рассыльщик на каждом цикле)
+        if funnel_name == "default":
+            await db.execute(
+                """
+                UPDATE notifications
+                SET is_active = FALSE
+                WHERE user_id = $1 AND is_active = TRUE
+                """,
+                user_id
+            )
+            await _reset_notification_series(db, user_id)
     return True
 
 
-async def close_old_notifications(user_id, callback):
-    db = await create_connect()
-    row = await db.fetch(
+async def _reset_notification_series(db, user_id):
+    """Все уведомления закрыты - серия уведомлений (user_activity_stats) закончилась"""
+    await db.execute(
         """
-        SELECT label FROM user_funnel
+        UPDATE user_activity_stats
+        SET first_active_notification = NULL
         WHERE user_id = $1
-        AND name = $2
         """,
-        user_id,
-        callback
+        user_id
     )
 
-    if row:
-        # значит он перешёл на сообщение на котором уже был
-        await logger.debug(f"Юзер {user_id} уже был на сообщении {callback} ранее")
-    else:
-        await logger.debug(f"Юзер {user_id} не был на сообщении {callback} ранее, закрываем все уведомления!")
-        await db.execute(
+
+async def _reset_notification_series_if_idle(db, user_id):
+    """Закрыта часть уведомлений: серия заканчивается, только если активных не осталось"""
+    await db.execute(
+        """
+        UPDATE user_activity_stats
+        SET first_active_notification = NULL
+        WHERE user_id = $1
+        AND first_active_notification IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM notifications
+            WHERE user_id = $1 AND is_active = true
+        )
+        """,
+        user_id
+    )
+
+
+async def close_old_notifications(user_id, callback):
+    # user_funnel пишется отложенно - дописываем, чтобы увидеть последние переходы
+    await write_behind.flush_user(user_id)
+    async with acquire() as db:
+        row = await db.fetch(
             """
-            UPDATE notifications
-            SET is_active = $1
-            WHERE user_id = $2
+            SELECT label FROM user_funnel
+            WHERE user_id = $1
+            AND name = $2
             """,
-            False,
-            user_id
+            user_id,
+            callback
         )
-    await db.close()
+
+        if row:
+            # значит он перешёл на сообщение на котором уже был
+            await logger.debug(f"Юзер {user_id} уже был на сообщении {callback} ранее")
+        else:
+            await logger.debug(f"Юзер {user_id} не был на сообщении {callback} ранее, закрываем все уведомления!")
+            await db.execute(
+                """
+                UPDATE notifications
+                SET is_active = $1
+                WHERE user_id = $2
+                """,
+                False,
+                user_id
+            )
+            await _reset_notification_series(db, user_id)
 
 async def get_quiz_results(bot, user_id):
     import mysql.connector
@@ -327,7 +438,6 @@ async def get_quiz_results(bot, user_id):
         else:
             get_scores = True
             break
-    db = await create_connect()
     if get_scores:
         iq_score = int(iq_score[0])
         cursor.close()
@@ -344,86 +454,66 @@ async def get_quiz_results(bot, user_id):
                     notification=True
                     )
                 break
-        rows = await db.execute(
-            """
-            DELETE FROM events
-            WHERE user_id = $1
-            AND event_type = $2
-            """,
-            user_id,
-            "iq_quiz_vk"
-        )
+    # events пишутся отложенно - дописываем, чтобы удаление не опередило вставку
+    await write_behind.flush()
+    async with acquire() as db:
+        if get_scores:
+            rows = await db.execute(
+                """
+                DELETE FROM events
+                WHERE user_id = $1
+                AND event_type = $2
+                """,
+                user_id,
+                "iq_quiz_vk"
+            )
+            await db.execute(
+                """
+                INSERT INTO funnel_history (user_id, label)
+                VALUES ($1, $2)
+                """,
+                user_id,
+                "подписался на канал для получения резов iq-квиза"
+            )
+        # Отключаем уведомление
         await db.execute(
             """
-            INSERT INTO funnel_history (user_id, label)
-            VALUES ($1, $2)
+            UPDATE notifications
+            SET is_active = $1
+            WHERE user_id = $2
+            AND label = $3
             """,
+            False,
             user_id,
-            "подписался на канал для получения резов iq-квиза"
+            "get_iq_result"
         )
-    # Отключаем уведомление
-    await db.execute(
-        """
-        UPDATE notifications
-        SET is_active = $1
-        WHERE user_id = $2
-        AND label = $3
-        """,
-        False,
-        user_id,
-        "get_iq_result"
-    )
-    await db.close()
+        await _reset_notification_series_if_idle(db, user_id)
     return True
 
 # сохраняем все переходы по боту
 async def save_funnel_history(user_id, label):
     if label:
-        db = await create_connect()
-        await db.execute(
-            """INSERT INTO funnel_history (user_id, label)
-               VALUES ($1, $2)""",
-            user_id, bot_lead_stages.get(label, label)
-            )
-        await db.close()
+        await write_behind.add_funnel_history(user_id=user_id, label=bot_lead_stages.get(label, label))
     else:
         await logger.error(f"В словаре соответствий не найден этап {label}")
         return None
 
-# для сохранения в БД ивента
+# для сохранения в БД ивента (запись отложенная, apps/write_behind.py)
 async def save_event(user_id, event, rewrite=False):
-    db = await create_connect()
-    if rewrite:
-        await db.execute(
-            """INSERT INTO events (user_id, event_type, event_date)
-               VALUES ($1, $2, $3)
-               ON CONFLICT (user_id, event_type)
-               DO UPDATE SET event_date = EXCLUDED.event_date""",
-            user_id, event, datetime.utcnow()
-        )
-    else:
-        await db.execute(
-            """INSERT INTO events (user_id, event_type, event_date)
-               VALUES ($1, $2, $3)
-               ON CONFLICT (user_id, event_type)
-               DO NOTHING""",
-            user_id, event, datetime.utcnow()
-        )
-    await db.close()
+    await write_behind.add_event(user_id=user_id, event=event, rewrite=rewrite)
 
 # для проверки регистрации на PokerHub
 async def is_pokerhub_registered(user_id):
     input_data = {
         "users": [user_id]
         }
-    async with aiohttp.ClientSession() as session:
-        async with session.post('https://pokerhub.pro/api/tg/getusers', json=input_data) as response:
-            # Проверка успешности запроса
-            if response.status == 200:
-                data = await response.json()
-                return True if data else False
-            else:
-                return False
+    async with http_clients.session("pokerhub").post('https://pokerhub.pro/api/tg/getusers', json=input_data) as response:
+        # Проверка успешности запроса
+        if response.status == 200:
+            data = await response.json()
+            return True if data else False
+        else:
+            return False
 
 # запускает для конкретного юзера машину состояний
 async def set_user_state(bot, user_id: int, collect_data: list, if_collected: str):
@@ -491,43 +581,55 @@ def escape_string(input_string):
         return ""
     return html.escape(input_string)
 
-# получаем словарь инфы о юзере
+# получаем словарь инфы о юзере (из кэша профилей, bot.get_chat - только если юзера нет в кэше и в БД)
 async def get_user_info(bot, user_id):
-    try:
-        # Получение информации о пользователе
-        user = await bot.get_chat(user_id)
-        username = user.username
-        first_name = user.first_name
-        last_name = user.last_name
-        return {"username": username, "first_name": first_name, "last_name": last_name}
-    except Exception as e:
-        await logger.error(f'Ошибка получения информации о пользователе: {e}')
-        return {"username": "unknown", "first_name": "друг", "last_name": ""}
+    return await user_profiles.get_profile(bot=bot, user_id=user_id)
 
 async def encrypt_message(message):
-    f = Fernet(key_b64)
-    encrypted_message = f.encrypt(str(message).encode())
+    encrypted_message = cipher.encrypt(str(message).encode())
     return encrypted_message.decode('utf-8')
 
 
-# для подстановки значений в плейсхолдеры
-async def placeholders_replace(data, user_id, user_data):
-    if data:
-        if "{crypted_user_id}" in data:
-            # подменяем плейсхолдер
-            data = data.format(crypted_user_id = await encrypt_message(message=user_id))
-        if "{user_id}" in data:
-            data = data.format(user_id = user_id)
+# плейсхолдеры, которые заполняются без данных юзера из Telegram
+_USER_ID_FIELDS = frozenset({"user_id", "crypted_user_id"})
+
+
+class RenderContext(SafeDict):
+    """
+    Значения плейсхолдеров одного сообщения (текст и все кнопки). crypted_user_id шифруется
+    при первом обращении и не больше одного раза на сообщение, precompute=True - сразу.
+    Неизвестные плейсхолдеры остаются как есть (как в SafeDict)
+    """
 
+    def __init__(self, user_id, user_data, precompute=False):
+        super().__init__(user_data)
+        self.user_id = user_id
+        self["user_id"] = user_id
+        if precompute:
+            self["crypted_user_id"]
+
+    def __missing__(self, key):
+        if key == "crypted_user_id":
+            self[key] = cipher.encrypt(str(self.user_id).encode()).decode('utf-8')
+            return self[key]
+        return super().__missing__(key)
+
+
+# для подстановки значений в плейсхолдеры (context - общий для текста и кнопок одного сообщения)
+async def placeholders_replace(data, user_id, user_data, context=None):
+    if data:
+        if context is None:
+            context = RenderContext(user_id=user_id, user_data=user_data)
         # тут добавляем всевозможные значения, которые будем пытаться подставить в строку сообщения
-        placeholders = SafeDict(**user_data)
-        # объявляем объекты для сообщения
-        data = data.format_map(placeholders)
+        data = data.format_map(context)
     return data
 
 
 # эта функция для сборки клавиатур на основе списка кнопок из json
-async def get_keyboard(buttons_list, user_id, user_data):
+async def get_keyboard(buttons_list, user_id, user_data, context=None):
+    # id юзера шифруется один раз на всю клавиатуру
+    if context is None:
+        context = RenderContext(user_id=user_id, user_data=user_data)
     # сюда будем собирать кнопки
     buttons = []
     keyboard_type = None
@@ -544,11 +646,11 @@ async def get_keyboard(buttons_list, user_id, user_data):
             else:
                 # ищем web_app
                 if (web_app_url:=button.get("web_app", None)):
-                    web_app = WebAppInfo(url=await placeholders_replace(data=web_app_url, user_id=str(user_id), user_data=user_data))
+                    web_app = WebAppInfo(url=await placeholders_replace(data=web_app_url, user_id=user_id, user_data=user_data, context=context))
                 # пытаемся найти ссылку для этой кнопки
                 if (link:=button.get("link", None)):
                     # если в ссылке есть плейсхолдеры, они будут подставлены
-                    link = await placeholders_replace(data=link, user_id=str(user_id), user_data=user_data)
+                    link = await placeholders_replace(data=link, user_id=user_id, user_data=user_data, context=context)
                 # если ссылки для кнопки нет, то делаем callback для неё. Иначе колбек = False
                 callback = button.get('callback', None) if not link else None
                 # добавляем кнопку
@@ -621,93 +723,64 @@ _LAST_ACTIVITY_SCHEMA_LOCK = asyncio.Lock()
 _LAST_ACTIVITY_SCHEMA_INITIALIZED = False
 
 
-# для записи в БД действие юзера
+# для записи в БД действие юзера (запись отложенная, apps/write_behind.py)
 async def add_history(user_id, text):
-    db = await create_connect()
-    await db.execute(
-        """INSERT INTO user_history (user_id, text) VALUES ($1, LEFT($2, $3))""", user_id,
-        text, MAX_CHARS_USERS_HISTORY
-    )
-    await db.close()
+    await write_behind.add_history(user_id=user_id, text=text)
 
 
 async def ensure_last_activity_support(db=None):
     """Ensures that the users table contains the last_activity column."""
-    global _LAST_ACTIVITY_SCHEMA_INITIALIZED
-
     if _LAST_ACTIVITY_SCHEMA_INITIALIZED:
         return
 
-    owns_connection = False
     if db is None:
-        db = await create_connect()
-        owns_connection = True
+        async with acquire() as db:
+            await _ensure_last_activity_schema(db)
+    else:
+        await _ensure_last_activity_schema(db)
 
-    try:
-        async with _LAST_ACTIVITY_SCHEMA_LOCK:
-            if not _LAST_ACTIVITY_SCHEMA_INITIALIZED:
-                await db.execute(
-                    """
-                    ALTER TABLE users
-                    ADD COLUMN IF NOT EXISTS last_activity TIMESTAMPTZ
-                    """
-                )
-                await db.execute(
-                    """
-                    ALTER TABLE users
-                    ALTER COLUMN last_activity SET DEFAULT timezone('UTC', now())
-                    """
-                )
-                await db.execute(
-                    """
-                    UPDATE users
-                    SET last_activity = timezone('UTC', now())
-                    WHERE last_activity IS NULL
-                    """
-                )
-                _LAST_ACTIVITY_SCHEMA_INITIALIZED = True
-    finally:
-        if owns_connection and db:
-            await db.close()
 
+async def _ensure_last_activity_schema(db):
+    global _LAST_ACTIVITY_SCHEMA_INITIALIZED
 
-async def touch_user_activity(user_id: int):
-    """Updates user's last activity timestamp and recalculates notifications."""
-    db = None
-    try:
-        db = await create_connect()
-        await ensure_last_activity_support(db=db)
-        await db.execute(
-            """
-            UPDATE users
-            SET last_activity = timezone('UTC', now())
-            WHERE id = $1
-            """,
-            user_id,
-        )
-    except Exception as error:
-        await logger.error(f"Не удалось обновить last_activity пользователя {user_id}: {error}")
-        return
-    finally:
-        if db:
-            await db.close()
+    async with _LAST_ACTIVITY_SCHEMA_LOCK:
+        if not _LAST_ACTIVITY_SCHEMA_INITIALIZED:
+            await db.execute(
+                """
+                ALTER TABLE users
+                ADD COLUMN IF NOT EXISTS last_activity TIMESTAMPTZ
+                """
+            )
+            await db.execute(
+                """
+                ALTER TABLE users
+                ALTER COLUMN last_activity SET DEFAULT timezone('UTC', now())
+                """
+            )
+            await db.execute(
+                """
+                UPDATE users
+                SET last_activity = timezone('UTC', now())
+                WHERE last_activity IS NULL
+                """
+            )
+            _LAST_ACTIVITY_SCHEMA_INITIALIZED = True
 
-    try:
-        from apps.notifier import notificator
 
-        await notificator.recalculate_user_notifications(user_id=user_id)
-    except Exception as error:
-        await logger.error(
-            f"Не удалось пересчитать уведомления пользователя {user_id}: {error}"
-        )
+async def touch_user_activity(user_id: int):
+    """
+    Отмечает активность пользователя. last_activity пишется пачкой в фоне, уведомления
+    пересчитываются только после долгого простоя (apps/activity_tracker.py)
+    """
+    activity_tracker.touch(user_id)
 
 
 # для проверки действий юзера
-    async def run_action(action, user_id, bot):
+async def run_action(action, user_id, bot):
 
-        result = False
+    result = False
 
-        func = action.get("func", "")
+    func = action.get("func", "")
     # если это действие - проверка подписки на канал
     if func == "check_subs":
         channel = action.get("channel")
@@ -757,10 +830,10 @@ async def touch_user_activity(user_id: int):
         },
         """
         # закрывает уведомление в БД по его id
-        db = await create_connect()
-        for label in action.get('labels'):
-            await db.execute("UPDATE notifications SET is_active = $1 WHERE user_id = $2 AND label = $3 AND is_active = $4", False, user_id, label, True)
-        await db.close()
+        async with acquire() as db:
+            for label in action.get('labels'):
+                await db.execute("UPDATE notifications SET is_active = $1 WHERE user_id = $2 AND label = $3 AND is_active = $4", False, user_id, label, True)
+            await _reset_notification_series_if_idle(db, user_id)
         result = True
     # функция закрывает все отложеное уведомления
     elif func == "close_all_notifications":
@@ -772,9 +845,9 @@ async def touch_user_activity(user_id: int):
         },
         """
         # закрывает уведомление в БД по его id
-        db = await create_connect()
-        await db.execute("UPDATE notifications SET is_active = $1 WHERE user_id = $2 AND is_active = $3", False, user_id, True)
-        await db.close()
+        async with acquire() as db:
+            await db.execute("UPDATE notifications SET is_active = $1 WHERE user_id = $2 AND is_active = $3", False, user_id, True)
+            await _reset_notification_series(db, user_id)
         result = True
     # функция для записи данных в гегл-таблицу
     elif func == "push_gsheet":
@@ -788,17 +861,31 @@ async def touch_user_activity(user_id: int):
     return result if not action.get("reverse_result", False) else not result
 
 # общая функция для отправки сообщения
-async def send_message(bot, user_id, msg_data, persona="default", route="start", user_data={}, notification=False):
+async def send_message(bot, user_id, msg_data, persona="default", route="start", user_data={}, notification=False, funnel_name=None):
+
+    compiled = isinstance(msg_data, CompiledNode)
+    # плейсхолдеры скомпилированного узла известны заранее
+    fields = frozenset()
+    if compiled:
+        if msg_data.template:
+            fields |= msg_data.template.fields
+        if msg_data.keyboard:
+            fields |= msg_data.keyboard.fields
 
     text = msg_data.get("text", None)
     # user_data отсутствует, если сообщение отправляется как отложенное уведомление
-    if not user_data:
+    # (для скомпилированного узла запрашиваем его, только если в тексте/кнопках есть данные юзера)
+    if not user_data and (not compiled or fields - _USER_ID_FIELDS):
         user_data = await get_user_info(bot=bot, user_id=user_id)
     # тут мы экранируем символы < > и &, чтобы не было ошибок при отправке сообщения
     user_data = {key: escape_string(value) for key, value in user_data.items()}
 
-    # вставляем данные на места плейсхолдеров, если они есть
-    text = await placeholders_replace(data=text, user_id=user_id, user_data=user_data) if text else None
+    # вставляем данные на места плейсхолдеров, если они есть (один контекст на текст и кнопки)
+    context = RenderContext(user_id=user_id, user_data=user_data)
+    if compiled:
+        text = msg_data.template.render(context) if msg_data.template else None
+    else:
+        text = await placeholders_replace(data=text, user_id=user_id, user_data=user_data, context=context) if text else None
 
     file=msg_data.get("file", None)
     files=msg_data.get("files", None)
@@ -828,8 +915,11 @@ async def send_message(bot, user_id, msg_data, persona="default", route="start",
 
     # проверяем, есть-ли кнопки для этого сообщения
     keyboard = None
-    if (buttons_list:=msg_data.get("buttons", None)):
-        keyboard = await get_keyboard(buttons_list=buttons_list, user_id=user_id, user_data=user_data)
+    if compiled and msg_data.keyboard:
+        # статичная клавиатура собрана при загрузке воронки
+        keyboard = msg_data.keyboard.render(context)
+    elif not compiled and (buttons_list:=msg_data.get("buttons", None)):
+        keyboard = await get_keyboard(buttons_list=buttons_list, user_id=user_id, user_data=user_data, context=context)
     # если есть метка, что нужно удалить клаву
     elif msg_data.get("remove_keyboard", False):
         keyboard = ReplyKeyboardRemove()
@@ -886,7 +976,7 @@ async def send_message(bot, user_id, msg_data, persona="default", route="start",
     if notification and result and (notifications:=msg_data.get('notifications', None)):
         from apps.notifier import notificator
         await notificator.add_notifications(user_id=user_id,
-            notifications=notifications)
+            notifications=notifications, funnel_name=funnel_name)
 
     # возвращаем результат отправки (True/False)
     return result
@@ -0,0 +1,347 @@
+"""
+Компиляция воронок (map.json, apps/funnels/*.json) при загрузке.
+
+JSON воронок во время работы не меняется, поэтому всё, что не зависит от юзера,
+считается один раз: шаблоны текста разбиваются на куски, статичные клавиатуры
+собираются заранее (заново рендерятся только кнопки с плейсхолдерами в link/web_app),
+action/actions приводятся к списку, а маршрут is_ok вычисляется заранее. validate_funnels проверяет граф воронок целиком.
+
+Узел воронки (CompiledNode) остаётся словарём только для чтения, поэтому старый код
+(msg_data.get("text"), msg_data.get("buttons")...) работает без изменений.
+"""
+from collections.abc import Mapping
+from datetime import datetime
+from pathlib import Path
+from string import Formatter
+from types import MappingProxyType
+
+from aiogram.types import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    KeyboardButton,
+    ReplyKeyboardMarkup,
+)
+from aiogram.types.web_app_info import WebAppInfo
+
+_formatter = Formatter()
+
+
+class CompiledTemplate:
+    """Строка с плейсхолдерами {name}, заранее разбитая на куски"""
+
+    __slots__ = ("source", "segments", "fields")
+
+    def __init__(self, source: str):
+        self.source = source
+        segments = []
+        fields = set()
+        try:
+            for literal, field, spec, conversion in _formatter.parse(source):
+                if field is not None and (not field.isidentifier() or spec or conversion):
+                    # сложные плейсхолдеры ({a.b}, {x:>3}) оставляем str.format_map
+                    segments = None
+                    break
+                segments.append((literal, field))
+                if field is not None:
+                    fields.add(field)
+        except ValueError:
+            # непарные скобки - такой текст отправляется как есть
+            segments = [(source, None)]
+            fields = set()
+        self.segments = tuple(segments) if segments is not None else None
+        self.fields = frozenset(fields)
+
+    def render(self, values: Mapping) -> str:
+        """Подставляет значения; неизвестные плейсхолдеры остаются как есть (как SafeDict)"""
+        if not self.fields:
+            return "".join(literal for literal, _ in self.segments) if self.segments else self.source
+        if self.segments is None:
+            return self.source.format_map(_SafeValues(values))
+        safe_values = _SafeValues(values)
+        parts = []
+        for literal, field in self.segments:
+            parts.append(literal)
+            if field is not None:
+                parts.append(str(safe_values[field]))
+        return "".join(parts)
+
+
+class _SafeValues:
+    """Обёртка над значениями: неизвестный плейсхолдер остаётся как есть. Значения читаются
+    через [] (а не копируются), поэтому ленивые значения (funcs.RenderContext) считаются по запросу"""
+
+    __slots__ = ("values",)
+
+    def __init__(self, values: Mapping):
+        self.values = values
+
+    def __getitem__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            return "{" + key + "}"
+
+
+class CompiledKeyboard:
+    """
+    Клавиатура узла. Если ни в одной кнопке нет плейсхолдеров - markup собран заранее
+    и переиспользуется, иначе пересобираются только кнопки с плейсхолдерами
+    """
+
+    __slots__ = ("rows", "markup_type", "static_markup", "fields")
+
+    def __init__(self, buttons_list):
+        rows = []
+        markup_type = None
+        fields = set()
+        for row in buttons_list:
+            rows.append([])
+            for button in row:
+                if button.get("type", None) == "button":
+                    rows[-1].append(KeyboardButton(text=button["title"], request_contact=button.get("request_contact", None)))
+                    markup_type = markup_type or ReplyKeyboardMarkup
+                    continue
+
+                link = button.get("link", None)
+                web_app_url = button.get("web_app", None)
+                link_template = CompiledTemplate(link) if link else None
+                web_app_template = CompiledTemplate(web_app_url) if web_app_url else None
+                dynamic = [template for template in (link_template, web_app_template) if template and template.fields]
+                if dynamic:
+                    for template in dynamic:
+                        fields |= template.fields
+                    rows[-1].append((button, link_template, web_app_template))
+                else:
+                    rows[-1].append(_inline_button(button, link, web_app_url))
+                markup_type = markup_type or InlineKeyboardMarkup
+
+        self.rows = tuple(tuple(row) for row in rows)
+        self.markup_type = markup_type
+        self.fields = frozenset(fields)
+        self.static_markup = None if fields else self._markup([list(row) for row in self.rows])
+
+    def _markup(self, buttons):
+        if self.markup_type == ReplyKeyboardMarkup:
+            return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
+        elif self.markup_type == InlineKeyboardMarkup:
+            return InlineKeyboardMarkup(inline_keyboard=buttons, resize_keyboard=True)
+        return None
+
+    def render(self, values: Mapping):
+        if self.static_markup is not None or self.markup_type is None:
+            return self.static_markup
+        buttons = []
+        for row in self.rows:
+            buttons.append([])
+            for item in row:
+                if isinstance(item, tuple):
+                    button, link_template, web_app_template = item
+                    item = _inline_button(
+                        button,
+                        link_template.render(values) if link_template else None,
+                        web_app_template.render(values) if web_app_template else None,
+                    )
+                buttons[-1].append(item)
+        return self._markup(buttons)
+
+
+def _inline_button(button, link, web_app_url):
+    # если ссылки для кнопки нет, то делаем callback для неё
+    return InlineKeyboardButton(
+        text=button["title"],
+        callback_data=button.get("callback", None) if not link else None,
+        url=link if link else None,
+        web_app=WebAppInfo(url=web_app_url) if web_app_url else None,
+    )
+
+
+def _extract_next_route(action_data):
+    """Возвращает маршрут из action(s), если он указан."""
+    if isinstance(action_data, dict):
+        return action_data.get("is_ok")
+    if isinstance(action_data, list):
+        for action in reversed(action_data):
+            if isinstance(action, dict) and action.get("is_ok"):
+                return action["is_ok"]
+    return None
+
+
+def _normalize_actions(node: Mapping):
+    """action/actions -> кортеж действий; None, если формат неверный"""
+    act = node.get("action") or node.get("actions")
+    if not act:
+        return ()
+    if isinstance(act, dict):
+        return (act,)
+    if isinstance(act, list):
+        return tuple(act)
+    return None
+
+
+class CompiledNode(Mapping):
+    """Узел воронки: исходный JSON только для чтения + заранее посчитанные части"""
+
+    __slots__ = ("_data", "template", "keyboard", "actions", "next_route")
+
+    def __init__(self, data: dict):
+        self._data = MappingProxyType(data)
+        text = data.get("text")
+        self.template = CompiledTemplate(text) if isinstance(text, str) and text else None
+        buttons = data.get("buttons")
+        self.keyboard = CompiledKeyboard(buttons) if buttons else None
+        self.actions = _normalize_actions(data)
+        self.next_route = _extract_next_route(data.get("action") or data.get("actions"))
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"CompiledNode({dict(self._data)!r})"
+
+
+def node_actions(node):
+    """(действия, маршрут is_ok) узла - из скомпилированного узла или из сырого словаря"""
+    if isinstance(node, CompiledNode):
+        return node.actions, node.next_route
+    act = node.get("action") or node.get("actions")
+    return _normalize_actions(node), _extract_next_route(act)
+
+
+def compile_funnel(funnel: dict) -> dict:
+    """Компилирует все узлы воронки ({"start": {...}, "callback": {...}})"""
+    compiled = {}
+    for section, nodes in funnel.items():
+        if isinstance(nodes, dict):
+            compiled[section] = {
+                label: CompiledNode(node) if isinstance(node, dict) else node
+                for label, node in nodes.items()
+            }
+        else:
+            compiled[section] = nodes
+    return compiled
+
+
+# -----------------------------
+#     ПРОВЕРКА ВОРОНОК
+# -----------------------------
+_AT_TIME_KEYS = {"wait_seconds", "target_datetime", "time", "delta_days"}
+
+
+def _check_at_time(at_time):
+    """Текст ошибки в at_time (в формате SmartNotifier._calculate_send_time) или None"""
+    if not isinstance(at_time, Mapping):
+        return f"at_time должен быть объектом, а не {type(at_time).__name__}"
+    if unknown := set(at_time) - _AT_TIME_KEYS:
+        return f"неизвестные ключи at_time: {', '.join(sorted(unknown))}"
+    if "wait_seconds" in at_time:
+        wait = at_time["wait_seconds"]
+        if isinstance(wait, bool) or not isinstance(wait, (int, float)) or wait <= 0:
+            return f"wait_seconds должен быть положительным числом, а не {wait!r}"
+        return None
+    if "target_datetime" in at_time:
+        try:
+            datetime.strptime(at_time["target_datetime"], "%d.%m.%Y %H:%M")
+        except (TypeError, ValueError):
+            return f"target_datetime должен быть в формате ДД.ММ.ГГГГ ЧЧ:ММ, а не {at_time['target_datetime']!r}"
+        return None
+    try:
+        hour, minute = map(int, str(at_time.get("time", "00:00")).split(":"))
+        if not (0 <= hour < 24 and 0 <= minute < 60):
+            raise ValueError
+    except ValueError:
+        return f"time должен быть в формате ЧЧ:ММ, а не {at_time.get('time')!r}"
+    delta_days = at_time.get("delta_days", 1)
+    if isinstance(delta_days, bool) or not isinstance(delta_days, int) or delta_days < 0:
+        return f"delta_days должен быть целым числом >= 0, а не {delta_days!r}"
+    return None
+
+
+def _node_files(node: Mapping, actions):
+    """Все описания файлов узла: file, files и файлы в действиях send_file"""
+    if isinstance(file := node.get("file"), Mapping):
+        yield file
+    for source in (node, *(action for action in actions or () if isinstance(action, Mapping))):
+        if isinstance(files := source.get("files"), list):
+            yield from (item for item in files if isinstance(item, Mapping))
+
+
+def validate_funnels(funnels: Mapping, base_dir: Path | None = None) -> tuple[list, list]:
+    """
+    Проверяет граф всех воронок целиком. Возвращает (ошибки, предупреждения) - списки строк.
+    Ошибки: callback/is_ok/message на несуществующий узел, неверный action(s) или at_time,
+    отсутствующий файл. Предупреждения: узлы callback, до которых нельзя дойти из start
+    (на них можно попасть ещё по ссылке /start <label> или из кода, поэтому это не ошибка)
+    """
+    errors, warnings = [], []
+    for funnel_name, funnel in funnels.items():
+        callbacks = funnel.get("callback") or {}
+        edges = {}
+
+        def check_route(where, target, kind):
+            if target not in callbacks:
+                errors.append(f"[{funnel_name}] {where}: {kind} '{target}' - нет такого узла в callback")
+                return
+            edges[where].add(target)
+
+        for section in ("start", "callback"):
+            for label, node in (funnel.get(section) or {}).items():
+                where = f"{section}.{label}"
+                edges[where] = set()
+                if not isinstance(node, Mapping):
+                    errors.append(f"[{funnel_name}] {where}: узел должен быть объектом")
+                    continue
+
+                for row in node.get("buttons") or ():
+                    for button in row:
+                        if button.get("type") == "button" or button.get("link") or button.get("web_app"):
+                            continue
+                        if callback := button.get("callback"):
+                            check_route(where, callback, "callback")
+                        else:
+                            errors.append(f"[{funnel_name}] {where}: у кнопки '{button.get('title')}' нет callback/link")
+
+                actions, next_route = node_actions(node)
+                if actions is None:
+                    errors.append(f"[{funnel_name}] {where}: action(s) должен быть объектом или списком")
+                elif next_route:
+                    check_route(where, next_route, "is_ok")
+
+                for notification in node.get("notifications") or ():
+                    target_name = (notification.get("funnel") or funnel_name).lower()
+                    target = funnels.get(target_name)
+                    message_label = notification.get("message")
+                    if target is None:
+                        errors.append(f"[{funnel_name}] {where}: уведомление '{message_label}' - нет воронки '{target_name}'")
+                    elif message_label not in (target.get("callback") or {}):
+                        errors.append(f"[{funnel_name}] {where}: уведомление '{message_label}' - нет такого узла в callback")
+                    elif target_name == funnel_name:
+                        edges[where].add(message_label)
+                    if problem := _check_at_time(notification.get("at_time")):
+                        errors.append(f"[{funnel_name}] {where}: уведомление '{message_label}': {problem}")
+
+                if base_dir is not None:
+                    for file in _node_files(node, actions):
+                        for key in ("file_path", "thumbnail"):
+                            if (path := file.get(key)) and not (base_dir / path).exists():
+                                errors.append(f"[{funnel_name}] {where}: файл {path} не существует")
+
+        # достижимость: обход от всех узлов start
+        reachable = set()
+        stack = [where for where in edges if where.startswith("start.")]
+        while stack:
+            where = stack.pop()
+            for label in edges.get(where, ()):
+                if label not in reachable:
+                    reachable.add(label)
+                    stack.append(f"callback.{label}")
+        for label in callbacks:
+            if label not in reachable:
+                warnings.append(f"[{funnel_name}] callback.{label}: недостижим из start")
+
+    return errors, warnings
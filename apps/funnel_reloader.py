@@ -0,0 +1,136 @@
+"""
+Проверка и горячая перезагрузка воронок (apps/funnels/*.json, map.json) без перезапуска бота.
+
+При старте бота check_funnels() проверяет весь граф воронок и пишет проблемы в лог.
+Дальше воронки перечитываются по SIGHUP или при изменении файлов (проверка раз в
+FUNNEL_RELOAD_INTERVAL секунд). Новый снимок собирается и проверяется в фоне и подменяет
+modules.FUNNELS целиком, polling и FSM-состояния пользователей при этом не трогаются.
+
+Снимок не применяется, если файл не удалось прочитать или в нём появились новые ошибки
+(ошибки, которые уже были в текущих воронках, перезагрузку не блокируют).
+"""
+import asyncio
+import signal
+from contextlib import suppress
+
+import modules
+import apps.logger as logger
+import apps.media_prewarm as media_prewarm
+from apps.funnel_compiler import validate_funnels
+
+# ошибки текущего снимка воронок (для сравнения с новым снимком)
+_current_errors = set()
+_reload_lock = asyncio.Lock()
+_watch_task = None
+# задачи перезагрузки по SIGHUP и предзагрузки медиа (ссылка держится, пока задача идёт)
+_sighup_task = None
+_prewarm_task = None
+
+
+def _files_signature():
+    """Имя, время изменения и размер файлов воронок - по ним видно, что файлы поменялись"""
+    signature = []
+    for path in modules.funnel_files():
+        with suppress(OSError):
+            stat = path.stat()
+            signature.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _build_snapshot():
+    """Читает, компилирует и проверяет воронки (в отдельном потоке, чтобы не блокировать loop)"""
+    load_errors = []
+    funnels = modules._load_funnels(load_errors)
+    errors, warnings = validate_funnels(funnels, modules.BASE_DIR)
+    return funnels, load_errors, errors, warnings, _files_signature()
+
+
+async def _log_problems(errors, warnings):
+    for problem in errors:
+        await logger.error(f"Воронки: {problem}")
+    for problem in warnings:
+        await logger.debug(f"Воронки: {problem}")
+
+
+async def check_funnels():
+    """Проверяет воронки, загруженные при старте, и пишет найденные проблемы в лог"""
+    global _current_errors
+    errors, warnings = await asyncio.to_thread(validate_funnels, modules.FUNNELS, modules.BASE_DIR)
+    _current_errors = set(errors)
+    await _log_problems(errors, warnings)
+    await logger.info(
+        f"Воронки загружены: {', '.join(modules.available_funnels())}; "
+        f"ошибок: {len(errors)}, недостижимых узлов: {len(warnings)}"
+    )
+
+
+async def reload_funnels(reason: str = "") -> bool:
+    """Собирает новый снимок воронок и подменяет текущий. True - снимок применён"""
+    global _current_errors, _prewarm_task
+    async with _reload_lock:
+        funnels, load_errors, errors, warnings, _ = await asyncio.to_thread(_build_snapshot)
+        if load_errors or not funnels:
+            for problem in load_errors:
+                await logger.error(f"Воронки не перезагружены ({reason}): {problem}")
+            if not funnels:
+                await logger.error(f"Воронки не перезагружены ({reason}): не найдено ни одной воронки")
+            return False
+
+        new_errors = [problem for problem in errors if problem not in _current_errors]
+        if new_errors:
+            await _log_problems(new_errors, ())
+            await logger.error(f"Воронки не перезагружены ({reason}): новых ошибок - {len(new_errors)}")
+            return False
+
+        modules.swap_funnels(funnels)
+        _current_errors = set(errors)
+        await logger.info(
+            f"Воронки перезагружены ({reason}): {', '.join(funnels)}; "
+            f"ошибок: {len(errors)}, недостижимых узлов: {len(warnings)}"
+        )
+
+    # новые файлы из воронок сразу загружаем в служебный чат (уже загруженные пропускаются)
+    if media_prewarm.MEDIA_PREWARM_CHAT:
+        _prewarm_task = logger.create_background_task(media_prewarm.prewarm_media())
+    return True
+
+
+async def _watch(interval: float):
+    signature = await asyncio.to_thread(_files_signature)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            current = await asyncio.to_thread(_files_signature)
+            if current != signature:
+                signature = current
+                await reload_funnels("файлы изменились")
+        except Exception as error:
+            await logger.error(f"Ошибка проверки файлов воронок: {error}")
+
+
+def _on_sighup():
+    global _sighup_task
+    _sighup_task = logger.create_background_task(reload_funnels("SIGHUP"))
+
+
+def start_funnel_reloader(interval: float | None = None):
+    """Включает перезагрузку воронок по SIGHUP и по изменению файлов (вызывать из bot.main)"""
+    global _watch_task
+    interval = modules.FUNNEL_RELOAD_INTERVAL if interval is None else interval
+    loop = asyncio.get_running_loop()
+    # на Windows SIGHUP нет, там остаётся только проверка файлов
+    if hasattr(signal, "SIGHUP"):
+        with suppress(NotImplementedError, RuntimeError):
+            loop.add_signal_handler(signal.SIGHUP, _on_sighup)
+    if interval > 0 and _watch_task is None:
+        _watch_task = logger.create_background_task(_watch(interval), loop)
+
+
+def stop_funnel_reloader():
+    global _watch_task
+    if hasattr(signal, "SIGHUP"):
+        with suppress(NotImplementedError, RuntimeError, ValueError):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+    if _watch_task is not None:
+        _watch_task.cancel()
+        _watch_task = None
@@ -0,0 +1,237 @@
+"""
+Отправка истории сообщений в веб-панель (messages_history) пачками.
+
+add() только кладёт запись в локальную очередь (spool) и присваивает ей порядковый номер.
+Раз в HISTORY_FLUSH_INTERVAL_MS (или как только набралось HISTORY_BATCH записей) очередь
+отправляется на бекенд: одним запросом на HISTORY_BULK_PATH, если он задан, иначе
+по одной записи на add-message, причём разные чаты отправляются параллельно
+(до HISTORY_CONCURRENCY одновременно), а сообщения одного чата - строго по порядку.
+
+Записи, не отправленные из-за сетевой ошибки, таймаута, 5xx или 429, возвращаются в начало
+очереди и повторяются с растущей паузой (до HISTORY_RETRY_MAX_DELAY секунд), сообщения этого
+чата ждут их. Остальные ответы с ошибкой (4xx, не JSON) повтором не исправить - такие записи
+логируются и отбрасываются, чтобы одна плохая запись не держала историю чата. Поэтому недоступность
+бекенда очередь переживает: записи отбрасываются, только если пролежали дольше
+HISTORY_MAX_AGE секунд или очередь переполнена (HISTORY_SPOOL_LIMIT, уходят самые старые).
+При остановке бота close() дописывает остаток.
+"""
+import asyncio
+import json
+from collections import deque
+from datetime import datetime, timezone
+from itertools import count
+from os import getenv
+from time import monotonic
+
+import apps.logger as logger
+import apps.http_clients as http_clients
+from apps.resilience import backoff_delay
+from modules import headers, get_host
+
+# как часто отправляем накопленное (мс) и сколько записей отправляем сразу, не дожидаясь таймера
+HISTORY_FLUSH_INTERVAL_MS = int(getenv('history_flush_interval_ms', 300))
+HISTORY_BATCH = int(getenv('history_batch', 200))
+# сколько записей максимум держим в очереди (самые старые отбрасываются)
+HISTORY_SPOOL_LIMIT = int(getenv('history_spool_limit', 10000))
+# сколько чатов отправляем одновременно (без bulk-эндпоинта)
+HISTORY_CONCURRENCY = int(getenv('history_concurrency', 8))
+# пауза между повторами растёт от 1 сек до HISTORY_RETRY_MAX_DELAY
+HISTORY_RETRY_MAX_DELAY = float(getenv('history_retry_max_delay', 60))
+# сколько секунд запись может ждать отправки, прежде чем её отбросить
+HISTORY_MAX_AGE = float(getenv('history_max_age', 86400))
+# путь bulk-эндпоинта на бекенде (принимает {"messages": [...]}), пусто - отправка по одной
+HISTORY_BULK_PATH = getenv('history_bulk_path', '')
+
+# записи в порядке добавления: {"seq", "attempts", "added_at", "next_attempt_at", "body"}
+_spool = deque()
+# порядковые номера записей (по ним восстанавливается порядок после повторов)
+_sequence = count(1)
+_flush_lock = asyncio.Lock()
+_wakeup = None
+_flusher_task = None
+_flusher_loop = None
+
+
+def pending() -> int:
+    """Сколько записей ждут отправки"""
+    return len(_spool)
+
+
+def _ensure_flusher(loop):
+    global _wakeup, _flusher_task, _flusher_loop
+    if _flusher_loop is loop and _flusher_task is not None and not _flusher_task.done():
+        return
+    _flusher_loop = loop
+    _wakeup = asyncio.Event()
+    _flusher_task = logger.create_background_task(_flusher(), loop)
+
+
+async def _flusher():
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), HISTORY_FLUSH_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        if _spool:
+            # shield: остановка (close) не обрывает пачку на середине отправки
+            await asyncio.shield(flush())
+
+
+async def add(chat_id, author_id, content, type="text", name=None) -> int:
+    """Ставит сообщение в очередь на запись в историю, возвращает его порядковый номер"""
+    seq = next(_sequence)
+    _spool.append({
+        "seq": seq,
+        "attempts": 0,
+        "added_at": monotonic(),
+        "next_attempt_at": 0,
+        "body": {
+            'content': content,
+            'chat_id': chat_id,
+            'author_id': author_id,
+            'type': type,
+            'name': name,
+        },
+    })
+    if len(_spool) > HISTORY_SPOOL_LIMIT:
+        dropped = _spool.popleft()
+        await logger.error(f"Очередь истории сообщений переполнена, запись #{dropped['seq']} отброшена: {dropped['body']}")
+    _ensure_flusher(asyncio.get_running_loop())
+    if len(_spool) >= HISTORY_BATCH:
+        _wakeup.set()
+    return seq
+
+
+async def flush(ignore_backoff: bool = False) -> int:
+    """Отправляет одну пачку из очереди, возвращает число отправленных записей"""
+    async with _flush_lock:
+        await _drop_expired()
+        batch = _take_batch(ignore_backoff)
+        if not batch:
+            return 0
+        if HISTORY_BULK_PATH:
+            failed = await _send_bulk(batch)
+        else:
+            failed = await _send_by_chat(batch)
+        await _requeue(failed)
+        return len(batch) - len(failed)
+
+
+def _take_batch(ignore_backoff: bool) -> list:
+    """Берёт из очереди до HISTORY_BATCH записей, чьё время повтора подошло (чат ждёт свою первую запись)"""
+    global _spool
+    now = monotonic()
+    batch, rest, waiting_chats = [], deque(), set()
+    for entry in _spool:
+        chat_id = entry["body"]["chat_id"]
+        if len(batch) >= HISTORY_BATCH or chat_id in waiting_chats:
+            rest.append(entry)
+        elif not ignore_backoff and entry["next_attempt_at"] > now:
+            waiting_chats.add(chat_id)
+            rest.append(entry)
+        else:
+            batch.append(entry)
+    _spool = rest
+    return batch
+
+
+async def _drop_expired():
+    expired = 0
+    deadline = monotonic() - HISTORY_MAX_AGE
+    while _spool and _spool[0]["added_at"] < deadline:
+        _spool.popleft()
+        expired += 1
+    if expired:
+        await logger.error(f"История сообщений: отброшено {expired} записей, не отправленных за {HISTORY_MAX_AGE:.0f} сек")
+
+
+async def _requeue(failed):
+    """Возвращает неотправленные записи в начало очереди (по порядку номеров) с паузой до повтора"""
+    now = monotonic()
+    for entry in failed:
+        entry["attempts"] += 1
+        entry["next_attempt_at"] = now + backoff_delay(entry["attempts"], base=1, cap=HISTORY_RETRY_MAX_DELAY)
+    retry = sorted(failed, key=lambda entry: entry["seq"])
+    _spool.extendleft(reversed(retry))
+    while len(_spool) > HISTORY_SPOOL_LIMIT:
+        dropped = _spool.popleft()
+        await logger.error(f"Очередь истории сообщений переполнена, запись #{dropped['seq']} отброшена: {dropped['body']}")
+
+
+def _is_retryable_status(status: int) -> bool:
+    """Временная ошибка бекенда (5xx, 429) - запрос можно повторить"""
+    return status == 429 or status >= 500
+
+
+async def _send_bulk(batch) -> list:
+    """Вся пачка одним запросом; при временной ошибке повторяется целиком"""
+    sent_at = datetime.now(timezone.utc).isoformat()
+    messages = [{**entry["body"], "seq": entry["seq"], "sent_at": sent_at} for entry in batch]
+    try:
+        session = http_clients.session("backend")
+        async with session.post(get_host() + HISTORY_BULK_PATH, json={"messages": messages}, headers=headers) as response:
+            if response.status == 200:
+                return []
+            await logger.error(f"Не удалось сохранить {len(batch)} сообщений в истории: статускод {response.status}, ответ: {await response.text()}")
+            if not _is_retryable_status(response.status):
+                # повтор не поможет - пачка отброшена
+                return []
+    except Exception as error:
+        await logger.error(f"Не удалось сохранить {len(batch)} сообщений в истории: {error}")
+    return batch
+
+
+async def _send_by_chat(batch) -> list:
+    """Чаты параллельно, сообщения одного чата - по порядку; возвращает неотправленные"""
+    chats = {}
+    for entry in batch:
+        chats.setdefault(entry["body"]["chat_id"], []).append(entry)
+    semaphore = asyncio.Semaphore(HISTORY_CONCURRENCY)
+
+    async def send_chat(entries):
+        async with semaphore:
+            for index, entry in enumerate(entries):
+                if not await _send_one(entry["body"]):
+                    # следующие сообщения чата ждут, чтобы не нарушить порядок
+                    return entries[index:]
+            return []
+
+    results = await asyncio.gather(*(send_chat(entries) for entries in chats.values()))
+    return [entry for failed in results for entry in failed]
+
+
+async def _send_one(body) -> bool:
+    """False - временная ошибка, запись нужно повторить; ответ с постоянной ошибкой запись отбрасывает"""
+    try:
+        session = http_clients.session("backend")
+        async with session.post(get_host()+'/messages_history/add-message', json=body, headers=headers) as response:
+            status = response.status
+            text = await response.text()
+    except Exception as error:
+        await logger.error(f"Не удалось сохранить сообщение в истории: {error}")
+        return False
+    if _is_retryable_status(status):
+        await logger.error(f"Не удалось сохранить сообщение в истории: статускод {status}, запись будет повторена")
+        return False
+    try:
+        json.loads(text)
+    except json.JSONDecodeError as error:
+        await logger.error(f"Не удалось сохранить сообщение в истории (статускод {status}), запись отброшена: {error}. Текст ответа: {text}")
+        return True
+    if status >= 400:
+        await logger.error(f"Не удалось сохранить сообщение в истории (статускод {status}), запись отброшена. Ответ: {text}")
+    return True
+
+
+async def close():
+    """Останавливает фоновую отправку и дописывает очередь (вызывать до закрытия HTTP-сессий)"""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        _flusher_task = None
+    # пока пачки уходят (без пауз между повторами); если бекенд недоступен - остаток теряется
+    while _spool and await flush(ignore_backoff=True):
+        pass
+    if _spool:
+        await logger.error(f"При остановке не сохранено в истории сообщений: {len(_spool)} записей")
@@ -0,0 +1,77 @@
+"""
+Общие HTTP-сессии для внешних сервисов: одна aiohttp.ClientSession (свой пул соединений)
+на каждый upstream вместо новой сессии на каждый запрос.
+
+Соединения переиспользуются (keep-alive), DNS кэшируется, у каждого сервиса свой лимит
+соединений и таймауты. Время запросов попадает в лог апдейта (logger.http_trace_config),
+а соединение апдейта с БД на время запроса возвращается в пул (modules.release_bound_connection).
+Сессия создаётся при первом запросе, close() вызывается при остановке бота.
+
+Использование:
+    async with http_clients.session("backend").post(url, json=body) as response:
+        ...
+"""
+import asyncio
+from os import getenv
+
+import aiohttp
+
+import apps.logger as logger
+from modules import release_bound_connection
+
+# через сколько секунд простоя закрывать keep-alive соединение
+HTTP_KEEPALIVE_TIMEOUT = float(getenv('http_keepalive_timeout', 30))
+# сколько секунд помнить DNS-ответ
+HTTP_DNS_CACHE_TTL = int(getenv('http_dns_cache_ttl', 300))
+
+# upstream -> (максимум соединений, таймаут запроса целиком, таймаут подключения), сек
+UPSTREAMS = {
+    "jivo": (20, 15, 5),  # JIVO-интегратор (JIVO_INTEGRATOR_URL)
+    "backend": (50, 30, 5),  # локальный бекенд (get_host())
+    "pokerhub": (20, 30, 10),  # pokerhub.pro
+    "discord": (5, 15, 10),  # discord.com
+    "amo": (10, 30, 10),  # AMO CRM
+    "telegraphyx": (5, 15, 10),  # app.telegraphyx.ru
+}
+
+# upstream -> (event loop, сессия): сессия привязана к loop, в котором создана
+_sessions = {}
+
+
+async def _on_request_start(session, context, params):
+    # пока ждём внешний сервис, соединение апдейта с БД не нужно - возвращаем его в пул
+    await release_bound_connection()
+
+
+def _db_release_trace_config():
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    return trace_config
+
+
+def session(upstream: str) -> aiohttp.ClientSession:
+    """Сессия upstream'а (создаётся при первом обращении и после закрытия)"""
+    loop = asyncio.get_running_loop()
+    session_loop, client = _sessions.get(upstream, (None, None))
+    if client is None or client.closed or session_loop is not loop:
+        limit, total, connect = UPSTREAMS[upstream]
+        client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=limit,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            ),
+            timeout=aiohttp.ClientTimeout(total=total, connect=connect),
+            trace_configs=[logger.http_trace_config(), _db_release_trace_config()],
+        )
+        _sessions[upstream] = (loop, client)
+    return client
+
+
+async def close():
+    """Закрывает все сессии (вызывается при остановке бота)"""
+    sessions = list(_sessions.values())
+    _sessions.clear()
+    for _, client in sessions:
+        if not client.closed:
+            await client.close()
@@ -0,0 +1,305 @@
+"""
+Пересылка сообщений пользователей в живую поддержку (JIVO) в фоне.
+
+Обработчик сообщения только ставит его в очередь пользователя (enqueue) и сразу завершается.
+Пути вложений (bot.get_file) запрашиваются сразу при постановке в очередь и параллельно,
+а в JIVO сообщения одного пользователя уходят строго по порядку: у каждого пользователя
+свой обработчик очереди. Разные пользователи обслуживаются параллельно, но не больше
+JIVO_RELAY_CONCURRENCY одновременно. Запись в историю сообщений - через history_batcher.
+
+Перед сообщением пользователя в JIVO уходят накопленные для него сообщения из
+jivo_integration_queue (триггерные сообщения ПХ и сообщения, отложенные, пока JIVO был
+недоступен), после чего они деактивируются. Если JIVO всё ещё недоступен, новое сообщение
+тоже откладывается в очередь, чтобы не обогнать старые.
+
+Отложенные сообщения (source = 'relay') юзеров, которые больше ничего не пишут, дошлёт
+фоновый разборщик (start_queue_drainer): раз в JIVO_DRAIN_INTERVAL секунд он берёт до
+JIVO_DRAIN_USERS юзеров и пересылает их очереди, не больше JIVO_DRAIN_CONCURRENCY
+одновременно. Строки берутся в работу коротким UPDATE ... FOR UPDATE SKIP LOCKED с lease
+(claimed_until), поэтому несколько копий бота не отправят одно сообщение дважды, а соединение
+с БД не держится, пока идёт отправка. Триггерные сообщения ПХ разборщик не трогает (чат в
+JIVO создаётся, только когда юзер ответил), а записи старше 2 недель деактивирует.
+"""
+import asyncio
+from collections import deque
+from os import getenv
+
+import apps.logger as logger
+import apps.funcs as funcs
+import apps.user_profiles as user_profiles
+from apps import resilience
+from apps.bot_info import bot_info
+from modules import acquire
+
+# сколько пользователей одновременно пересылаем в JIVO
+JIVO_RELAY_CONCURRENCY = int(getenv('jivo_relay_concurrency', 10))
+# сколько секунд при остановке бота ждём, пока очереди дойдут
+JIVO_RELAY_SHUTDOWN_TIMEOUT = float(getenv('jivo_relay_shutdown_timeout', 30))
+# фоновый разбор jivo_integration_queue: интервал (сек), юзеров за проход, юзеров одновременно
+JIVO_DRAIN_INTERVAL = float(getenv('jivo_drain_interval', 30))
+JIVO_DRAIN_USERS = int(getenv('jivo_drain_users', 50))
+JIVO_DRAIN_CONCURRENCY = int(getenv('jivo_drain_concurrency', 4))
+
+# user_id -> очередь сообщений пользователя
+_queues = {}
+# user_id -> задача, которая разбирает очередь пользователя (завершается, когда очередь пуста)
+_workers = {}
+_semaphore = asyncio.Semaphore(JIVO_RELAY_CONCURRENCY)
+_drain_task = None
+
+
+def _attachments(message) -> list:
+    """Вложения сообщения: (тип для JIVO, file_id, имя файла)"""
+    attachments = []
+    if message.photo:
+        attachments.append(("photo", message.photo[-1].file_id, "photo.jpg"))
+    if message.video:
+        attachments.append(("video", message.video.file_id, message.video.file_name or "video.mp4"))
+    if message.document:
+        attachments.append(("document", message.document.file_id, message.document.file_name or "document"))
+    if message.voice:
+        attachments.append(("audio", message.voice.file_id, "voice.ogg"))
+    return attachments
+
+
+async def _resolve_file(bot, attachment) -> dict | None:
+    file_type, file_id, file_name = attachment
+    try:
+        file = await bot.get_file(file_id)
+    except Exception as error:
+        await logger.error(f"Не удалось получить путь вложения {file_type} ({file_id}): {error}")
+        return None
+    return {"file_type": file_type, "file_path": file.file_path, "file_name": file_name}
+
+
+def _sender(user_id, full_name, username=None) -> dict:
+    """Данные отправителя для JIVO"""
+    return {
+        "name": f"{full_name}",
+        "intent": f"Обращение из телеграм @{bot_info.get_username()}" + (f" https://t.me/{username}" if username else ""),
+        "invite": f"Для просмотра истории переписки с пользователем, можете посетить: https://telegram.pokerhub.pro/profile/{user_id}",
+        "photo": f"https://telegram.pokerhub.pro/api/static/img/avatars/avatar_{user_id}.jpg",
+    }
+
+
+def enqueue(bot, message) -> None:
+    """Ставит сообщение пользователя в очередь на пересылку в JIVO"""
+    user_id = message.from_user.id
+    attachments = _attachments(message)
+    # пути вложений запрашиваем сразу, не дожидаясь своей очереди
+    files = asyncio.gather(*(_resolve_file(bot, attachment) for attachment in attachments)) if attachments else None
+    _queues.setdefault(user_id, deque()).append({
+        "text": message.text,
+        "files": files,
+        "user_full_name": message.from_user.full_name,
+        "sender": _sender(user_id, message.from_user.full_name, message.from_user.username),
+    })
+    worker = _workers.get(user_id)
+    if worker is None or worker.done():
+        # без контекста апдейта: пересылка идёт уже после того, как апдейт обработан
+        _workers[user_id] = logger.create_background_task(_work(user_id))
+
+
+async def _work(user_id):
+    """Разбирает очередь пользователя по порядку"""
+    queue = _queues[user_id]
+    try:
+        while queue:
+            job = queue[0]
+            try:
+                async with _semaphore:
+                    await _relay(user_id, job)
+            except Exception as error:
+                await logger.error(f"Ошибка пересылки сообщения юзера {job['user_full_name']} ({user_id}) в JIVO: {error}")
+            queue.popleft()
+    finally:
+        if not queue:
+            _queues.pop(user_id, None)
+        if _workers.get(user_id) is asyncio.current_task():
+            del _workers[user_id]
+
+
+async def _relay(user_id, job):
+    user_full_name, sender, message_text = job["user_full_name"], job["sender"], job["text"]
+    attachments = [item for item in await job["files"] if item] if job["files"] else []
+
+    # Сначала отправляем накопленные сообщения из jivo_integration_queue
+    if not await replay_queue(user_id, sender):
+        # JIVO недоступен или очередь юзера досылает фоновый разборщик:
+        # откладываем и новое сообщение, чтобы не обогнать старые
+        await _spill(user_id, message_text, attachments)
+        await logger.info(f"JIVO недоступен, сообщение юзера {user_full_name} ({user_id}) отложено в jivo_integration_queue")
+        return
+
+    # Отправляем файлы, если они есть
+    for attachment in attachments:
+        result = await funcs.send_to_jivo(user_id=user_id, **attachment, **sender)
+        if not result:
+            await logger.error(f"Вложение от юзера {user_full_name} ({user_id}) не доставлено в JIVO!")
+        else:
+            await _save_file_history(user_id, attachment['file_type'], result)
+
+    # Затем текст сообщения
+    if message_text:
+        result = await funcs.send_to_jivo(text=message_text, user_id=user_id, **sender)
+        if not result:
+            await logger.error(f"Сообщение от юзера {user_full_name} ({user_id}) не доставлено в JIVO!")
+        else:
+            # Сохраняем сообщение в историю сообщений
+            await funcs.add_msg_to_history(content=message_text, chat_id=user_id, author_id=user_id)
+
+
+async def _spill(user_id, message_text, attachments):
+    """Откладывает сообщение в jivo_integration_queue (его дошлёт фоновый разборщик)"""
+    for attachment in attachments:
+        await funcs.add_msg_to_jivo_integration_queue(user_id=user_id, text=None, source="relay", **attachment)
+    if message_text:
+        await funcs.add_msg_to_jivo_integration_queue(user_id=user_id, text=message_text, source="relay")
+
+
+async def _save_file_history(user_id, file_type, result):
+    # Сохраняем вложение в историю сообщений
+    file_name = result.get('file_name', None)
+    original_file_name = result.get('original_file_name', None)
+    if file_name and original_file_name:
+        await funcs.add_msg_to_history(content=original_file_name,
+                                       name=file_name,
+                                       type=file_type,
+                                       chat_id=user_id,
+                                       author_id=user_id)
+    else:
+        await logger.error(f"Не удалось получить имя файла, сохраненного на сервере! result={result}")
+
+
+async def replay_queue(user_id, sender, sources=("ph", "relay")) -> bool:
+    """
+    Отправляет в JIVO сообщения юзера из jivo_integration_queue по порядку и деактивирует
+    отправленные. Соединение с БД во время отправки не держится: строки берутся в работу
+    коротким запросом (lease), а после отправки отпускаются вторым.
+    False - JIVO недоступен или часть очереди сейчас отправляет другой процесс
+    """
+    while True:
+        rows, busy = await funcs.claim_jivo_integration_queue(user_id, sources=sources)
+        if not rows:
+            return not busy
+        done = []
+        try:
+            for row in rows:
+                try:
+                    await _replay_row(user_id, row, sender)
+                except (resilience.CircuitOpenError, *resilience.RETRYABLE_ERRORS) as error:
+                    await logger.error(f"Очередь юзера {user_id} для JIVO не отправлена ({len(rows) - len(done)} сообщ.): {error}")
+                    return False
+                # отклонённое интегратором сообщение повторять бесполезно - тоже деактивируем
+                done.append(row['id'])
+        finally:
+            await funcs.release_jivo_integration_queue([row['id'] for row in rows], done)
+        if busy:
+            return False
+
+
+async def _replay_row(user_id, row, sender):
+    if row['file_path']:
+        result = await funcs.post_to_jivo(
+            user_id=user_id, file_type=row['file_type'], file_path=row['file_path'], file_name=row['file_name'], **sender
+        )
+        if result:
+            await _save_file_history(user_id, row['file_type'], result)
+    else:
+        # Добавляем \n\n\n в конец триггерных сообщений ПХ, чтобы визуально проще различать сообщения
+        text = row['text'] + '\n\n\n' if row['source'] == "ph" else row['text']
+        result = await funcs.post_to_jivo(text=text, user_id=user_id, **sender)
+        # отложенное сообщение юзера попадает в историю после доставки (сообщения ПХ сохранены при отправке)
+        if result and row['source'] == "relay":
+            await funcs.add_msg_to_history(content=row['text'], chat_id=user_id, author_id=user_id)
+    if not result:
+        await logger.error(f"Сообщение #{row['id']} из jivo_integration_queue юзера {user_id} не доставлено в JIVO!")
+
+
+async def drain_queue() -> int:
+    """Один проход фонового разбора jivo_integration_queue, возвращает число обработанных юзеров"""
+    expired = await funcs.expire_jivo_integration_queue()
+    if expired:
+        await logger.info(f"jivo_integration_queue: деактивировано устаревших сообщений - {expired}")
+    # юзеров, которые сейчас пишут боту, обслуживает их собственная очередь
+    user_ids = [user_id for user_id in await funcs.get_users_with_jivo_relay_queue(JIVO_DRAIN_USERS) if user_id not in _workers]
+    if not user_ids:
+        return 0
+
+    missing = [user_id for user_id in user_ids if user_profiles.cached(user_id) is None]
+    if missing:
+        async with acquire() as db:
+            await user_profiles.load_profiles(db, missing)
+    semaphore = asyncio.Semaphore(JIVO_DRAIN_CONCURRENCY)
+
+    async def drain_user(user_id):
+        profile = user_profiles.cached(user_id) or user_profiles.DEFAULT_PROFILE
+        full_name = " ".join(part for part in (profile['first_name'], profile['last_name']) if part)
+        async with semaphore:
+            try:
+                return await replay_queue(user_id, _sender(user_id, full_name, profile['username']), sources=("relay",))
+            except Exception as error:
+                await logger.error(f"Ошибка разбора jivo_integration_queue юзера {user_id}: {error}")
+                return False
+
+    await asyncio.gather(*(drain_user(user_id) for user_id in user_ids))
+    return len(user_ids)
+
+
+async def _drainer(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await drain_queue()
+        except Exception as error:
+            await logger.error(f"Ошибка фонового разбора jivo_integration_queue: {error}")
+
+
+def start_queue_drainer(interval: float | None = None):
+    """Запускает фоновый разбор jivo_integration_queue (вызывать из bot.main)"""
+    global _drain_task
+    interval = JIVO_DRAIN_INTERVAL if interval is None else interval
+    if interval > 0 and _drain_task is None:
+        _drain_task = logger.create_background_task(_drainer(interval))
+
+
+def stop_queue_drainer():
+    global _drain_task
+    if _drain_task is not None:
+        _drain_task.cancel()
+        _drain_task = None
+
+
+def pending() -> int:
+    """Сколько сообщений ждут пересылки"""
+    return sum(len(queue) for queue in _queues.values())
+
+
+async def close():
+    """
+    Ждёт, пока очереди дойдут (не дольше JIVO_RELAY_SHUTDOWN_TIMEOUT), затем останавливает
+    обработчики и откладывает оставшиеся сообщения в jivo_integration_queue (вызывать до закрытия пула БД)
+    """
+    workers = [worker for worker in _workers.values() if not worker.done()]
+    if workers:
+        _, running = await asyncio.wait(workers, timeout=JIVO_RELAY_SHUTDOWN_TIMEOUT)
+        for worker in running:
+            worker.cancel()
+        # отменённый обработчик отпускает взятые строки очереди (release в finally replay_queue)
+        await asyncio.gather(*running, return_exceptions=True)
+    spilled = lost = 0
+    for user_id, queue in list(_queues.items()):
+        while queue:
+            job = queue.popleft()
+            try:
+                attachments = [item for item in await job["files"] if item] if job["files"] else []
+                await _spill(user_id, job["text"], attachments)
+                spilled += 1
+            except (Exception, asyncio.CancelledError) as error:
+                lost += 1
+                await logger.error(f"При остановке не удалось отложить сообщение юзера {job['user_full_name']} ({user_id}) для JIVO: {error!r}")
+        _queues.pop(user_id, None)
+    if spilled:
+        await logger.info(f"При остановке отложено в jivo_integration_queue: {spilled} сообщений")
+    if lost:
+        await logger.error(f"При остановке не переслано в JIVO: {lost} сообщений")
@@ -1,61 +1,225 @@
-import inspect
-# 
+import asyncio
+import json
+import sys
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import Context, ContextVar
 from datetime import datetime
-from functools import wraps
-# 
+from os import getenv
+from time import monotonic, time
+#
+from aiohttp import TraceConfig
 from colorama import Fore, Style, init
-import aioconsole
 
 
 
 # Инициализация colorama
 init(autoreset=True)
 
+# уровни логирования: всё, что ниже LOG_LEVEL, отбрасывается до форматирования
+DEBUG, INFO, ERROR = 10, 20, 40
+_LEVEL_NAMES = {"DEBUG": DEBUG, "INFO": INFO, "ERROR": ERROR}
+LOG_LEVEL = _LEVEL_NAMES.get(getenv("log_level", "DEBUG").upper(), DEBUG)
+# дополнительно писать логи в файл (без цветов)
+LOG_FILE = getenv("log_file")
+# формат вывода: text (цветной текст) или json (по строке JSON на запись, для сбора метрик)
+LOG_FORMAT = getenv("log_format", "text").lower()
+# сколько записей пишем за раз и сколько максимум держим в очереди
+LOG_BATCH_SIZE = 500
+LOG_QUEUE_LIMIT = 10000
 
+_STYLES = {
+    DEBUG: (Fore.CYAN, "[DEBUG]"),
+    INFO: (Fore.GREEN, "[INFO ]"),
+    ERROR: (Fore.RED, "[ERROR]"),
+}
 
-# Декоратор для автоматического добавления имени модуля и функции
-def log_with_context(log_func):
-    @wraps(log_func)
-    async def wrapper(text, *args, **kwargs):
-        frame = inspect.currentframe().f_back  # Берём предыдущий стек вызова
-        module_name = inspect.getmodule(frame).__name__  # Получаем имя модуля
-        function_name = frame.f_code.co_name  # Получаем имя функции
-        
-        # Формируем сообщение с модулем и функцией
-        log_text = f"[{module_name}.{function_name}] {text}"
-        await log_func(log_text, *args, **kwargs)  # Передаём дальше в логгер
-    return wrapper
-
-
-# Асинхронные функции логирования
-@log_with_context
-async def debug(text):
-    await aioconsole.aprint(
-        Style.BRIGHT + datetime.now().strftime("%d-%m-%Y : %H:%M:%S"),
-        ">",
-        Fore.CYAN + "[DEBUG]",
-        ">",
-        Style.BRIGHT + Fore.CYAN + text
-    )
+# контекст текущего апдейта/уведомления: user_id, update_type и накопленное время БД/HTTP
+_log_context = ContextVar("log_context", default=None)
 
+# очередь записей и фоновая задача, которая их выводит
+_queue = deque()
+_dropped = 0
+_wakeup = None
+_writer_task = None
+_writer_loop = None
+# очередь разбирает кто-то один (фоновая задача или flush), чтобы пачки выводились по порядку
+_drain_lock = None
+_drain_loop = None
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Привязывает поля (user_id, update_type...) ко всем записям внутри блока и
+    собирает время, потраченное на БД/HTTP (add_timing). Отдаёт словарь контекста
+    """
+    context = {"fields": fields, "timings": defaultdict(float)}
+    token = _log_context.set(context)
+    try:
+        yield context
+    finally:
+        _log_context.reset(token)
+
+
+def create_background_task(coro, loop=None):
+    """
+    Запускает фоновую задачу с пустым контекстом. Задача, созданная обычным create_task
+    внутри обработки апдейта, наследует его log_context, и её записи и время БД/HTTP
+    приписываются этому апдейту (а после его завершения - уже никуда не выводятся)
+    """
+    loop = loop or asyncio.get_running_loop()
+    return Context().run(loop.create_task, coro)
+
+
+def add_timing(kind, seconds):
+    """Добавляет время (в секундах) к счётчику kind текущего контекста (db, http, telegram)"""
+    context = _log_context.get()
+    if context is not None:
+        context["timings"][kind] += seconds
+
+
+def timings_ms(context):
+    """Счётчики времени контекста в миллисекундах: {"db_ms": ..., "http_ms": ...}"""
+    return {f"{kind}_ms": round(seconds * 1000, 1) for kind, seconds in context["timings"].items()}
 
-@log_with_context
-async def info(text):
-    await aioconsole.aprint(
-        Style.BRIGHT + datetime.now().strftime("%d-%m-%Y : %H:%M:%S"),
-        ">",
-        Fore.GREEN + "[INFO ]",
-        ">",
-        Style.BRIGHT + Fore.GREEN + text
-    )
 
+async def _on_request_start(session, trace_config_ctx, params):
+    trace_config_ctx.started = monotonic()
 
-@log_with_context
-async def error(text):
-    await aioconsole.aprint(
-        Style.BRIGHT + datetime.now().strftime("%d-%m-%Y : %H:%M:%S"),
-        ">",
-        Fore.RED + "[ERROR]",
-        ">",
-        Style.BRIGHT + Fore.RED + text
+
+async def _on_request_end(session, trace_config_ctx, params):
+    add_timing("http", monotonic() - trace_config_ctx.started)
+
+
+def http_trace_config():
+    """TraceConfig для aiohttp.ClientSession: время HTTP-запросов попадает в контекст лога"""
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_end)
+    return trace_config
+
+
+def _enqueue(level, text, frame, module=None, fields=None):
+    """Кладёт запись в очередь. Имя модуля и функции берём из кадра вызывающего (без inspect.getmodule)"""
+    global _dropped
+    context = _log_context.get()
+    if context is not None:
+        fields = {**context["fields"], **fields} if fields else context["fields"]
+    record = (
+        time(),
+        level,
+        module or frame.f_globals.get("__name__", "?"),
+        frame.f_code.co_name,
+        text,
+        fields,
     )
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # вне event loop (импорт, скрипты) - пишем сразу
+        _write_batch([record])
+        return
+
+    if len(_queue) >= LOG_QUEUE_LIMIT:
+        _queue.popleft()
+        _dropped += 1
+    _queue.append(record)
+    _ensure_writer(loop)
+    _wakeup.set()
+
+
+def _ensure_writer(loop):
+    global _wakeup, _writer_task, _writer_loop
+    if _writer_loop is loop and _writer_task is not None and not _writer_task.done():
+        return
+    _writer_loop = loop
+    _wakeup = asyncio.Event()
+    _writer_task = create_background_task(_writer(), loop)
+
+
+async def _writer():
+    while True:
+        await _wakeup.wait()
+        _wakeup.clear()
+        await _drain()
+
+
+def _get_drain_lock(loop):
+    global _drain_lock, _drain_loop
+    # asyncio.Lock привязывается к своему event loop - на новом loop создаём новую
+    if _drain_loop is not loop:
+        _drain_loop = loop
+        _drain_lock = asyncio.Lock()
+    return _drain_lock
+
+
+async def _drain():
+    global _dropped
+    async with _get_drain_lock(asyncio.get_running_loop()):
+        while _queue:
+            batch = [_queue.popleft() for _ in range(min(len(_queue), LOG_BATCH_SIZE))]
+            if _dropped:
+                batch.append((time(), ERROR, __name__, "_drain", f"Очередь логов переполнена, потеряно записей: {_dropped}", None))
+                _dropped = 0
+            # вывод в консоль/файл не блокирует event loop
+            await asyncio.to_thread(_write_batch, batch)
+
+
+def _format_json(record):
+    timestamp, level, module, function, text, fields = record
+    return json.dumps({
+        "timestamp": datetime.fromtimestamp(timestamp).isoformat(timespec="milliseconds"),
+        "level": _STYLES[level][1].strip("[ ]"),
+        "module": module,
+        "function": function,
+        "message": text,
+        **(fields or {}),
+    }, ensure_ascii=False, default=str)
+
+
+def _format(record, colored=True):
+    if LOG_FORMAT == "json":
+        return _format_json(record)
+    timestamp, level, module, function, text, fields = record
+    color, name = _STYLES[level]
+    moment = datetime.fromtimestamp(timestamp).strftime("%d-%m-%Y : %H:%M:%S")
+    message = f"[{module}.{function}] {text}"
+    if fields:
+        message += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+    if not colored:
+        return f"{moment} > {name} > {message}"
+    return f"{Style.BRIGHT + moment} > {color + name} > {Style.BRIGHT + color + message}{Style.RESET_ALL}"
+
+
+def _write_batch(batch):
+    try:
+        sys.stdout.write("".join(_format(record) + "\n" for record in batch))
+        sys.stdout.flush()
+        if LOG_FILE:
+            with open(LOG_FILE, "a", encoding="utf-8") as file:
+                file.write("".join(_format(record, colored=False) + "\n" for record in batch))
+    except Exception as error:
+        sys.stderr.write(f"Не удалось записать логи: {error}\n")
+
+
+async def flush():
+    """Дописывает всё, что осталось в очереди (вызывать перед остановкой бота)"""
+    await _drain()
+
+
+# Асинхронные функции логирования (fields - дополнительные поля записи, например duration_ms)
+async def debug(text, module=None, **fields):
+    if LOG_LEVEL <= DEBUG:
+        _enqueue(DEBUG, text, sys._getframe(1), module, fields)
+
+
+async def info(text, module=None, **fields):
+    if LOG_LEVEL <= INFO:
+        _enqueue(INFO, text, sys._getframe(1), module, fields)
+
+
+async def error(text, module=None, **fields):
+    if LOG_LEVEL <= ERROR:
+        _enqueue(ERROR, text, sys._getframe(1), module, fields)
@@ -22,17 +22,7 @@ from modules import (
     set_user_funnel,
 )
 from modules import message_manager
-
-
-def _extract_next_route(action_data):
-    """Возвращает целевой маршрут из action(s), если он указан."""
-    if isinstance(action_data, dict):
-        return action_data.get("is_ok")
-    if isinstance(action_data, list):
-        for action in reversed(action_data):
-            if isinstance(action, dict) and action.get("is_ok"):
-                return action["is_ok"]
-    return None
+from apps.funnel_compiler import node_actions
 
 
 router = Router()
@@ -70,7 +60,6 @@ async def start(bot, message, persona, msg, funnel_name: str = DEFAULT_FUNNEL):
 
     route = "start"
     user_id = message.from_user.id
-    await touch_user_activity(user_id)
 
     current_map = funnel_map["start"] if not msg else funnel_map["callback"]
 
@@ -78,28 +67,22 @@ async def start(bot, message, persona, msg, funnel_name: str = DEFAULT_FUNNEL):
     msg_data = current_map.get(msg or persona)
 
     if msg_data:
-        # выполняем actions / action
+        # выполняем actions / action (список и маршрут is_ok посчитаны при загрузке воронки)
         result = False
-        act = msg_data.get("action") or msg_data.get("actions")
-
-        if act:
-            if isinstance(act, list):
-                for action in act:
-                    result = await run_action(
-                        action=action, user_id=user_id, bot=bot
-                    )
-            elif isinstance(act, dict):
+        actions, next_route = node_actions(msg_data)
+
+        if actions is None:
+            await logger.error(
+                f"action(s) must be list/dict, got {type(msg_data.get('action') or msg_data.get('actions'))}"
+            )
+        else:
+            for action in actions:
                 result = await run_action(
-                    action=act, user_id=user_id, bot=bot
-                )
-            else:
-                await logger.error(
-                    f"action(s) must be list/dict, got {type(act)}"
+                    action=action, user_id=user_id, bot=bot
                 )
 
         # если действие выполнено положительно
         if result:
-            next_route = _extract_next_route(act)
             if next_route:
                 route = next_route
                 msg_data = funnel_map["callback"].get(route)
@@ -187,26 +170,20 @@ async def handle_persona_callback(call, state, bot):
     prev = callback_data
     result = False
 
-    act = msg_data.get("action") or msg_data.get("actions")
+    actions, next_route = node_actions(msg_data)
 
-    if act:
-        if isinstance(act, list):
-            for action in act:
-                result = await run_action(
-                    action=action, user_id=user_id, bot=bot
-                )
-        elif isinstance(act, dict):
+    if actions is None:
+        await logger.error(
+            f"action(s) must be list/dict, got {type(msg_data.get('action') or msg_data.get('actions'))}"
+        )
+    else:
+        for action in actions:
             result = await run_action(
-                action=act, user_id=user_id, bot=bot
-            )
-        else:
-            await logger.error(
-                f"action(s) must be list/dict, got {type(act)}"
+                action=action, user_id=user_id, bot=bot
             )
 
     # если действие успешно — подменяем маршрут
     if result:
-        next_route = _extract_next_route(act)
         if next_route:
             prev = next_route
             msg_data = funnel_map["callback"].get(next_route)
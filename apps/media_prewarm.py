@@ -0,0 +1,162 @@
+"""
+Предзагрузка медиа воронок в Telegram.
+
+Проходит по всем воронкам (modules.FUNNELS и map.json), собирает file/files,
+один раз загружает каждый файл в служебный чат и сохраняет file_id в uploaded_files.
+funcs.send_message подписывает файлы персоной (f"{persona}_{file_path}"), поэтому
+file_id сохраняется под меткой каждой персоны из funnel_map["start"].
+После этого пользователям медиа уходят только по file_id, без загрузки файла.
+
+Запуск вручную:  python -m apps.media_prewarm
+При старте бота запускается сам, если задана переменная media_prewarm_chat.
+"""
+import asyncio
+from collections.abc import Mapping
+from json import loads
+from os import getenv
+from os.path import exists
+
+from aiogram.types import FSInputFile
+
+import modules
+import apps.logger as logger
+import apps.file_id_uploader as file_uploader
+
+# служебный чат, куда загружаем файлы (бот должен иметь право писать туда)
+MEDIA_PREWARM_CHAT = getenv('media_prewarm_chat')
+# сколько файлов загружаем одновременно
+MEDIA_PREWARM_CONCURRENCY = int(getenv('media_prewarm_concurrency', 4))
+# persona, с которой funcs.send_message отправляет файлы по умолчанию
+DEFAULT_PERSONA = "default"
+
+
+def _funnel_maps():
+    """Все карты воронок: загруженные в modules.FUNNELS и map.json (если его там нет)"""
+    maps = list(modules.FUNNELS.values())
+    if "default" not in modules.FUNNELS and modules.FALLBACK_MAP_PATH.exists():
+        maps.append(loads(modules.FALLBACK_MAP_PATH.read_text(encoding="utf-8")))
+    return maps
+
+
+def _walk_files(node):
+    """Находит во вложенной структуре воронки все описания файлов (file и files)"""
+    if isinstance(node, Mapping):
+        if isinstance(file := node.get("file"), dict) and file.get("file_path"):
+            yield file
+        if isinstance(files := node.get("files"), list):
+            yield from (item for item in files if isinstance(item, dict) and item.get("file_path"))
+        for value in node.values():
+            if isinstance(value, (Mapping, list)):
+                yield from _walk_files(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _walk_files(item)
+
+
+def collect_media(maps=None) -> dict:
+    """Собирает уникальные файлы воронок: {(file_path, content_type): описание файла}"""
+    media = {}
+    for funnel_map in maps if maps is not None else _funnel_maps():
+        for file in _walk_files(funnel_map):
+            key = (file["file_path"], file.get("content_type", "document"))
+            media.setdefault(key, file)
+    return media
+
+
+def collect_personas(maps=None) -> list:
+    """Персоны стартовых сообщений (ключи funnel_map["start"]) и persona по умолчанию"""
+    personas = {DEFAULT_PERSONA}
+    for funnel_map in maps if maps is not None else _funnel_maps():
+        if isinstance(start := funnel_map.get("start"), Mapping):
+            personas.update(start)
+    return sorted(personas)
+
+
+def _is_actual(row, content_type: str, file_hash: str) -> bool:
+    return bool(row and row.get("file_id") and row.get("content_type") == content_type and row.get("hash") == file_hash)
+
+
+async def _upload(bot, chat_id, file: dict, content_type: str, personas) -> bool:
+    file_path = file["file_path"]
+    if not exists(file_path):
+        await logger.error(f"Предзагрузка: файл {file_path} не существует")
+        return False
+    file_hash = await file_uploader.get_file_hash(filepath=file_path)
+    rows = {persona: await file_uploader.get_file_id(label=f"{persona}_{file_path}") for persona in personas}
+    missing = [persona for persona, row in rows.items() if not _is_actual(row, content_type, file_hash)]
+    if not missing:
+        return True
+    # file_id одного бота подходит для любой метки: загружаем файл, только если его нет ни под одной
+    actual = [row["file_id"] for row in rows.values() if _is_actual(row, content_type, file_hash)]
+    file_id = actual[0] if actual else await _send(bot, chat_id, file, content_type)
+    if not file_id:
+        return False
+    for persona in missing:
+        await file_uploader.save_file_id(label=f"{persona}_{file_path}", file_id=file_id, content_type=content_type, file_hash=file_hash)
+    return True
+
+
+async def _send(bot, chat_id, file: dict, content_type: str) -> str | None:
+    """Загружает файл в служебный чат и возвращает его file_id"""
+    file_path = file["file_path"]
+    thumbnail_path = file.get("thumbnail")
+    thumbnail = FSInputFile(thumbnail_path) if thumbnail_path and exists(thumbnail_path) else None
+    message_id, answer = await file_uploader.send_and_save_file(
+        bot=bot,
+        chat_id=chat_id,
+        file=FSInputFile(file_path, filename=file.get("tg_filename")),
+        content_type=content_type,
+        text=None,
+        thumbnail=thumbnail,
+        reply_markup=None,
+    )
+    if not message_id:
+        await logger.error(f"Предзагрузка: не удалось загрузить {file_path}: {answer}")
+        return None
+    try:
+        await bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except Exception:
+        pass
+    return answer
+
+
+async def prewarm_media(bot=None, chat_id=None) -> dict:
+    """Загружает в служебный чат все файлы воронок, у которых ещё нет актуального file_id"""
+    bot = bot or modules.bot
+    chat_id = chat_id or MEDIA_PREWARM_CHAT
+    if not chat_id:
+        await logger.info("Предзагрузка медиа пропущена: не задан media_prewarm_chat")
+        return {}
+
+    maps = _funnel_maps()
+    media = collect_media(maps)
+    personas = collect_personas(maps)
+    semaphore = asyncio.Semaphore(MEDIA_PREWARM_CONCURRENCY)
+
+    async def worker(file, content_type):
+        async with semaphore:
+            try:
+                return await _upload(bot, chat_id, file, content_type, personas)
+            except Exception as error:
+                await logger.error(f"Предзагрузка: ошибка для {file['file_path']}: {error}")
+                return False
+
+    results = await asyncio.gather(*(worker(file, content_type) for (_, content_type), file in media.items()))
+    stats = {"total": len(results), "ok": sum(results), "failed": len(results) - sum(results)}
+    await logger.info(f"Предзагрузка медиа завершена: {stats}")
+    return stats
+
+
+async def _main():
+    await modules.init_db_pool()
+    try:
+        await file_uploader.load_uploaded_files()
+        await prewarm_media()
+    finally:
+        await modules.close_db_pool()
+        await modules.bot.session.close()
+        await logger.flush()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,68 @@
+"""
+Middleware для диспетчера бота
+"""
+from time import monotonic
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from modules import bind_connection, release_bound_connection
+import apps.logger as logger
+import apps.user_profiles as user_profiles
+
+
+class DBConnectionMiddleware(BaseMiddleware):
+    """
+    Один апдейт - одно соединение с БД. Все хелперы (send_message, notificator,
+    close_old_notifications...) внутри обработки апдейта получают через acquire()
+    одно и то же соединение вместо того, чтобы каждый раз брать новое.
+    На время запросов к Telegram и внешним HTTP-сервисам соединение возвращается в пул
+    """
+
+    async def __call__(self, handler, event, data):
+        async with bind_connection():
+            return await handler(event, data)
+
+
+class UserProfileMiddleware(BaseMiddleware):
+    """Запоминает профиль отправителя апдейта, чтобы send_message не вызывал bot.get_chat"""
+
+    async def __call__(self, handler, event, data):
+        if user := data.get("event_from_user"):
+            user_profiles.remember_user(user)
+        return await handler(event, data)
+
+
+class LoggingMiddleware(BaseMiddleware):
+    """
+    Пишет в лог время обработки апдейта: duration_ms (всего), db_ms (работа с БД, включая ожидание соединения),
+    http_ms (внешние API), telegram_ms (запросы к Telegram). Все записи лога внутри
+    обработки получают user_id и update_type (удобно в формате log_format=json)
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        started = monotonic()
+        with logger.log_context(user_id=user.id if user else None, update_type=event.event_type) as context:
+            try:
+                return await handler(event, data)
+            finally:
+                await logger.info(
+                    "Апдейт обработан",
+                    module=__name__,
+                    duration_ms=round((monotonic() - started) * 1000, 1),
+                    **logger.timings_ms(context),
+                )
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Считает время запросов к Telegram API в контекст лога (telegram_ms)"""
+
+    async def __call__(self, make_request, bot, method):
+        # пока ждём Telegram, соединение апдейта с БД не нужно - возвращаем его в пул
+        await release_bound_connection()
+        started = monotonic()
+        try:
+            return await make_request(bot, method)
+        finally:
+            logger.add_timing("telegram", monotonic() - started)
@@ -2,29 +2,22 @@
 Умный модуль отложенных уведомлений с контролем активности пользователей
 """
 import asyncio
+import heapq
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from os import getenv
 from datetime import datetime, timedelta
 from typing import Dict, Tuple
-from aiohttp import ClientSession
 
-from modules import DEFAULT_FUNNEL, MAX_CHARS_USERS_HISTORY, create_connect, get_funnel
+from modules import DEFAULT_FUNNEL, MAX_CHARS_USERS_HISTORY, NOTIFY_CONCURRENCY, acquire, get_funnel
 import apps.logger as logger
+import apps.user_profiles as user_profiles
+import apps.write_behind as write_behind
+import apps.http_clients as http_clients
 from apps.funcs import send_message, run_action, save_event
 from modules import bot
 from apps.bot_info import bot_info
-
-
-def _extract_next_route(action_data):
-    """Возвращает маршрут из action(s), если он указан."""
-    if isinstance(action_data, dict):
-        return action_data.get('is_ok')
-    if isinstance(action_data, list):
-        for action in reversed(action_data):
-            if isinstance(action, dict) and action.get('is_ok'):
-                return action['is_ok']
-    return None
+from apps.funnel_compiler import node_actions
 
 
 # Настройки Discord
@@ -39,67 +32,194 @@ headers = {
 class SmartNotifier:
     def __init__(self):
         self.bot = bot
-        self._notification_funnels: Dict[Tuple[int, str], str] = {}
+        # воронка уведомления хранится в notifications.funnel_name, здесь только горячий кэш
+        # для строк, созданных до миграции (ограничен по размеру, старые записи вытесняются)
+        self.FUNNEL_CACHE_LIMIT = 10000
+        self._notification_funnels: OrderedDict[Tuple[int, str], str] = OrderedDict()
 
         # Настройки активности
         self.INACTIVITY_THRESHOLD_DAYS = 45  # 1.5 месяца
         self.MAX_NOTIFICATION_PERIOD_DAYS = 60  # 2 месяца максимум для рассылки
+        self.IGNORED_INACTIVITY_DAYS = 14  # 2 недели без реакции на 10+ уведомлений
 
         # Кэш для паузы уведомлений
         self._paused_notifications = defaultdict(dict)
 
+        # Настройки планировщика
+        self.CLAIM_BATCH_SIZE = 100  # сколько уведомлений забираем из БД за раз
+        self.CLAIM_LEASE_SECONDS = 300  # на сколько откладываем забранное уведомление, пока оно отправляется
+        self.RESYNC_INTERVAL_SECONDS = 60  # как часто сверяем расписание с БД (уведомления от других процессов)
+
+        # min-куча ближайших time_to_send (только до следующей сверки с БД)
+        # и событие для пробуждения цикла
+        self._due_times: list[int] = []
+        self._wakeup = asyncio.Event()
+        self._next_resync = 0
+
     async def main(self):
         """Основной цикл обработки уведомлений"""
         await logger.info("Умный модуль отложенных уведомлений запущен!")
         while True:
             try:
-                notifications = await self.load_notifications()
-                for notification in notifications:
-                    # Проверяем активность перед отправкой
-                    if await self.check_user_activity(notification['user_id']):
-                        await self.send_notification(notification)
-                    else:
-                        await self.pause_user_notifications(notification['user_id'])
-                await asyncio.sleep(0.5)
+                if time.time() >= self._next_resync:
+                    self._next_resync = time.time() + self.RESYNC_INTERVAL_SECONDS
+                    await self.sync_schedule()
+                # спим до ближайшего уведомления (или пока не добавят более раннее)
+                await self._wait_next_due(deadline=self._next_resync)
+                if await self.dispatch_due():
+                    # следующее по времени уведомление могло быть не в куче
+                    await self.sync_schedule()
             except Exception as error:
                 await logger.error(f"Ошибка в рассыльщике: {error}")
+                await asyncio.sleep(1)
+
+    def schedule(self, send_time: int):
+        """Сообщает циклу рассылки о новом времени отправки"""
+        send_time = int(send_time)
+        # более поздние уведомления найдёт очередная сверка с БД
+        if send_time >= self._next_resync:
+            return
+        wake = not self._due_times or send_time < self._due_times[0]
+        heapq.heappush(self._due_times, send_time)
+        if wake:
+            self._wakeup.set()
+
+    async def _wait_next_due(self, deadline: float):
+        wake_at = min(self._due_times[0], deadline) if self._due_times else deadline
+        timeout = wake_at - time.time()
+        if timeout <= 0:
+            return
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def sync_schedule(self):
+        """Подтягивает из БД ближайшее время отправки (индекс по is_active, time_to_send)"""
+        async with acquire() as db:
+            row = await db.fetchrow("""
+                SELECT n.time_to_send
+                FROM notifications n
+                LEFT JOIN users u ON u.id = n.user_id
+                WHERE n.is_active = TRUE
+                AND COALESCE(u.user_block, FALSE) = FALSE
+                AND COALESCE(n.pause_reason, '') != 'inactivity'
+                AND NOT EXISTS (
+                    SELECT 1 FROM funnel_passed fp
+                    WHERE fp.user_id = n.user_id
+                    AND fp.funnel_name = 'default' AND fp.passed = TRUE
+                )
+                ORDER BY n.time_to_send
+                LIMIT 1
+            """)
+        if row:
+            self.schedule(row['time_to_send'])
+
+    async def dispatch_due(self) -> bool:
+        """Забирает и отправляет все наступившие уведомления. Возвращает True, если что-то наступило"""
+        now = int(time.time())
+        if not self._due_times or self._due_times[0] > now:
+            return False
+        while self._due_times and self._due_times[0] <= now:
+            heapq.heappop(self._due_times)
+
+        # вердикты активности на весь цикл: каждого пользователя проверяем один раз
+        activity = {}
+        while True:
+            notifications = await self.load_notifications(now=now)
+            unchecked = {n['user_id'] for n in notifications} - activity.keys()
+            if unchecked:
+                activity.update(await self.check_users_activity(unchecked))
+                await self._load_user_profiles(unchecked)
+            await self.process_notifications(notifications, activity)
+            if len(notifications) < self.CLAIM_BATCH_SIZE:
+                return True
+
+    async def _load_user_profiles(self, user_ids):
+        """Имена пользователей для плейсхолдеров одним запросом (вместо bot.get_chat на каждое уведомление)"""
+        missing = [user_id for user_id in user_ids if user_profiles.cached(user_id) is None]
+        if missing:
+            async with acquire() as db:
+                await user_profiles.load_profiles(db, missing)
+
+    async def process_notifications(self, notifications: list, activity: Dict[int, bool] | None = None):
+        """
+        Отправляет пачку уведомлений параллельно (не больше NOTIFY_CONCURRENCY пользователей
+        одновременно). Уведомления одного пользователя идут по порядку в одной задаче.
+        Частоту отправки ограничивает apps/rate_limiter.py на уровне сессии бота
+        """
+        by_user = defaultdict(list)
+        for notification in notifications:
+            by_user[notification['user_id']].append(notification)
+
+        semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+        async def worker(user_id, user_notifications):
+            async with semaphore:
+                try:
+                    # Проверяем активность перед отправкой
+                    is_active = activity.get(user_id) if activity is not None else None
+                    if is_active is None:
+                        is_active = await self.check_user_activity(user_id)
+                    if not is_active:
+                        await self.pause_user_notifications(user_id)
+                        return
+                    for notification in user_notifications:
+                        with logger.log_context(user_id=user_id, update_type="notification") as context:
+                            started = time.monotonic()
+                            await self.send_notification(notification)
+                            await logger.info(
+                                f"Уведомление {notification.get('label')} обработано",
+                                duration_ms=round((time.monotonic() - started) * 1000, 1),
+                                **logger.timings_ms(context),
+                            )
+                except Exception as error:
+                    await logger.error(f"Ошибка рассылки пользователю {user_id}: {error}")
+
+        await asyncio.gather(*(worker(user_id, items) for user_id, items in by_user.items()))
 
     async def check_user_activity(self, user_id: int) -> bool:
         """
         Проверяет активность пользователя
         Возвращает True если пользователь активен, False если нужно остановить рассылку
         """
-        db = await create_connect()
-
-        # Получаем данные об активности
-        activity = await db.fetchrow("""
-            SELECT
-                -- Последняя активность (из last_activity или истории)
-                COALESCE(
-                    u.last_activity,
-                    (SELECT MAX(timestamp) FROM user_history WHERE user_id = $1)
-                ) as last_activity,
-                -- Последний запуск бота
-                (SELECT MAX(timestamp) FROM user_history
-                 WHERE user_id = $1 AND text LIKE '%запустил бота%') as last_start,
-                -- Первое уведомление в текущей серии
-                (SELECT MIN(created_at) FROM notifications
-                 WHERE user_id = $1 AND is_active = true) as first_notification,
-                -- Количество отправленных уведомлений за последние 2 месяца
-                (SELECT COUNT(*) FROM user_history
-                 WHERE user_id = $1
-                 AND text LIKE 'Получил уведомление%'
-                 AND timestamp > NOW() - INTERVAL '2 months') as notifications_sent
-            FROM users u
-            WHERE u.id = $1
-        """, user_id)
-
-        await db.close()
+        verdicts = await self.check_users_activity([user_id])
+        return verdicts.get(user_id, True)
 
-        if not activity:
-            return True  # Новый пользователь - отправляем
-
-        now = datetime.now()
+    async def check_users_activity(self, user_ids) -> Dict[int, bool]:
+        """
+        Проверяет активность сразу для набора пользователей одним запросом.
+        Возвращает {user_id: True/False}; пользователей без статистики считаем новыми (активными)
+        """
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return {}
+
+        async with acquire() as db:
+            # Получаем данные об активности (user_activity_stats, поиск по первичному ключу)
+            rows = await db.fetch("""
+                SELECT
+                    s.user_id,
+                    s.last_activity,
+                    -- Первое уведомление в текущей серии
+                    s.first_active_notification AS first_notification,
+                    -- Количество отправленных уведомлений за последние 2 месяца
+                    (SELECT COUNT(*) FROM unnest(s.notifications_sent_at) AS sent_at
+                     WHERE sent_at > timezone('UTC', now()) - INTERVAL '2 months') AS notifications_sent
+                FROM user_activity_stats s
+                WHERE s.user_id = ANY($1::bigint[])
+            """, user_ids)
+
+        # user_activity_stats хранит время в UTC (activity_tracker, timezone('UTC', now()))
+        now = datetime.utcnow()
+        verdicts = {user_id: True for user_id in user_ids}  # Новый пользователь - отправляем
+        for activity in rows:
+            verdicts[activity['user_id']] = await self._activity_verdict(activity, now)
+        return verdicts
+
+    async def _activity_verdict(self, activity, now: datetime) -> bool:
+        user_id = activity['user_id']
 
         # 1. Проверяем последнюю активность
         if activity['last_activity']:
@@ -124,7 +244,7 @@ class SmartNotifier:
         if activity['notifications_sent'] and activity['notifications_sent'] > 10:
             if activity['last_activity']:
                 days_inactive = (now - activity['last_activity']).days
-                if days_inactive > 14:  # 2 недели
+                if days_inactive > self.IGNORED_INACTIVITY_DAYS:  # 2 недели
                     await logger.info(f"Пользователь {user_id} проигнорировал {activity['notifications_sent']} уведомлений")
                     return False
 
@@ -132,82 +252,101 @@ class SmartNotifier:
 
     async def pause_user_notifications(self, user_id: int):
         """Ставит уведомления пользователя на паузу"""
-        db = await create_connect()
-
-        # Деактивируем все активные уведомления
-        await db.execute("""
-            UPDATE notifications
-            SET is_active = false,
-                paused_at = NOW(),
-                pause_reason = 'inactivity'
-            WHERE user_id = $1 AND is_active = true
-        """, user_id)
+        async with acquire() as db:
+            # Деактивируем все активные уведомления
+            await db.execute("""
+                UPDATE notifications
+                SET is_active = false,
+                    paused_at = NOW(),
+                    pause_reason = 'inactivity'
+                WHERE user_id = $1 AND is_active = true
+            """, user_id)
+            # серия уведомлений закончилась
+            await db.execute("""
+                UPDATE user_activity_stats
+                SET first_active_notification = NULL
+                WHERE user_id = $1
+            """, user_id)
 
-        # Записываем в историю
-        await db.execute("""
-            INSERT INTO user_history (user_id, text)
-            VALUES ($1, $2)
-        """, user_id, "Уведомления приостановлены из-за неактивности")
+            # Записываем в историю
+            await db.execute("""
+                INSERT INTO user_history (user_id, text)
+                VALUES ($1, $2)
+            """, user_id, "Уведомления приостановлены из-за неактивности")
 
-        await db.close()
         await logger.info(f"Уведомления пользователя {user_id} поставлены на паузу")
 
+    def inactivity_boundary(self) -> timedelta:
+        """
+        Минимальный простой, после которого рассылку могли поставить на паузу (_activity_verdict).
+        Если юзер был активен позже, приостановленных из-за неактивности уведомлений у него нет
+        """
+        return timedelta(days=min(
+            self.INACTIVITY_THRESHOLD_DAYS,
+            self.MAX_NOTIFICATION_PERIOD_DAYS,
+            self.IGNORED_INACTIVITY_DAYS,
+        ))
+
     async def resume_user_notifications(self, user_id: int):
         """Возобновляет уведомления при активности пользователя"""
-        db = await create_connect()
-
-        # НОВОЕ: Проверяем, зарегистрирован ли пользователь
-        is_registered = await db.fetchrow("""
-            SELECT COUNT(*) as cnt FROM events
-            WHERE user_id = $1 AND event_type = 'course_registration'
-        """, user_id)
+        await write_behind.flush_user(user_id)
+        async with acquire() as db:
+            # НОВОЕ: Проверяем, зарегистрирован ли пользователь
+            is_registered = await db.fetchrow("""
+                SELECT COUNT(*) as cnt FROM events
+                WHERE user_id = $1 AND event_type = 'course_registration'
+            """, user_id)
+
+            # Проверяем приостановленные уведомления
+            paused = await db.fetch("""
+                SELECT id, label, time_to_send
+                FROM notifications
+                WHERE user_id = $1
+                AND is_active = false
+                AND pause_reason = 'inactivity'
+                AND paused_at > NOW() - INTERVAL '6 months'
+            """, user_id)
+
+            if paused:
+                now = int(time.time())
+
+                for notif in paused:
+                    # НОВОЕ: Пропускаем догревочные уведомления для зарегистрированных
+                    if notif['label'].startswith('warmup_') and is_registered and is_registered['cnt'] > 0:
+                        await logger.info(f"Пропускаем догревочное уведомление {notif['label']} для зарегистрированного пользователя {user_id}")
+                        continue
+
+                    new_time = now + 300  # Через 5 минут после активности
 
-        # Проверяем приостановленные уведомления
-        paused = await db.fetch("""
-            SELECT id, label, time_to_send
-            FROM notifications
-            WHERE user_id = $1
-            AND is_active = false
-            AND pause_reason = 'inactivity'
-            AND paused_at > NOW() - INTERVAL '6 months'
-        """, user_id)
-
-        if paused:
-            now = int(time.time())
-
-            for notif in paused:
-                # НОВОЕ: Пропускаем догревочные уведомления для зарегистрированных
-                if notif['label'].startswith('warmup_') and is_registered and is_registered['cnt'] > 0:
-                    await logger.info(f"Пропускаем догревочное уведомление {notif['label']} для зарегистрированного пользователя {user_id}")
-                    continue
-
-                new_time = now + 300  # Через 5 минут после активности
-
-                await db.execute("""
-                    UPDATE notifications
-                    SET is_active = true,
-                        time_to_send = $1,
-                        paused_at = NULL,
-                        pause_reason = NULL
-                    WHERE id = $2
-                """, new_time, notif['id'])
-
-            resumed_count = len([n for n in paused if not (n['label'].startswith('warmup_') and is_registered and is_registered['cnt'] > 0)])
+                    await db.execute("""
+                        UPDATE notifications
+                        SET is_active = true,
+                            time_to_send = $1,
+                            paused_at = NULL,
+                            pause_reason = NULL
+                        WHERE id = $2
+                    """, new_time, notif['id'])
+                    self.schedule(new_time)
 
-            if resumed_count > 0:
-                await logger.info(f"Возобновлены {resumed_count} уведомлений для пользователя {user_id}")
+                resumed_count = len([n for n in paused if not (n['label'].startswith('warmup_') and is_registered and is_registered['cnt'] > 0)])
 
-                await db.execute("""
-                    INSERT INTO user_history (user_id, text)
-                    VALUES ($1, $2)
-                """, user_id, "Уведомления возобновлены после активности")
+                if resumed_count > 0:
+                    await self._start_notification_series(db, user_id)
+                    await logger.info(f"Возобновлены {resumed_count} уведомлений для пользователя {user_id}")
 
-        await db.close()
+                    await db.execute("""
+                        INSERT INTO user_history (user_id, text)
+                        VALUES ($1, $2)
+                    """, user_id, "Уведомления возобновлены после активности")
 
     def _remember_notification_funnel(self, user_id: int, label: str, funnel_name: str | None):
         if not user_id or not label:
             return
-        self._notification_funnels[(user_id, label)] = (funnel_name or DEFAULT_FUNNEL).lower()
+        key = (user_id, label)
+        self._notification_funnels[key] = (funnel_name or DEFAULT_FUNNEL).lower()
+        self._notification_funnels.move_to_end(key)
+        while len(self._notification_funnels) > self.FUNNEL_CACHE_LIMIT:
+            self._notification_funnels.popitem(last=False)
 
     def _drop_notification_funnel(self, user_id: int | None, label: str | None):
         if not user_id or not label:
@@ -215,15 +354,16 @@ class SmartNotifier:
         self._notification_funnels.pop((user_id, label), None)
 
     def _resolve_notification_funnel(self, notification) -> str:
+        # воронка из строки уведомления - основной источник
+        if funnel_name := notification.get('funnel_name'):
+            return funnel_name.lower()
         user_id = notification.get('user_id')
         label = notification.get('label')
         cached = self._notification_funnels.get((user_id, label))
         if cached:
+            self._notification_funnels.move_to_end((user_id, label))
             return cached
-        fallback = notification.get('funnel_name') or DEFAULT_FUNNEL
-        if fallback != DEFAULT_FUNNEL:
-            self._remember_notification_funnel(user_id, label, fallback)
-        return fallback
+        return DEFAULT_FUNNEL
 
     async def add_notifications(self, user_id: int, notifications: list, funnel_name: str = DEFAULT_FUNNEL):
         """
@@ -235,109 +375,118 @@ class SmartNotifier:
         3. Незарегистрированные В воронке курса → получают обычные уведомления (без догрева)
         """
         funnel_name = (funnel_name or DEFAULT_FUNNEL).lower()
-        db = await create_connect()
-
-        # Проверяем статус пользователя
-        user_status = await db.fetchrow("""
-            SELECT
-                u.timestamp_registration,
-                -- Проверяем, зарегистрирован ли на курсе
-                (SELECT COUNT(*) FROM events
-                 WHERE user_id = $1
-                 AND event_type = 'course_registration') as is_registered,
-                -- Проверяем, в воронке ли пользователя курса
-                (SELECT COUNT(*) FROM user_funnel
-                 WHERE user_id = $1
-                 AND (label LIKE '%course%' OR label LIKE '%spin%'
-                      OR label LIKE '%mtt%' OR label LIKE '%cash%')) as in_course_funnel,
-                -- Последняя активность
-                COALESCE(
-                    u.last_activity,
-                    (SELECT MAX(timestamp) FROM user_history WHERE user_id = $1)
-                ) as last_activity
-            FROM users u
-            WHERE u.id = $1
-        """, user_id)
-
-        if user_status:
-            # ДОГРЕВОЧНЫЕ УВЕДОМЛЕНИЯ:
-            # Только если НЕ в воронке курса И НЕ зарегистрирован
-            should_add_warmup = (
-                user_status['in_course_funnel'] == 0 and
-                user_status['is_registered'] == 0
-            )
-
-            if should_add_warmup:
-                await self._add_warmup_notifications(user_id, db, funnel_name)
-            else:
-                await logger.info(
-                    f"Пользователь {user_id}: "
-                    f"зарегистрирован={user_status['is_registered']}, "
-                    f"в_воронке={user_status['in_course_funnel']} "
-                    f"→ догрев НЕ добавляем, обычные уведомления ДОБАВЛЯЕМ"
+        # events и user_funnel пишутся отложенно (apps/write_behind.py) - дописываем строки юзера перед проверкой статуса
+        await write_behind.flush_user(user_id)
+        async with acquire() as db:
+            # Проверяем статус пользователя (один запрос и для обычных, и для догрева)
+            user_status = await db.fetchrow("""
+                SELECT
+                    u.timestamp_registration,
+                    -- Проверяем, зарегистрирован ли на курсе
+                    (SELECT COUNT(*) FROM events
+                     WHERE user_id = $1
+                     AND event_type = 'course_registration') as is_registered,
+                    -- Проверяем, в воронке ли пользователя курса
+                    (SELECT COUNT(*) FROM user_funnel
+                     WHERE user_id = $1
+                     AND (label LIKE '%course%' OR label LIKE '%spin%'
+                          OR label LIKE '%mtt%' OR label LIKE '%cash%')) as in_course_funnel,
+                    -- Есть ли уже активные догревочные уведомления
+                    EXISTS(SELECT 1 FROM notifications
+                           WHERE user_id = $1 AND label LIKE 'warmup_%' AND is_active = true) as has_warmup,
+                    -- Последняя активность
+                    COALESCE(
+                        u.last_activity,
+                        (SELECT MAX(timestamp) FROM user_history WHERE user_id = $1)
+                    ) as last_activity
+                FROM users u
+                WHERE u.id = $1
+            """, user_id)
+
+            if user_status:
+                # ДОГРЕВОЧНЫЕ УВЕДОМЛЕНИЯ:
+                # Только если НЕ в воронке курса И НЕ зарегистрирован
+                should_add_warmup = (
+                    user_status['in_course_funnel'] == 0 and
+                    user_status['is_registered'] == 0
                 )
 
-        # Добавляем ОБЫЧНЫЕ уведомления (для всех, независимо от статуса)
-        for notification in notifications:
-            label = notification.get('message')
-            wait = notification.get('at_time')
-            notification_funnel = (notification.get('funnel') or funnel_name or DEFAULT_FUNNEL).lower()
-
-            # Вычисляем время отправки
-            send_time = self._calculate_send_time(wait)
+                if should_add_warmup:
+                    await self._add_warmup_notifications(user_id, db, funnel_name, user_status)
+                else:
+                    await logger.info(
+                        f"Пользователь {user_id}: "
+                        f"зарегистрирован={user_status['is_registered']}, "
+                        f"в_воронке={user_status['in_course_funnel']} "
+                        f"→ догрев НЕ добавляем, обычные уведомления ДОБАВЛЯЕМ"
+                    )
 
-            if notification.get('reusable', False):
-                await db.execute("""
-                    INSERT INTO notifications (user_id, time_to_send, label, is_active)
-                    VALUES ($1, $2, $3, $4)
+            # Добавляем ОБЫЧНЫЕ уведомления (для всех, независимо от статуса)
+            # строки собираем в памяти и пишем двумя executemany вместо INSERT на каждое
+            reusable_rows = []
+            single_rows = []
+            for notification in notifications:
+                label = notification.get('message')
+                wait = notification.get('at_time')
+                notification_funnel = (notification.get('funnel') or funnel_name or DEFAULT_FUNNEL).lower()
+
+                # Вычисляем время отправки
+                send_time = self._calculate_send_time(wait)
+
+                if notification.get('reusable', False):
+                    reusable_rows.append((user_id, send_time, label, True, notification_funnel))
+                else:
+                    single_rows.append((user_id, send_time, label, True, notification_funnel))
+
+                self._remember_notification_funnel(user_id, label, notification_funnel)
+                self.schedule(send_time)
+
+            if reusable_rows:
+                await db.executemany("""
+                    INSERT INTO notifications (user_id, time_to_send, label, is_active, funnel_name)
+                    VALUES ($1, $2, $3, $4, $5)
                     ON CONFLICT (user_id, label) DO UPDATE
-                    SET time_to_send = $2, is_active = $4
-                """, user_id, send_time, label, True)
-            else:
-                await db.execute("""
-                    INSERT INTO notifications (user_id, time_to_send, label, is_active)
-                    VALUES ($1, $2, $3, $4)
+                    SET time_to_send = $2, is_active = $4, funnel_name = $5
+                """, reusable_rows)
+            if single_rows:
+                await db.executemany("""
+                    INSERT INTO notifications (user_id, time_to_send, label, is_active, funnel_name)
+                    VALUES ($1, $2, $3, $4, $5)
                     ON CONFLICT (user_id, label) DO NOTHING
-                """, user_id, send_time, label, True)
+                """, single_rows)
 
-            self._remember_notification_funnel(user_id, label, notification_funnel)
+            await self._start_notification_series(db, user_id)
 
-        await db.close()
+    async def _start_notification_series(self, db, user_id: int):
+        """Отмечает начало серии уведомлений, если она ещё не идёт (user_activity_stats, время в UTC)"""
+        await db.execute("""
+            INSERT INTO user_activity_stats (user_id, first_active_notification)
+            VALUES ($1, timezone('UTC', now()))
+            ON CONFLICT (user_id) DO UPDATE
+            SET first_active_notification = COALESCE(
+                user_activity_stats.first_active_notification,
+                EXCLUDED.first_active_notification
+            )
+        """, user_id)
 
-    async def _add_warmup_notifications(self, user_id: int, db, funnel_name: str):
+    async def _add_warmup_notifications(self, user_id: int, db, funnel_name: str, user_status):
         """
         Добавляет догревочные уведомления ТОЛЬКО для незарегистрированных
-        пользователей, которые НЕ находятся в воронке курса
+        пользователей, которые НЕ находятся в воронке курса.
+        user_status - строка статуса из add_notifications (is_registered, in_course_funnel, has_warmup)
         """
         # Проверяем существующие догревочные уведомления
-        existing = await db.fetchrow("""
-            SELECT COUNT(*) as cnt FROM notifications
-            WHERE user_id = $1 AND label LIKE 'warmup_%' AND is_active = true
-        """, user_id)
-
-        if existing and existing['cnt'] > 0:
+        if user_status['has_warmup']:
             await logger.info(f"У пользователя {user_id} уже есть догревочные уведомления")
             return
 
         # КРИТИЧЕСКИ ВАЖНО: Проверяем, что пользователь НЕ зарегистрирован
-        is_registered = await db.fetchrow("""
-            SELECT COUNT(*) as cnt FROM events
-            WHERE user_id = $1 AND event_type = 'course_registration'
-        """, user_id)
-
-        if is_registered and is_registered['cnt'] > 0:
+        if user_status['is_registered']:
             await logger.info(f"Пользователь {user_id} зарегистрирован, догрев не нужен")
             return
 
         # Проверяем, что пользователь НЕ в воронке курса
-        in_course_funnel = await db.fetchrow("""
-            SELECT COUNT(*) as cnt FROM user_funnel
-            WHERE user_id = $1
-            AND (label LIKE '%course%' OR label LIKE '%spin%'
-                 OR label LIKE '%mtt%' OR label LIKE '%cash%')
-        """, user_id)
-
-        if in_course_funnel and in_course_funnel['cnt'] > 0:
+        if user_status['in_course_funnel']:
             await logger.info(f"Пользователь {user_id} уже в воронке курса, догрев не нужен")
             return
 
@@ -354,6 +503,7 @@ class SmartNotifier:
 
         base_time = datetime.now()
 
+        rows = []
         for msg in warmup_messages:
             target_date = base_time + timedelta(days=msg['days'])
             hour, minute = map(int, msg['time'].split(':'))
@@ -362,13 +512,16 @@ class SmartNotifier:
                 hour, minute
             )
             send_time = int(target_datetime.timestamp())
+            rows.append((user_id, send_time, msg['label'], True, funnel_name))
 
-            await db.execute("""
-                INSERT INTO notifications (user_id, time_to_send, label, is_active)
-                VALUES ($1, $2, $3, $4)
-                ON CONFLICT DO NOTHING
-            """, user_id, send_time, msg['label'], True)
-            self._remember_notification_funnel(user_id, msg['label'], funnel_name)
+        await db.executemany("""
+            INSERT INTO notifications (user_id, time_to_send, label, is_active, funnel_name)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT DO NOTHING
+        """, rows)
+        for _, send_time, label, _, _ in rows:
+            self.schedule(send_time)
+            self._remember_notification_funnel(user_id, label, funnel_name)
 
     def _calculate_send_time(self, wait):
         """Вычисляет время отправки уведомления"""
@@ -391,53 +544,69 @@ class SmartNotifier:
 
             return int(target_datetime.timestamp())
 
-    async def load_notifications(self):
-        """Загружает уведомления для отправки с учетом активности"""
-        now = int(time.time())
-        db = await create_connect()
-
-        # Закрываем уведомления для прошедших воронку
-        await db.execute("""
-            UPDATE notifications
-            SET is_active = FALSE
-            WHERE user_id IN (
-                SELECT user_id FROM funnel_passed
-                WHERE funnel_name = 'default' AND passed = TRUE
-            )
-        """)
-
-        # Выбираем активные уведомления
-        notifications = await db.fetch("""
-            SELECT n.id, n.user_id, n.time_to_send, n.label
-            FROM notifications n
-            LEFT JOIN users u ON u.id = n.user_id
-            WHERE n.is_active = TRUE
-            AND COALESCE(u.user_block, FALSE) = FALSE
-            AND n.time_to_send < $1
-            AND COALESCE(n.pause_reason, '') != 'inactivity'
-            AND n.user_id NOT IN (
-                SELECT user_id FROM funnel_passed
-                WHERE funnel_name = 'default' AND passed = TRUE
-            )
-        """, now)
-
-        await db.close()
-        return notifications
+    async def load_notifications(self, now: int | None = None):
+        """
+        Забирает пачку наступивших уведомлений. Строки блокируются через SKIP LOCKED и
+        откладываются на CLAIM_LEASE_SECONDS, поэтому несколько процессов бота не
+        заберут одно уведомление дважды, а неотправленное вернётся в рассылку позже
+        """
+        now = int(time.time()) if now is None else now
+        async with acquire() as db:
+            notifications = await db.fetch("""
+                WITH due AS (
+                    SELECT n.id, n.time_to_send
+                    FROM notifications n
+                    LEFT JOIN users u ON u.id = n.user_id
+                    WHERE n.is_active = TRUE
+                    AND n.time_to_send <= $1
+                    AND COALESCE(u.user_block, FALSE) = FALSE
+                    AND COALESCE(n.pause_reason, '') != 'inactivity'
+                    AND NOT EXISTS (
+                        SELECT 1 FROM funnel_passed fp
+                        WHERE fp.user_id = n.user_id
+                        AND fp.funnel_name = 'default' AND fp.passed = TRUE
+                    )
+                    ORDER BY n.time_to_send
+                    LIMIT $2
+                    FOR UPDATE OF n SKIP LOCKED
+                )
+                UPDATE notifications n
+                SET time_to_send = $1 + $3
+                FROM due
+                WHERE n.id = due.id
+                RETURNING n.id, n.user_id, due.time_to_send, n.label, n.funnel_name
+            """, now, self.CLAIM_BATCH_SIZE, self.CLAIM_LEASE_SECONDS)
+
+        if notifications:
+            # неотправленные вернутся после аренды
+            self.schedule(now + self.CLAIM_LEASE_SECONDS)
+        return [dict(notification) for notification in notifications]
 
     async def close_notification(self, notification_id=None, user_id=None, label=None, funnel_name: str | None = None):
         """Закрывает уведомление"""
-        db = await create_connect()
-        if notification_id:
-            await db.execute(
-                "UPDATE notifications SET is_active = $1 WHERE id = $2",
-                False, notification_id
-            )
-        else:
-            await db.execute("""
-                UPDATE notifications SET is_active = $1
-                WHERE user_id = $2 AND label = $3 AND is_active = $4
-            """, False, user_id, label, True)
-        await db.close()
+        async with acquire() as db:
+            if notification_id:
+                await db.execute(
+                    "UPDATE notifications SET is_active = $1 WHERE id = $2",
+                    False, notification_id
+                )
+            else:
+                await db.execute("""
+                    UPDATE notifications SET is_active = $1
+                    WHERE user_id = $2 AND label = $3 AND is_active = $4
+                """, False, user_id, label, True)
+            if user_id:
+                # последнее активное уведомление закрыто - серия закончилась
+                await db.execute("""
+                    UPDATE user_activity_stats
+                    SET first_active_notification = NULL
+                    WHERE user_id = $1
+                    AND first_active_notification IS NOT NULL
+                    AND NOT EXISTS (
+                        SELECT 1 FROM notifications
+                        WHERE user_id = $1 AND is_active = true
+                    )
+                """, user_id)
         if user_id and label:
             self._drop_notification_funnel(user_id, label)
 
@@ -468,17 +637,13 @@ class SmartNotifier:
                 await logger.info("Уведомление устарело и закрыто")
                 return
 
-            # Обработка actions
+            # Обработка actions (список и маршрут is_ok посчитаны при загрузке воронки)
             result = False
-            if act := (msg_data.get("action") or msg_data.get("actions")):
-                if isinstance(act, list):
-                    for action in act:
-                        result = await run_action(action=action, user_id=user_id, bot=bot)
-                elif isinstance(act, dict):
-                    result = await run_action(action=act, user_id=user_id, bot=bot)
+            actions, next_route = node_actions(msg_data)
+            for action in actions or ():
+                result = await run_action(action=action, user_id=user_id, bot=bot)
 
             if result:
-                next_route = _extract_next_route(act)
                 if next_route:
                     route = next_route
                     msg_data = funnel_map['callback'].get(route)
@@ -524,12 +689,24 @@ class SmartNotifier:
                     await logger.info(f"Уведомление {notification.get('id')} отправлено")
 
                     # Сохраняем в историю
-                    db = await create_connect()
-                    await db.execute("""
-                        INSERT INTO user_history (user_id, text)
-                        VALUES ($1, LEFT($2, $3))
-                    """, user_id, f"Получил уведомление: {notification.get('label')}", MAX_CHARS_USERS_HISTORY)
-                    await db.close()
+                    async with acquire() as db:
+                        await db.execute("""
+                            INSERT INTO user_history (user_id, text)
+                            VALUES ($1, LEFT($2, $3))
+                        """, user_id, f"Получил уведомление: {notification.get('label')}", MAX_CHARS_USERS_HISTORY)
+                        # счётчик отправленных за 2 месяца (старые отметки отсекаем, время в UTC)
+                        await db.execute("""
+                            INSERT INTO user_activity_stats (user_id, notifications_sent_at)
+                            VALUES ($1, ARRAY[timezone('UTC', now())])
+                            ON CONFLICT (user_id) DO UPDATE
+                            SET notifications_sent_at = array_append(
+                                ARRAY(
+                                    SELECT sent_at FROM unnest(user_activity_stats.notifications_sent_at) AS sent_at
+                                    WHERE sent_at > timezone('UTC', now()) - INTERVAL '2 months'
+                                ),
+                                timezone('UTC', now())
+                            )
+                        """, user_id)
 
             elif new := msg_data.get("notifications"):
                 await self.add_notifications(
@@ -546,22 +723,19 @@ class SmartNotifier:
 
     async def blocked(self, user_id, is_blocked: bool = False):
         """Помечает пользователя как заблокировавшего бота"""
-        db = await create_connect()
-
-        action = "заблокировал" if is_blocked else "разблокировал"
+        async with acquire() as db:
+            action = "заблокировал" if is_blocked else "разблокировал"
 
-        username = await db.fetchrow("SELECT username FROM users WHERE id = $1", user_id)
-        username = username.get("username") if username else "unknown"
+            username = await db.fetchrow("SELECT username FROM users WHERE id = $1", user_id)
+            username = username.get("username") if username else "unknown"
 
-        await db.execute("""
-            INSERT INTO user_history (user_id, text) VALUES ($1, $2)
-        """, user_id, f"Пользователь {action} бота!")
-
-        await db.execute("""
-            UPDATE users SET user_block = $1 WHERE id = $2
-        """, is_blocked, user_id)
+            await db.execute("""
+                INSERT INTO user_history (user_id, text) VALUES ($1, $2)
+            """, user_id, f"Пользователь {action} бота!")
 
-        await db.close()
+            await db.execute("""
+                UPDATE users SET user_block = $1 WHERE id = $2
+            """, is_blocked, user_id)
 
         # Отправляем алерт в Discord
         await self.discord_alert(
@@ -576,11 +750,11 @@ class SmartNotifier:
         try:
             url = f"https://discord.com/api/v9/channels/{ds_channel}/messages"
             payload = {"content": text}
-            async with ClientSession() as session:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    if response.status == 200:
-                        await logger.info("Уведомление отправлено в Discord")
-                    return response
+            session = http_clients.session("discord")
+            async with session.post(url, json=payload, headers=headers) as response:
+                if response.status == 200:
+                    await logger.info("Уведомление отправлено в Discord")
+                return response
         except Exception as error:
             await logger.error(f"Ошибка Discord: {error}")
             return None
@@ -5,7 +5,6 @@ import aiogram.exceptions
 from aiogram import Router
 from aiogram.types import User
 from os import getenv
-from aiohttp import ClientSession
 from datetime import datetime, timedelta
 import json
 import html
@@ -14,8 +13,9 @@ import apps.logger as logger
 from threading import Thread
 import re
 #
-from modules import MAX_CHARS_USERS_HISTORY, bot, create_connect
+from modules import MAX_CHARS_USERS_HISTORY, bot, acquire
 import apps.funcs as funcs
+import apps.http_clients as http_clients
 from apps.bot_info import bot_info
 
 router = Router()
@@ -116,12 +116,11 @@ async def user_click_handler(call, bot):
         msg_text = KEYBOARDS[params[0]]['discord_msg'].format(username=username, msg_text=message_text)
     else:
         # проверяем, есть-ли в БД данные для данной кнопки
-        db = await create_connect()
-        key_data = await db.fetchrow(
-            """SELECT id, key_text, answer FROM msg_keys WHERE user_id = $1 AND message_id = $2 AND key_label = $3""",
-            str(user_id), message_id, params[1]
-        )
-        await db.close()
+        async with acquire() as db:
+            key_data = await db.fetchrow(
+                """SELECT id, key_text, answer FROM msg_keys WHERE user_id = $1 AND message_id = $2 AND key_label = $3""",
+                str(user_id), message_id, params[1]
+            )
 
         # если есть
         if key_data:
@@ -135,12 +134,11 @@ async def user_click_handler(call, bot):
     await bot.delete_message(chat_id, message_id)
 
     # удаляем инфу о кнопках из БД
-    db = await create_connect()
-    await db.execute(
-    """DELETE FROM msg_keys WHERE user_id = $1 AND message_id = $2""",
-    str(user_id), message_id
-    )
-    await db.close()
+    async with acquire() as db:
+        await db.execute(
+        """DELETE FROM msg_keys WHERE user_id = $1 AND message_id = $2""",
+        str(user_id), message_id
+        )
 
     # если в БД есть ответ для этого сообщения - отправляем его
     if key_data and (answer:=key_data.get("answer", "")):
@@ -297,14 +295,13 @@ async def send_alerts(notifications, conf_data):
                 # если мы тут - то сообщение удачно отправлено, и можно сделать записи в БД
                 # если в сообщении были кастомные кнопки
                 if custom_keys:
-                    db = await create_connect()
-                    # проходимся по кнопкам
-                    for key in custom_keys:
-                        await db.execute(
-                        """INSERT INTO msg_keys (user_id, message_id, key_text, answer, key_label) VALUES ($1, $2, $3, $4, $5)""",
-                        user.get('user_id'), message_id, key["text"], key["answer"], str(key["number"])
-                    )
-                    await db.close()
+                    async with acquire() as db:
+                        # проходимся по кнопкам
+                        for key in custom_keys:
+                            await db.execute(
+                            """INSERT INTO msg_keys (user_id, message_id, key_text, answer, key_label) VALUES ($1, $2, $3, $4, $5)""",
+                            user.get('user_id'), message_id, key["text"], key["answer"], str(key["number"])
+                        )
             # если кнопок нет - отправляем просто текст сообщения
             else:
                 await bot.send_message(chat_id=user.get('user_id'), text=message_text)
@@ -351,12 +348,11 @@ async def send_alerts(notifications, conf_data):
             await funcs.add_msg_to_history(chat_id=user.get('user_id'), author_id="system", content=f"Пользователь получил автоматизированное сообщение с ПХ с текстом: {message_text}")
 
             # записываем в БД в историю юзера
-            db = await create_connect()
-            await db.execute(
-                """INSERT INTO user_history (user_id, text) VALUES ($1, LEFT($2, $3))""", int(user.get('user_id')),
-                f"Получил уведомление с PokerHUB: {message_text}", MAX_CHARS_USERS_HISTORY
-            )
-            await db.close()
+            async with acquire() as db:
+                await db.execute(
+                    """INSERT INTO user_history (user_id, text) VALUES ($1, LEFT($2, $3))""", int(user.get('user_id')),
+                    f"Получил уведомление с PokerHUB: {message_text}", MAX_CHARS_USERS_HISTORY
+                )
 
             # сохраняем в список, кому удалось отправить
             alerts.append(user['id'])
@@ -438,22 +434,22 @@ async def send_alerts(notifications, conf_data):
 
 async def get_notifications():
     # запрашиваем уведомления с покерхаб
-    async with ClientSession() as session:
-        async with session.get('https://pokerhub.pro/api/getnotifications') as response:
-        # async with session.get('http://localhost:2288/api/getnotifications') as response: # для локального теста
-            try:
-                resp = await response.json()
-                # получаем текущее время по МСК
-                msk_tz = pytz.timezone('Europe/Moscow')
-                now_msk = datetime.now(msk_tz).replace(tzinfo=None)
-                # await logger.debug(f"Будут отобраны уведомления чьё время < {str(now_msk)}")
-                # фильтруем только те, которые уже нужно отправить
-                need_send = list(filter(lambda data: now_msk > datetime.strptime(data['date'], '%Y-%m-%d %H:%M:%S'), resp))
-
-                # await logger.debug(f"Нужно отправить уведомления: {need_send}")
-            except Exception as error:
-                await logger.error(f'Ошибка PokerHub: {error}')
-                return None
+    session = http_clients.session("pokerhub")
+    async with session.get('https://pokerhub.pro/api/getnotifications') as response:
+    # async with session.get('http://localhost:2288/api/getnotifications') as response: # для локального теста
+        try:
+            resp = await response.json()
+            # получаем текущее время по МСК
+            msk_tz = pytz.timezone('Europe/Moscow')
+            now_msk = datetime.now(msk_tz).replace(tzinfo=None)
+            # await logger.debug(f"Будут отобраны уведомления чьё время < {str(now_msk)}")
+            # фильтруем только те, которые уже нужно отправить
+            need_send = list(filter(lambda data: now_msk > datetime.strptime(data['date'], '%Y-%m-%d %H:%M:%S'), resp))
+
+            # await logger.debug(f"Нужно отправить уведомления: {need_send}")
+        except Exception as error:
+            await logger.error(f'Ошибка PokerHub: {error}')
+            return None
     # возвращаем фильтрованный JSON
     return need_send
 
@@ -462,10 +458,10 @@ async def close_notifications(users: list):
     if not users:
         return
     # отправляем запрос на закрытие уведомлений, которые удалось отправить
-    async with ClientSession() as session:
-        url = f'https://pokerhub.pro/api/updatenotifications?ids={",".join([str(user) for user in users])}'
-        async with session.get(url) as response:
-            await logger.debug(f"Ответ от {url}: {response.status}")
+    session = http_clients.session("pokerhub")
+    url = f'https://pokerhub.pro/api/updatenotifications?ids={",".join([str(user) for user in users])}'
+    async with session.get(url) as response:
+        await logger.debug(f"Ответ от {url}: {response.status}")
 
 async def discord_alert(users_errors: dict, conf_data: dict):
     # для формирования в ДС уведомления, кому не удалось отправить сообщения
@@ -506,9 +502,9 @@ async def send_msg(msg: str):
         url = f"https://discord.com/api/v9/channels/{ds_channel}/messages"
         # сообщение
         payload = {"content": msg}
-        async with ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                return response
+        session = http_clients.session("discord")
+        async with session.post(url, json=payload, headers=headers) as response:
+            return response
     except Exception as error:
         await logger.error(f"При отправке уведомления в дискорд возникла ошибка: {error}")
         return None
@@ -0,0 +1,127 @@
+"""
+Ограничение частоты отправки сообщений в Telegram.
+
+Общий лимит бота (~30 сообщений/сек) и лимит на один чат (1 сообщение/сек).
+Подключается к сессии бота как request-middleware (bot.main), поэтому под лимит
+попадают все отправки: ответы в обработчиках, рассыльщик уведомлений, actions.
+"""
+import asyncio
+from time import monotonic
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from modules import TG_CHAT_BURST, TG_CHAT_RATE_LIMIT, TG_RATE_LIMIT
+import apps.logger as logger
+
+# методы API, которые считаются отправкой сообщения
+_COUNTED_METHODS = {"copyMessage", "copyMessages", "forwardMessage", "forwardMessages"}
+_SKIPPED_METHODS = {"sendChatAction"}
+# сколько раз повторяем запрос после TelegramRetryAfter
+MAX_RETRY_AFTER_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """
+    Token bucket в виде GCRA: для каждого ключа храним теоретическое время следующей
+    отправки, поэтому не нужны ни фоновые задачи, ни блокировки
+    """
+
+    def __init__(self, rate: float, burst: int = 1, max_keys: int = 10000):
+        self.interval = 1 / rate
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        self.max_keys = max_keys
+        self._tat = {}
+
+    def reserve(self, key=None, cost: int = 1) -> float:
+        """Занимает cost слотов и возвращает, сколько секунд нужно подождать до отправки"""
+        now = monotonic()
+        tat = max(self._tat.get(key, now), now)
+        self._tat[key] = tat + self.interval * cost
+        if len(self._tat) > self.max_keys:
+            self._cleanup(now)
+        # отправлять можно, когда освободился последний из занятых слотов
+        return max(0.0, tat + self.interval * (cost - 1) - self.tolerance - now)
+
+    def _cleanup(self, now: float):
+        # ключи, у которых слот уже в прошлом, ничем не отличаются от новых
+        for key in [key for key, tat in self._tat.items() if tat <= now]:
+            del self._tat[key]
+
+
+class TelegramRateLimiter:
+    def __init__(self, rate: float = TG_RATE_LIMIT, chat_rate: float = TG_CHAT_RATE_LIMIT,
+                 chat_burst: int = TG_CHAT_BURST):
+        self.bucket = TokenBucket(rate)
+        self.chats = TokenBucket(chat_rate, burst=chat_burst)
+        self._paused_until = 0.0
+
+    async def wait(self, chat_id=None, cost: int = 1):
+        """Ждёт, пока можно отправить cost сообщений в чат"""
+        if chat_id is not None:
+            await _sleep(self.chats.reserve(chat_id, cost))
+        while True:
+            await _sleep(self.bucket.reserve(cost=cost))
+            pause = self._paused_until - monotonic()
+            if pause <= 0:
+                return
+            # пока бот на паузе после RetryAfter - ждём и занимаем слот заново
+            await asyncio.sleep(pause)
+
+    def pause(self, seconds: float):
+        """Останавливает все отправки на seconds (ответ Telegram с retry_after)"""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+
+async def _sleep(delay: float):
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+def is_counted(method) -> bool:
+    api_method = getattr(method, "__api_method__", "")
+    if api_method in _SKIPPED_METHODS:
+        return False
+    return api_method.startswith("send") or api_method in _COUNTED_METHODS
+
+
+def message_cost(method) -> int:
+    """Сколько сообщений отправит метод: альбом (sendMediaGroup) - по одному на каждый файл"""
+    if getattr(method, "__api_method__", "") == "sendMediaGroup":
+        return max(len(method.media), 1)
+    return 1
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """
+    Пропускает отправку сообщений через лимитер. На TelegramRetryAfter ставит
+    на паузу весь бот и повторяет то же сообщение, а не теряет его
+    """
+
+    def __init__(self, limiter: TelegramRateLimiter | None = None):
+        self.limiter = limiter or telegram_limiter
+
+    async def __call__(self, make_request, bot, method):
+        if not is_counted(method):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        cost = message_cost(method)
+        attempt = 0
+        while True:
+            await self.limiter.wait(chat_id, cost)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as error:
+                attempt += 1
+                self.limiter.pause(error.retry_after)
+                await logger.info(
+                    f"Telegram RetryAfter {error.retry_after} сек ({method.__api_method__}, chat {chat_id}), "
+                    f"попытка {attempt}"
+                )
+                if attempt >= MAX_RETRY_AFTER_ATTEMPTS:
+                    raise
+
+
+# общий на процесс лимитер
+telegram_limiter = TelegramRateLimiter()
@@ -0,0 +1,107 @@
+"""
+Повторы запросов к внешним сервисам и защита от недоступного сервиса.
+
+retry() повторяет запрос с экспоненциальной задержкой и случайным разбросом (full jitter),
+чтобы после сбоя клиенты не били в сервис одновременно. CircuitBreaker считает сбои
+подряд: после failure_threshold сбоев он "размыкается" и reset_timeout секунд запросы
+сразу завершаются CircuitOpenError, не дожидаясь таймаутов. Затем пропускается один
+пробный запрос: успех замыкает цепь, сбой снова размыкает её.
+
+Повторяются только RetryableError и сетевые ошибки (aiohttp.ClientError, таймауты);
+остальные исключения (например, ответ 4xx) пробрасываются сразу и сбоем сервиса не считаются.
+
+Использование:
+    breaker = CircuitBreaker("jivo")
+    result = await retry(lambda: post(data), breaker=breaker, attempts=3)
+"""
+import asyncio
+import random
+from time import monotonic
+
+import aiohttp
+
+import apps.logger as logger
+
+
+class RetryableError(Exception):
+    """Временная ошибка сервиса (5xx, 429) - запрос можно повторить"""
+
+
+class CircuitOpenError(Exception):
+    """Сервис считается недоступным, запрос не выполнялся"""
+
+
+RETRYABLE_ERRORS = (RetryableError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        # время, до которого запросы не пропускаются (None - цепь замкнута)
+        self.open_until = None
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.open_until is not None
+
+    def allow(self) -> bool:
+        """Можно ли выполнять запрос (после reset_timeout пропускается один пробный)"""
+        if self.open_until is None:
+            return True
+        if self.probing or monotonic() < self.open_until:
+            return False
+        self.probing = True
+        return True
+
+    async def record_success(self):
+        if self.open_until is not None:
+            await logger.info(f"{self.name}: сервис снова доступен")
+        self.failures = 0
+        self.open_until = None
+        self.probing = False
+
+    async def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.open_until is None:
+                await logger.error(f"{self.name}: {self.failures} сбоев подряд, запросы приостановлены на {self.reset_timeout} сек")
+            self.open_until = monotonic() + self.reset_timeout
+            self.probing = False
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 10) -> float:
+    """Задержка перед повтором номер attempt (с 1): случайная от 0 до base * 2^(attempt-1), не больше cap"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+async def retry(request, breaker: CircuitBreaker | None = None, attempts: int = 3,
+                base_delay: float = 0.5, max_delay: float = 10):
+    """
+    Выполняет request() (корутинная функция) до attempts раз.
+    Возвращает результат первого успешного вызова; если все попытки неудачны -
+    пробрасывает последнюю ошибку, если цепь разомкнута - CircuitOpenError
+    """
+    for attempt in range(1, attempts + 1):
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(f"{breaker.name}: сервис недоступен, запрос не выполнялся")
+        try:
+            result = await request()
+        except RETRYABLE_ERRORS:
+            if breaker is not None:
+                await breaker.record_failure()
+            if attempt == attempts:
+                raise
+            await asyncio.sleep(backoff_delay(attempt, base_delay, max_delay))
+        except BaseException:
+            # сервис ответил, ошибка на нашей стороне или запрос отменён - пробный запрос завершён
+            if breaker is not None:
+                breaker.probing = False
+            raise
+        else:
+            if breaker is not None:
+                await breaker.record_success()
+            return result
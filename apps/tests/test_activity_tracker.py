@@ -0,0 +1,107 @@
+"""Tests for debounced activity tracking (apps/activity_tracker.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import types
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import apps.activity_tracker as activity_tracker  # noqa: E402
+
+
+class FakeDB:
+    def __init__(self, previous) -> None:
+        self.previous = previous
+        self.calls = []
+
+    async def fetch(self, query, user_ids, seen_at):
+        assert "unnest($1::bigint[], $2::timestamp[])" in query
+        self.calls.append((list(user_ids), list(seen_at)))
+        return [{"user_id": user_id, "previous_activity": self.previous.get(user_id)} for user_id in user_ids]
+
+
+class FakeNotifier:
+    def __init__(self) -> None:
+        self.resumed = []
+
+    def inactivity_boundary(self):
+        return timedelta(days=14)
+
+    async def resume_user_notifications(self, user_id):
+        self.resumed.append(user_id)
+
+
+def _setup(monkeypatch, previous):
+    fake_db = FakeDB(previous)
+    notifier = FakeNotifier()
+
+    @asynccontextmanager
+    async def acquire():
+        yield fake_db
+
+    async def ensure_last_activity_support(db=None):
+        pass
+
+    monkeypatch.setattr(activity_tracker, "acquire", acquire)
+    monkeypatch.setattr(activity_tracker, "_pending", {})
+    monkeypatch.setattr(activity_tracker, "_flusher_task", None)
+    monkeypatch.setitem(sys.modules, "apps.notifier", types.SimpleNamespace(notificator=notifier))
+    monkeypatch.setitem(sys.modules, "apps.funcs", types.SimpleNamespace(ensure_last_activity_support=ensure_last_activity_support))
+    return fake_db, notifier
+
+
+def test_touches_are_coalesced_into_one_update(monkeypatch) -> None:
+    now = datetime.utcnow()
+    fake_db, notifier = _setup(monkeypatch, {1: now - timedelta(hours=1), 2: now - timedelta(minutes=5)})
+
+    async def runner():
+        for _ in range(3):
+            activity_tracker.touch(1)
+        activity_tracker.touch(2)
+        await activity_tracker.close()
+
+    asyncio.run(runner())
+
+    assert len(fake_db.calls) == 1
+    assert sorted(fake_db.calls[0][0]) == [1, 2]
+    # оба были активны недавно - пересчитывать уведомления не нужно
+    assert notifier.resumed == []
+
+
+def test_only_users_crossing_inactivity_boundary_are_resumed(monkeypatch) -> None:
+    now = datetime.utcnow()
+    fake_db, notifier = _setup(monkeypatch, {1: now - timedelta(days=1), 2: now - timedelta(days=30)})
+
+    async def runner():
+        activity_tracker.touch(1)
+        activity_tracker.touch(2)
+        activity_tracker.touch(3)  # без статистики - новый пользователь
+        await activity_tracker.close()
+
+    asyncio.run(runner())
+
+    assert sorted(notifier.resumed) == [2, 3]
+
+
+def test_activity_is_written_as_naive_utc(monkeypatch) -> None:
+    fake_db, notifier = _setup(monkeypatch, {})
+
+    async def runner():
+        activity_tracker.touch(1)
+        await activity_tracker.close()
+
+    before = datetime.utcnow()
+    asyncio.run(runner())
+
+    (seen_at,) = fake_db.calls[0][1]
+    # колонки last_activity - timestamp без пояса: aware-время зависело бы от TimeZone сессии
+    assert seen_at.tzinfo is None
+    assert before <= seen_at <= datetime.utcnow()
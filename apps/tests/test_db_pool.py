@@ -0,0 +1,177 @@
+"""Tests for the shared DB pool helpers in modules (acquire/bind_connection)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import modules  # noqa: E402
+
+
+class FakePool:
+    def __init__(self) -> None:
+        self.acquired = 0
+        self.released = 0
+        self._next = 0
+
+    async def acquire(self):
+        self.acquired += 1
+        self._next += 1
+        return f"conn-{self._next}"
+
+    async def release(self, connection) -> None:
+        self.released += 1
+
+    def get_size(self) -> int:
+        return 2
+
+    def get_idle_size(self) -> int:
+        return 2 - (self.acquired - self.released)
+
+    def get_min_size(self) -> int:
+        return 1
+
+    def get_max_size(self) -> int:
+        return 4
+
+
+def _use_pool(monkeypatch) -> FakePool:
+    pool = FakePool()
+    monkeypatch.setattr(modules, "_db_pool", pool)
+    return pool
+
+
+def test_acquire_returns_connection_to_pool(monkeypatch) -> None:
+    pool = _use_pool(monkeypatch)
+
+    async def runner() -> None:
+        async with modules.acquire() as first:
+            pass
+        async with modules.acquire() as second:
+            pass
+        assert first != second
+
+    asyncio.run(runner())
+    assert pool.acquired == pool.released == 2
+
+
+def test_bound_connection_is_reused_within_update(monkeypatch) -> None:
+    pool = _use_pool(monkeypatch)
+
+    async def runner() -> None:
+        async with modules.bind_connection():
+            async with modules.acquire() as first:
+                # вложенный acquire (например, хелпер внутри хелпера)
+                async with modules.acquire() as nested:
+                    assert nested == first
+            async with modules.acquire() as second:
+                assert second == first
+            assert pool.released == 0
+
+    asyncio.run(runner())
+    assert pool.acquired == pool.released == 1
+
+
+def test_bind_without_queries_does_not_touch_pool(monkeypatch) -> None:
+    pool = _use_pool(monkeypatch)
+
+    async def runner() -> None:
+        async with modules.bind_connection():
+            await asyncio.sleep(0)
+
+    asyncio.run(runner())
+    assert pool.acquired == 0
+
+
+def test_spawned_task_gets_own_connection(monkeypatch) -> None:
+    pool = _use_pool(monkeypatch)
+
+    async def background() -> str:
+        async with modules.acquire() as db:
+            return db
+
+    async def runner() -> None:
+        async with modules.bind_connection():
+            async with modules.acquire() as bound:
+                spawned = await asyncio.create_task(background())
+            assert spawned != bound
+
+    asyncio.run(runner())
+    assert pool.acquired == pool.released == 2
+
+
+def test_pool_stats_report_saturation(monkeypatch) -> None:
+    _use_pool(monkeypatch)
+
+    async def runner() -> dict:
+        async with modules.acquire():
+            return modules.db_pool_stats()
+
+    stats = asyncio.run(runner())
+    assert stats["in_use"] == 1
+    assert stats["saturation"] == 0.25
+
+
+def test_bound_connection_is_returned_around_external_io(monkeypatch) -> None:
+    pool = _use_pool(monkeypatch)
+
+    async def runner() -> None:
+        async with modules.bind_connection():
+            async with modules.acquire() as first:
+                # внутри блока acquire соединение используется - не отдаём
+                await modules.release_bound_connection()
+                assert pool.released == 0
+            # запрос к Telegram/HTTP между блоками - соединение возвращается в пул
+            await modules.release_bound_connection()
+            assert pool.released == 1
+            async with modules.acquire() as second:
+                assert second != first
+
+    asyncio.run(runner())
+    assert pool.acquired == pool.released == 2
+
+
+def test_bound_connection_goes_back_to_its_own_pool(monkeypatch) -> None:
+    old_pool = _use_pool(monkeypatch)
+
+    async def runner() -> None:
+        async with modules.bind_connection():
+            async with modules.acquire():
+                pass
+            # пул пересоздан во время обработки апдейта
+            modules._db_pool = FakePool()
+
+    asyncio.run(runner())
+    assert old_pool.released == 1 and modules._db_pool.released == 0
+
+
+def test_db_time_is_counted_in_the_update_and_not_in_background_tasks(monkeypatch) -> None:
+    import apps.logger as logger
+
+    _use_pool(monkeypatch)
+
+    async def query() -> None:
+        async with modules.acquire():
+            async with modules.acquire():
+                await asyncio.sleep(0.02)
+
+    async def runner() -> tuple:
+        with logger.log_context(update_type="message") as update:
+            await query()
+            # время БД уже учтено, когда обработчик пишет итог апдейта
+            handler_db = update["timings"]["db"]
+            background = logger.create_background_task(query())
+        await background
+        return handler_db, update["timings"]["db"]
+
+    handler_db, final_db = asyncio.run(runner())
+    # вложенный acquire не считается дважды
+    assert 0.02 <= handler_db < 0.04
+    # фоновая задача не наследует контекст апдейта
+    assert final_db == handler_db
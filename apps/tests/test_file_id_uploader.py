@@ -0,0 +1,302 @@
+"""Tests for file hashing and file_id lookups in apps/file_id_uploader.py."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import apps.file_id_uploader as file_uploader  # noqa: E402
+
+
+def test_file_hash_is_cached_until_file_changes(tmp_path, monkeypatch) -> None:
+    media = tmp_path / "video.mp4"
+    media.write_bytes(b"a" * 3000)
+    monkeypatch.setattr(file_uploader, "HASH_CHUNK_SIZE", 1024)
+    calls = []
+    original = file_uploader.calculate_file_hash
+
+    def counting_hash(filepath):
+        calls.append(filepath)
+        return original(filepath)
+
+    monkeypatch.setattr(file_uploader, "calculate_file_hash", counting_hash)
+
+    first = asyncio.run(file_uploader.get_file_hash(str(media)))
+    second = asyncio.run(file_uploader.get_file_hash(str(media)))
+    assert first == second == hashlib.md5(b"a" * 3000).hexdigest()
+    assert len(calls) == 1
+
+    media.write_bytes(b"b" * 10)
+    os.utime(media, ns=(0, 1))
+    assert asyncio.run(file_uploader.get_file_hash(str(media))) == hashlib.md5(b"b" * 10).hexdigest()
+    assert len(calls) == 2
+
+
+class FakeDB:
+    def __init__(self, rows) -> None:
+        self.rows = rows
+        self.queries = []
+
+    async def fetch(self, query, *args):
+        self.queries.append(query)
+        return self.rows
+
+    async def execute(self, query, *args):
+        self.queries.append(query)
+
+
+def test_file_ids_are_served_from_memory(monkeypatch) -> None:
+    fake_db = FakeDB([{"label": "intro_a.mp4", "file_id": "F1", "content_type": "video", "hash": "h1"}])
+
+    @contextlib.asynccontextmanager
+    async def fake_acquire():
+        yield fake_db
+
+    monkeypatch.setattr(file_uploader, "acquire", fake_acquire)
+    monkeypatch.setattr(file_uploader, "_uploaded_files", {})
+    monkeypatch.setattr(file_uploader, "_uploaded_files_loaded", False)
+
+    async def runner() -> None:
+        assert (await file_uploader.get_file_id("intro_a.mp4"))["file_id"] == "F1"
+        assert await file_uploader.get_file_id("missing") is None
+        await file_uploader.save_file_id("intro_b.mp4", "F2", "video", "h2")
+        assert (await file_uploader.get_file_id("intro_b.mp4"))["file_id"] == "F2"
+
+    asyncio.run(runner())
+
+    # одна загрузка таблицы + запись (upsert и pg_notify), поиск - без запросов
+    assert len(fake_db.queries) == 3
+
+    file_uploader._on_uploaded_file_notify(
+        None, 1, "uploaded_files", '{"label": "intro_c.mp4", "file_id": "F3", "content_type": "image", "hash": "h3"}'
+    )
+    assert file_uploader._uploaded_files["intro_c.mp4"]["file_id"] == "F3"
+
+
+def test_listener_reconnects_and_reloads_after_connection_loss(monkeypatch) -> None:
+    class FakeConnection:
+        def __init__(self) -> None:
+            self.on_terminate = None
+
+        async def add_listener(self, channel, callback):
+            pass
+
+        def add_termination_listener(self, callback):
+            self.on_terminate = callback
+
+        async def close(self):
+            pass
+
+    connections = []
+    reloads = []
+
+    async def fake_connect_db():
+        connections.append(FakeConnection())
+        return connections[-1]
+
+    async def fake_load():
+        reloads.append(True)
+
+    monkeypatch.setattr(file_uploader, "UPLOADED_FILES_LISTEN", True)
+    monkeypatch.setattr(file_uploader, "connect_db", fake_connect_db)
+    monkeypatch.setattr(file_uploader, "load_uploaded_files", fake_load)
+    monkeypatch.setattr(file_uploader, "backoff_delay", lambda *args, **kwargs: 0)
+
+    async def runner() -> None:
+        await file_uploader.start_uploaded_files_listener()
+        first = connections[0]
+        first.on_terminate(first)
+        assert file_uploader._listen_connection is None
+        assert file_uploader._uploaded_files_loaded is False
+        await file_uploader._reconnect_task
+        assert file_uploader._listen_connection is connections[1]
+        assert reloads == [True]
+        await file_uploader.stop_uploaded_files_listener()
+        assert file_uploader._listen_connection is None and not file_uploader._listening
+
+    asyncio.run(runner())
+
+
+def test_failed_subscribe_closes_connection_and_failed_reload_invalidates_cache(monkeypatch) -> None:
+    class FakeConnection:
+        def __init__(self, fail) -> None:
+            self.fail = fail
+            self.closed = False
+
+        async def add_listener(self, channel, callback):
+            if self.fail:
+                raise RuntimeError("LISTEN failed")
+
+        def add_termination_listener(self, callback):
+            pass
+
+        async def close(self):
+            self.closed = True
+
+    connections = []
+
+    async def fake_connect_db():
+        # первая подписка падает, вторая удаётся
+        connections.append(FakeConnection(fail=not connections))
+        return connections[-1]
+
+    async def failing_load():
+        raise RuntimeError("db down")
+
+    async def noop(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(file_uploader, "UPLOADED_FILES_LISTEN", True)
+    monkeypatch.setattr(file_uploader, "connect_db", fake_connect_db)
+    monkeypatch.setattr(file_uploader, "load_uploaded_files", failing_load)
+    monkeypatch.setattr(file_uploader, "backoff_delay", lambda *args, **kwargs: 0)
+    monkeypatch.setattr(file_uploader, "_uploaded_files_loaded", True)
+    monkeypatch.setattr(file_uploader.logger, "error", noop)
+
+    async def runner() -> None:
+        await file_uploader.start_uploaded_files_listener()
+        await file_uploader._reconnect_task
+        assert connections[0].closed
+        assert file_uploader._listen_connection is connections[1]
+        # таблица не перечитана - кэш будет перечитан при следующем запросе
+        assert file_uploader._uploaded_files_loaded is False
+        await file_uploader.stop_uploaded_files_listener()
+
+    asyncio.run(runner())
+
+
+def test_save_file_id_keeps_memory_unchanged_when_insert_fails(monkeypatch) -> None:
+    class FailingDB:
+        async def execute(self, query, *args):
+            raise RuntimeError("db down")
+
+    @contextlib.asynccontextmanager
+    async def fake_acquire():
+        yield FailingDB()
+
+    monkeypatch.setattr(file_uploader, "acquire", fake_acquire)
+    monkeypatch.setattr(file_uploader, "_uploaded_files", {})
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(file_uploader.save_file_id("intro_d.mp4", "F4", "video", "h4"))
+    assert "intro_d.mp4" not in file_uploader._uploaded_files
+
+
+def test_prewarm_collects_unique_funnel_media() -> None:
+    import apps.media_prewarm as media_prewarm
+
+    funnel = {
+        "start": {"start": {"file": {"file_path": "media/a.png", "content_type": "image"}}},
+        "callback": {
+            "x": {"files": [
+                {"file_path": "media/a.png", "content_type": "image"},
+                {"file_path": "media/b.mp4", "content_type": "video", "thumbnail": "media/b.jpg"},
+            ]},
+            "y": {"actions": [{"func": "send", "file": {"file_path": "media/c.pdf"}}]},
+        },
+    }
+
+    media = media_prewarm.collect_media([funnel])
+
+    assert set(media) == {
+        ("media/a.png", "image"),
+        ("media/b.mp4", "video"),
+        ("media/c.pdf", "document"),
+    }
+    assert media[("media/b.mp4", "video")]["thumbnail"] == "media/b.jpg"
+
+
+def test_prewarm_saves_file_id_under_every_start_persona(tmp_path, monkeypatch) -> None:
+    import apps.media_prewarm as media_prewarm
+
+    media = tmp_path / "intro.mp4"
+    media.write_bytes(b"video")
+    file_path = str(media)
+    funnel = {"start": {"default": {}, "from_group": {}, "ph_mtt": {}}}
+    file_hash = asyncio.run(file_uploader.get_file_hash(file_path))
+    # под персоной default файл уже загружен, под остальными - нет
+    monkeypatch.setattr(file_uploader, "_uploaded_files", {
+        f"default_{file_path}": {"file_id": "F1", "content_type": "video", "hash": file_hash},
+    })
+    monkeypatch.setattr(file_uploader, "_uploaded_files_loaded", True)
+    saved = {}
+
+    async def fake_save(label, file_id, content_type, file_hash):
+        saved[label] = file_id
+
+    async def no_upload(*args, **kwargs):
+        raise AssertionError("файл уже загружен, повторная загрузка не нужна")
+
+    monkeypatch.setattr(file_uploader, "save_file_id", fake_save)
+    monkeypatch.setattr(file_uploader, "send_and_save_file", no_upload)
+
+    personas = media_prewarm.collect_personas([funnel])
+    assert personas == ["default", "from_group", "ph_mtt"]
+    assert asyncio.run(media_prewarm._upload(None, 1, {"file_path": file_path}, "video", personas))
+    assert saved == {f"from_group_{file_path}": "F1", f"ph_mtt_{file_path}": "F1"}
+
+
+def test_media_group_uploads_only_changed_files(tmp_path, monkeypatch) -> None:
+    from types import SimpleNamespace
+
+    paths = []
+    for name in ("a.png", "b.png", "c.png"):
+        path = tmp_path / name
+        path.write_bytes(name.encode())
+        paths.append(str(path))
+
+    stored = {
+        f"default_{paths[0]}": {"file_id": "A", "content_type": "image", "hash": "hash-a"},
+        f"default_{paths[2]}": {"file_id": "C", "content_type": "image", "hash": "hash-c"},
+    }
+    saved = {}
+
+    async def fake_get_file_id(label):
+        return stored.get(label)
+
+    async def fake_get_file_hash(filepath):
+        return "hash-" + Path(filepath).stem
+
+    async def fake_save_file_id(label, file_id, content_type, file_hash):
+        saved[label] = (file_id, file_hash)
+
+    async def fake_add_message(user_id, message_id):
+        return None
+
+    monkeypatch.setattr(file_uploader, "get_file_id", fake_get_file_id)
+    monkeypatch.setattr(file_uploader, "get_file_hash", fake_get_file_hash)
+    monkeypatch.setattr(file_uploader, "save_file_id", fake_save_file_id)
+    monkeypatch.setattr(file_uploader.message_manager, "add_message", fake_add_message)
+
+    class FakeBot:
+        async def send_media_group(self, chat_id, media):
+            self.media = media
+            return [
+                SimpleNamespace(message_id=index, photo=[SimpleNamespace(file_id=f"new-{index}")])
+                for index in range(len(media))
+            ]
+
+    bot = FakeBot()
+    files_group = [{"file_path": path, "tg_filename": None, "content_type": "image"} for path in paths]
+
+    result = asyncio.run(file_uploader.send_file_by_label(
+        bot=bot, chat_id=1, label="default", files_group=files_group, text="caption"
+    ))
+
+    assert result is True
+    # порядок сохранён: кэшированные file_id на своих местах, загружается только изменённый файл
+    assert bot.media[0].media == "A"
+    assert not isinstance(bot.media[1].media, str)
+    assert bot.media[2].media == "C"
+    assert bot.media[0].caption == "caption"
+    assert saved == {f"default_{paths[1]}": ("new-1", "hash-b")}
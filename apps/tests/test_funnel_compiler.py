@@ -0,0 +1,141 @@
+"""Tests for load-time funnel compilation (apps/funnel_compiler.py)."""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+
+from apps.funnel_compiler import CompiledNode, compile_funnel, node_actions, validate_funnels  # noqa: E402
+
+
+FUNNEL = {
+    "start": {
+        "default": {
+            "text": "Привет, {first_name}! Твой id: {user_id}, {unknown}",
+            "buttons": [[{"title": "Дальше", "callback": "next"}]],
+        },
+    },
+    "callback": {
+        "next": {
+            "text": "Ссылка ниже",
+            "buttons": [
+                [{"title": "Курс", "link": "https://example.com/?u={crypted_user_id}"}],
+                [{"title": "Назад", "callback": "done"}],
+            ],
+            "actions": [{"func": "check_subs"}, {"func": "send_amo", "is_ok": "done"}],
+        },
+        "done": {"text": "Готово", "action": {"func": "check_subs", "is_ok": "next"}},
+    },
+}
+
+
+def test_nodes_are_read_only_mappings() -> None:
+    compiled = compile_funnel(FUNNEL)
+    node = compiled["start"]["default"]
+
+    assert isinstance(node, CompiledNode)
+    assert node.get("buttons") == FUNNEL["start"]["default"]["buttons"]
+    try:
+        node["text"] = "changed"
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("CompiledNode must be read-only")
+
+
+def test_template_renders_known_fields_and_keeps_unknown() -> None:
+    node = compile_funnel(FUNNEL)["start"]["default"]
+
+    assert node.template.fields == {"first_name", "user_id", "unknown"}
+    text = node.template.render({"first_name": "Вася", "user_id": 42})
+    assert text == "Привет, Вася! Твой id: 42, {unknown}"
+
+
+def test_static_keyboard_is_prebuilt_and_dynamic_buttons_rerendered() -> None:
+    compiled = compile_funnel(FUNNEL)
+    static = compiled["start"]["default"].keyboard
+    dynamic = compiled["callback"]["next"].keyboard
+
+    assert static.render({}) is static.render({})
+    assert dynamic.static_markup is None
+    assert dynamic.fields == {"crypted_user_id"}
+    markup = dynamic.render({"crypted_user_id": "abc"})
+    assert markup.inline_keyboard[0][0].url == "https://example.com/?u=abc"
+    assert markup.inline_keyboard[1][0].callback_data == "done"
+
+
+def test_actions_are_normalized_with_next_route() -> None:
+    compiled = compile_funnel(FUNNEL)
+
+    actions, next_route = node_actions(compiled["callback"]["next"])
+    assert [action["func"] for action in actions] == ["check_subs", "send_amo"]
+    assert next_route == "done"
+
+    actions, next_route = node_actions(compiled["callback"]["done"])
+    assert len(actions) == 1 and next_route == "next"
+
+    # сырые словари (например, собранные в коде) обрабатываются так же
+    assert node_actions({"text": "x"}) == ((), None)
+    assert node_actions({"action": "oops"})[0] is None
+
+
+def test_validate_funnels_reports_broken_references() -> None:
+    funnels = {
+        "default": {
+            "start": {"default": {"text": "x", "buttons": [[{"title": "A", "callback": "missing"}]]}},
+            "callback": {
+                "orphan": {
+                    "text": "y",
+                    "action": {"func": "return_ok", "is_ok": "nowhere"},
+                    "notifications": [
+                        {"message": "ghost", "at_time": {"time": "10:00", "delta_days": 1}},
+                        {"message": "orphan", "at_time": {"time": "25:00"}},
+                    ],
+                    "file": {"file_path": "no/such/file.png", "content_type": "image"},
+                },
+            },
+        },
+    }
+
+    errors, warnings = validate_funnels(funnels, base_dir=ROOT_DIR)
+
+    assert any("callback 'missing'" in problem for problem in errors)
+    assert any("is_ok 'nowhere'" in problem for problem in errors)
+    assert any("'ghost'" in problem for problem in errors)
+    assert any("ЧЧ:ММ" in problem for problem in errors)
+    assert any("no/such/file.png" in problem for problem in errors)
+    assert warnings == ["[default] callback.orphan: недостижим из start"]
+
+
+def test_validate_funnels_accepts_valid_graph() -> None:
+    errors, warnings = validate_funnels({"x": compile_funnel(FUNNEL)})
+
+    assert errors == []
+    assert warnings == []
+
+
+def test_lazy_values_are_computed_once_per_message() -> None:
+    calls = []
+
+    class LazyValues(dict):
+        def __missing__(self, key):
+            if key != "crypted_user_id":
+                raise KeyError(key)
+            calls.append(key)
+            self[key] = "token"
+            return self[key]
+
+    node = compile_funnel({"callback": {"n": {
+        "text": "{crypted_user_id} {other}",
+        "buttons": [[{"title": "A", "link": "https://a/{crypted_user_id}"}], [{"title": "B", "web_app": "https://b/{crypted_user_id}"}]],
+    }}})["callback"]["n"]
+    values = LazyValues()
+
+    assert node.template.render(values) == "token {other}"
+    markup = node.keyboard.render(values)
+
+    assert markup.inline_keyboard[1][0].web_app.url == "https://b/token"
+    assert calls == ["crypted_user_id"]
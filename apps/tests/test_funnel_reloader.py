@@ -0,0 +1,80 @@
+"""Tests for funnel hot-reload (apps/funnel_reloader.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import modules  # noqa: E402
+import apps.funnel_reloader as funnel_reloader  # noqa: E402
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.records = []
+
+    async def info(self, text, **fields):
+        self.records.append(("info", text))
+
+    async def error(self, text, **fields):
+        self.records.append(("error", text))
+
+    async def debug(self, text, **fields):
+        self.records.append(("debug", text))
+
+
+def _write_funnel(directory: Path, text: str, callback: str = "next") -> None:
+    funnel = {
+        "start": {"default": {"text": text, "buttons": [[{"title": "Дальше", "callback": callback}]]}},
+        "callback": {"next": {"text": "Второй шаг"}},
+    }
+    (directory / "main.json").write_text(json.dumps(funnel, ensure_ascii=False), encoding="utf-8")
+
+
+def _setup(monkeypatch, tmp_path: Path) -> Recorder:
+    recorder = Recorder()
+    monkeypatch.setattr(modules, "FUNNELS_DIR", tmp_path)
+    monkeypatch.setattr(modules, "FALLBACK_MAP_PATH", tmp_path / "map.json")
+    monkeypatch.setattr(modules, "BASE_DIR", tmp_path)
+    monkeypatch.setattr(modules, "FUNNELS", {})
+    monkeypatch.setattr(modules, "MAP", {})
+    monkeypatch.setattr(funnel_reloader, "logger", recorder)
+    monkeypatch.setattr(funnel_reloader, "_current_errors", set())
+    monkeypatch.setattr(funnel_reloader.media_prewarm, "MEDIA_PREWARM_CHAT", None)
+    return recorder
+
+
+def test_reload_swaps_snapshot(monkeypatch, tmp_path) -> None:
+    _setup(monkeypatch, tmp_path)
+    _write_funnel(tmp_path, "Привет")
+    assert asyncio.run(funnel_reloader.reload_funnels("test"))
+    old_snapshot = modules.get_funnel("main")
+
+    _write_funnel(tmp_path, "Привет, обновлено")
+    assert asyncio.run(funnel_reloader.reload_funnels("test"))
+
+    assert modules.get_funnel("main")["start"]["default"]["text"] == "Привет, обновлено"
+    # обработчики, которые уже взяли старый снимок, дорабатывают на нём
+    assert old_snapshot["start"]["default"]["text"] == "Привет"
+
+
+def test_reload_rejects_new_errors_and_broken_json(monkeypatch, tmp_path) -> None:
+    recorder = _setup(monkeypatch, tmp_path)
+    _write_funnel(tmp_path, "Привет")
+    assert asyncio.run(funnel_reloader.reload_funnels("test"))
+
+    _write_funnel(tmp_path, "Сломано", callback="missing")
+    assert not asyncio.run(funnel_reloader.reload_funnels("test"))
+    assert modules.get_funnel("main")["start"]["default"]["text"] == "Привет"
+    assert any("callback 'missing'" in text for level, text in recorder.records if level == "error")
+
+    (tmp_path / "main.json").write_text("{not json", encoding="utf-8")
+    assert not asyncio.run(funnel_reloader.reload_funnels("test"))
+    assert modules.get_funnel("main")["start"]["default"]["text"] == "Привет"
@@ -0,0 +1,153 @@
+"""Tests for batched message-history sending (apps/history_batcher.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from collections import deque
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import apps.history_batcher as history_batcher  # noqa: E402
+
+
+def _fresh_spool(monkeypatch) -> None:
+    monkeypatch.setattr(history_batcher, "_spool", deque())
+    monkeypatch.setattr(history_batcher, "_ensure_flusher", lambda loop: None)
+
+
+def test_chat_order_is_kept_and_failed_tail_is_retried(monkeypatch) -> None:
+    _fresh_spool(monkeypatch)
+    sent = []
+    failing = {"b2"}
+
+    async def fake_send_one(body):
+        if body["content"] in failing:
+            return False
+        sent.append(body["content"])
+        return True
+
+    monkeypatch.setattr(history_batcher, "_send_one", fake_send_one)
+    clock = [1000.0]
+    monkeypatch.setattr(history_batcher, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(history_batcher, "backoff_delay", lambda attempt, base, cap: min(cap, base * 2 ** (attempt - 1)))
+
+    async def scenario():
+        for chat_id, content in [(1, "a1"), (2, "b1"), (1, "a2"), (2, "b2"), (2, "b3")]:
+            await history_batcher.add(chat_id=chat_id, author_id="-1", content=content)
+
+        assert await history_batcher.flush() == 3
+        # b3 не отправлен раньше b2, оба ждут повтора
+        assert sorted(sent) == ["a1", "a2", "b1"]
+        assert sent.index("a1") < sent.index("a2")
+        assert [entry["body"]["content"] for entry in history_batcher._spool] == ["b2", "b3"]
+        assert [entry["attempts"] for entry in history_batcher._spool] == [1, 1]
+
+        await history_batcher.add(chat_id=1, author_id="-1", content="a3")
+        await history_batcher.add(chat_id=2, author_id="-1", content="b4")
+        # до паузы повтора чат 2 ждёт, остальные чаты отправляются
+        assert await history_batcher.flush() == 1
+        assert sent[-1] == "a3"
+
+        # повтор снова неудачен - пауза удваивается
+        clock[0] += 1
+        assert await history_batcher.flush() == 0
+        assert history_batcher._spool[0]["next_attempt_at"] == clock[0] + 2
+
+        failing.clear()
+        clock[0] += 2
+        assert await history_batcher.flush() == 3
+        assert sent[-3:] == ["b2", "b3", "b4"]
+        assert history_batcher.pending() == 0
+
+    asyncio.run(scenario())
+
+
+def test_spool_drops_oldest_when_full(monkeypatch) -> None:
+    _fresh_spool(monkeypatch)
+    monkeypatch.setattr(history_batcher, "HISTORY_SPOOL_LIMIT", 2)
+
+    async def scenario():
+        for content in ["first", "second", "third"]:
+            await history_batcher.add(chat_id=1, author_id="-1", content=content)
+
+    asyncio.run(scenario())
+    assert [entry["body"]["content"] for entry in history_batcher._spool] == ["second", "third"]
+
+
+def test_entries_survive_outage_until_max_age(monkeypatch) -> None:
+    _fresh_spool(monkeypatch)
+    clock = [0.0]
+    monkeypatch.setattr(history_batcher, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(history_batcher, "HISTORY_MAX_AGE", 3600)
+
+    async def always_failing(body):
+        return False
+
+    monkeypatch.setattr(history_batcher, "_send_one", always_failing)
+
+    async def scenario():
+        await history_batcher.add(chat_id=1, author_id="-1", content="kept")
+        # долгий сбой бекенда: запись не теряется после нескольких неудачных попыток
+        for _ in range(20):
+            clock[0] += 60
+            await history_batcher.flush()
+        assert history_batcher.pending() == 1 and history_batcher._spool[0]["attempts"] == 20
+        clock[0] += 3600
+        await history_batcher.flush()
+        assert history_batcher.pending() == 0
+
+    asyncio.run(scenario())
+
+
+class FakeResponse:
+    def __init__(self, status, text) -> None:
+        self.status = status
+        self._text = text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def text(self):
+        return self._text
+
+
+def test_permanent_error_drops_entry_and_temporary_error_retries(monkeypatch) -> None:
+    _fresh_spool(monkeypatch)
+    responses = {
+        "bad": FakeResponse(400, "<html>Bad Request</html>"),
+        "busy": FakeResponse(503, "<html>Service Unavailable</html>"),
+    }
+    posted = []
+
+    class FakeSession:
+        def post(self, url, json, headers):
+            posted.append(json["content"])
+            return responses.get(json["content"], FakeResponse(200, '{"ok": true}'))
+
+    async def noop(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(history_batcher.http_clients, "session", lambda name: FakeSession())
+    monkeypatch.setattr(history_batcher, "get_host", lambda: "http://backend")
+    monkeypatch.setattr(history_batcher.logger, "error", noop)
+
+    async def scenario():
+        for content in ["bad", "after_bad"]:
+            await history_batcher.add(chat_id=1, author_id="-1", content=content)
+        for content in ["busy", "after_busy"]:
+            await history_batcher.add(chat_id=2, author_id="-1", content=content)
+        return await history_batcher.flush()
+
+    # 400 с HTML-страницей не повторяется и не держит чат, 503 - повторяется
+    # отброшенная запись больше не в очереди, как и отправленная
+    assert asyncio.run(scenario()) == 2
+    assert posted.count("after_bad") == 1 and "after_busy" not in posted
+    assert [entry["body"]["content"] for entry in history_batcher._spool] == ["busy", "after_busy"]
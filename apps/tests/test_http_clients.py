@@ -0,0 +1,31 @@
+"""Tests for shared per-upstream HTTP sessions (apps/http_clients.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import apps.http_clients as http_clients  # noqa: E402
+
+
+def test_session_is_reused_per_upstream_and_recreated_after_close() -> None:
+    async def scenario():
+        first = http_clients.session("backend")
+        assert http_clients.session("backend") is first
+        assert http_clients.session("jivo") is not first
+        assert first.timeout.total == http_clients.UPSTREAMS["backend"][1]
+        assert first.connector.limit == http_clients.UPSTREAMS["backend"][0]
+
+        await http_clients.close()
+        assert first.closed
+        second = http_clients.session("backend")
+        assert second is not first and not second.closed
+        await http_clients.close()
+
+    asyncio.run(scenario())
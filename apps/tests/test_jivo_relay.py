@@ -0,0 +1,209 @@
+"""Tests for the background per-user JIVO relay and queue drainer (apps/jivo_relay.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import importlib
+import os
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+from apps import resilience  # noqa: E402
+from apps.bot_info import bot_info  # noqa: E402
+
+
+def _message(user_id, text=None, photo_id=None):
+    user = SimpleNamespace(id=user_id, username=None, full_name=f"user {user_id}")
+    photo = [SimpleNamespace(file_id=photo_id)] if photo_id else None
+    return SimpleNamespace(from_user=user, text=text, photo=photo, video=None, document=None, voice=None)
+
+
+class FakeJivo:
+    """Стаб apps.funcs: очередь jivo_integration_queue в памяти и запись отправленного"""
+
+    def __init__(self) -> None:
+        self.rows = []
+        self.sent = []
+        self.history = []
+        self.claims = []
+        self.available = True
+
+    def queue(self, user_id, text, source, **files):
+        self.rows.append({
+            "id": len(self.rows) + 1, "user_id": user_id, "text": text, "source": source, "active": True, "claimed": False,
+            "create_at": None, "file_type": files.get("file_type"), "file_path": files.get("file_path"),
+            "file_name": files.get("file_name"),
+        })
+
+    async def claim_jivo_integration_queue(self, user_id, sources=("ph", "relay")):
+        self.claims.append((user_id, tuple(sources)))
+        rows = [
+            row for row in self.rows
+            if row["user_id"] == user_id and row["active"] and row["source"] in sources
+        ]
+        free = [row for row in rows if not row["claimed"]]
+        for row in free:
+            row["claimed"] = True
+        return [dict(row) for row in free], len(free) < len(rows)
+
+    async def release_jivo_integration_queue(self, claimed_ids, delivered_ids):
+        for row in self.rows:
+            if row["id"] in claimed_ids:
+                row["claimed"] = False
+                row["active"] = row["active"] and row["id"] not in delivered_ids
+
+    async def add_msg_to_jivo_integration_queue(self, user_id, text, source="ph", **files):
+        self.queue(user_id, text, source, **files)
+
+    async def expire_jivo_integration_queue(self):
+        return 0
+
+    async def get_users_with_jivo_relay_queue(self, limit):
+        return sorted({row["user_id"] for row in self.rows if row["active"] and row["source"] == "relay"})[:limit]
+
+    async def post_to_jivo(self, user_id, text=None, file_path=None, **kwargs):
+        if not self.available:
+            raise resilience.CircuitOpenError("down")
+        await asyncio.sleep(0)
+        self.sent.append((user_id, text or file_path))
+        return {"file_name": "f", "original_file_name": "o"}
+
+    async def send_to_jivo(self, user_id, text=None, file_path=None, spill_as="relay", **kwargs):
+        return await self.post_to_jivo(user_id, text=text, file_path=file_path, **kwargs)
+
+    async def add_msg_to_history(self, chat_id, author_id, content, type="text", name=None):
+        self.history.append((chat_id, content))
+
+
+class FakeDB:
+    pass
+
+
+@pytest.fixture
+def relay(monkeypatch):
+    jivo = FakeJivo()
+    # настоящий apps.funcs требует окружения бота, подменяем его до импорта
+    monkeypatch.setitem(sys.modules, "apps.funcs", jivo)
+    # после теста модуль со стабом убирается из sys.modules
+    monkeypatch.setitem(sys.modules, "apps.jivo_relay", None)
+    del sys.modules["apps.jivo_relay"]
+    jivo_relay = importlib.import_module("apps.jivo_relay")
+
+    @asynccontextmanager
+    async def fake_acquire():
+        yield FakeDB()
+
+    async def fake_load_profiles(db, user_ids):
+        return 0
+
+    monkeypatch.setattr(jivo_relay, "acquire", fake_acquire)
+    monkeypatch.setattr(jivo_relay.user_profiles, "load_profiles", fake_load_profiles)
+    monkeypatch.setattr(bot_info, "get_username", lambda: "bot")
+    return jivo_relay, jivo
+
+
+def test_messages_are_relayed_in_order_with_files_resolved_upfront(relay) -> None:
+    jivo_relay, jivo = relay
+    jivo.queue(1, "ph", "ph")
+    resolving = []
+
+    class FakeBot:
+        async def get_file(self, file_id):
+            resolving.append(file_id)
+            await asyncio.sleep(0.01)
+            return SimpleNamespace(file_path=f"path/{file_id}")
+
+    async def scenario():
+        bot = FakeBot()
+        for photo_id in ["p1", "p2", "p3"]:
+            jivo_relay.enqueue(bot, _message(1, photo_id=photo_id))
+        jivo_relay.enqueue(bot, _message(1, text="hello"))
+        jivo_relay.enqueue(bot, _message(2, text="other"))
+        # все пути вложений запрошены до начала пересылки
+        await asyncio.sleep(0)
+        assert sorted(resolving) == ["p1", "p2", "p3"]
+        await jivo_relay.close()
+
+    asyncio.run(scenario())
+
+    assert [item for item in jivo.sent if item[0] == 1] == [
+        (1, "ph\n\n\n"), (1, "path/p1"), (1, "path/p2"), (1, "path/p3"), (1, "hello"),
+    ]
+    assert (2, "other") in jivo.sent
+    # сообщение ПХ в историю повторно не пишется
+    assert (1, "ph\n\n\n") not in jivo.history and (1, "hello") in jivo.history
+    assert not any(row["active"] for row in jivo.rows)
+    assert jivo_relay.pending() == 0 and not jivo_relay._workers
+
+
+def test_outage_spills_new_message_behind_queued_ones_and_drainer_replays_them(relay) -> None:
+    jivo_relay, jivo = relay
+    jivo.queue(1, "ph", "ph")
+    jivo.queue(1, "earlier", "relay")
+    jivo.available = False
+
+    async def outage():
+        jivo_relay.enqueue(None, _message(1, text="hello"))
+        await jivo_relay.close()
+
+    asyncio.run(outage())
+    assert jivo.sent == []
+    assert [(row["text"], row["source"], row["active"]) for row in jivo.rows] == [
+        ("ph", "ph", True), ("earlier", "relay", True), ("hello", "relay", True),
+    ]
+
+    # фоновый разборщик досылает только отложенные сообщения юзера, без триггеров ПХ
+    jivo.available = True
+    assert asyncio.run(jivo_relay.drain_queue()) == 1
+    assert (1, ("relay",)) in jivo.claims
+    assert jivo.sent == [(1, "earlier"), (1, "hello")]
+    assert jivo.history == [(1, "earlier"), (1, "hello")]
+    assert [row["active"] for row in jivo.rows] == [True, False, False]
+    assert not any(row["claimed"] for row in jivo.rows)
+
+
+def test_rows_leased_by_another_process_make_new_message_wait(relay) -> None:
+    jivo_relay, jivo = relay
+    jivo.queue(1, "earlier", "relay")
+    # сообщение досылает другая копия бота
+    jivo.rows[0]["claimed"] = True
+
+    async def scenario():
+        jivo_relay.enqueue(None, _message(1, text="hello"))
+        await jivo_relay.close()
+
+    asyncio.run(scenario())
+    assert jivo.sent == []
+    assert [(row["text"], row["active"]) for row in jivo.rows] == [("earlier", True), ("hello", True)]
+
+
+def test_close_cancels_stuck_workers_and_spills_their_messages(relay, monkeypatch) -> None:
+    jivo_relay, jivo = relay
+    monkeypatch.setattr(jivo_relay, "JIVO_RELAY_SHUTDOWN_TIMEOUT", 0.05)
+    jivo.queue(1, "earlier", "relay")
+
+    async def hanging_post(user_id, text=None, file_path=None, **kwargs):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(jivo, "post_to_jivo", hanging_post)
+
+    async def scenario():
+        jivo_relay.enqueue(None, _message(1, text="hello"))
+        jivo_relay.enqueue(None, _message(1, text="again"))
+        await asyncio.sleep(0.01)
+        await jivo_relay.close()
+
+    asyncio.run(scenario())
+    assert jivo_relay.pending() == 0 and not jivo_relay._workers
+    # взятая в работу строка отпущена, оставшиеся сообщения отложены за ней по порядку
+    assert [(row["text"], row["active"], row["claimed"]) for row in jivo.rows] == [
+        ("earlier", True, False), ("hello", True, False), ("again", True, False),
+    ]
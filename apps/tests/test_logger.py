@@ -0,0 +1,91 @@
+"""Tests for the queue-based logger in apps/logger.py."""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+
+import importlib  # noqa: E402
+
+logger = importlib.import_module("apps.logger")
+# тесты уведомлений подменяют apps.logger заглушкой - берём настоящий модуль
+if not hasattr(logger, "flush"):
+    sys.modules.pop("apps.logger")
+    logger = importlib.import_module("apps.logger")
+
+
+def test_records_are_batched_with_caller_context(monkeypatch) -> None:
+    batches = []
+    monkeypatch.setattr(logger, "_write_batch", batches.append)
+    monkeypatch.setattr(logger, "LOG_LEVEL", logger.INFO)
+
+    async def send_media() -> None:
+        await logger.debug("skipped")
+        await logger.info("first")
+        await logger.error("second")
+
+    async def runner() -> None:
+        await send_media()
+        # до флеша ничего не выведено - вызов логгера только ставит запись в очередь
+        assert batches == []
+        await logger.flush()
+
+    asyncio.run(runner())
+
+    records = [record for batch in batches for record in batch]
+    assert [record[4] for record in records] == ["first", "second"]
+    assert records[0][3] == "send_media"
+    assert records[0][2] == __name__
+
+
+def test_json_records_carry_context_and_timings(monkeypatch) -> None:
+    batches = []
+    monkeypatch.setattr(logger, "_write_batch", batches.append)
+    monkeypatch.setattr(logger, "LOG_LEVEL", logger.DEBUG)
+    monkeypatch.setattr(logger, "LOG_FORMAT", "json")
+
+    async def runner() -> None:
+        with logger.log_context(user_id=42, update_type="message") as context:
+            logger.add_timing("db", 0.0125)
+            await logger.info("done", duration_ms=20.0, **logger.timings_ms(context))
+        await logger.flush()
+
+    asyncio.run(runner())
+
+    payload = json.loads(logger._format(batches[0][0]))
+    assert payload["user_id"] == 42
+    assert payload["update_type"] == "message"
+    assert payload["db_ms"] == 12.5
+    assert payload["duration_ms"] == 20.0
+    assert payload["level"] == "INFO"
+    assert payload["message"] == "done"
+
+
+def test_flush_and_background_writer_keep_batches_in_order(monkeypatch) -> None:
+    batches = []
+
+    def slow_write(batch):
+        import time
+        time.sleep(0.01)
+        batches.append([record[4] for record in batch])
+
+    monkeypatch.setattr(logger, "_write_batch", slow_write)
+    monkeypatch.setattr(logger, "LOG_LEVEL", logger.INFO)
+    monkeypatch.setattr(logger, "LOG_BATCH_SIZE", 1)
+
+    async def runner() -> None:
+        await logger.info("first")
+        await logger.info("second")
+        # фоновая задача начинает вывод, flush вызывается одновременно с ней
+        await asyncio.sleep(0)
+        await logger.info("third")
+        await logger.flush()
+
+    asyncio.run(runner())
+
+    assert batches == [["first"], ["second"], ["third"]]
@@ -2,6 +2,7 @@
 Тесты для проверки логики догревочных (warmup) уведомлений
 """
 import asyncio
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Any, Dict, List
@@ -36,6 +37,11 @@ async def _log_stub(*args, **kwargs):
 logger_stub.info = _log_stub
 logger_stub.error = _log_stub
 logger_stub.debug = _log_stub
+@contextmanager
+def _log_context_stub(**fields):
+    yield {"fields": fields, "timings": {}}
+logger_stub.log_context = _log_context_stub
+logger_stub.timings_ms = lambda context: {}
 sys.modules.setdefault("apps.logger", logger_stub)
 
 from apps.notifier import SmartNotifier
@@ -59,6 +65,9 @@ class FakeDB:
         self.events: Dict[int, List[str]] = events or {}  # {user_id: [event_type, ...]}
         self.user_funnel: Dict[int, List[str]] = user_funnel or {}  # {user_id: [label, ...]}
         self.closed = False
+        self.activity_queries = 0
+        self.profile_queries = 0
+        self.executemany_calls = 0
         self._next_notification_id = (
             max((item["id"] for item in self.notifications), default=0) + 1
         )
@@ -80,6 +89,8 @@ class FakeDB:
             self._set_active_by_label(*args)
         elif normalized.startswith("INSERT INTO user_history"):
             return
+        elif "user_activity_stats" in normalized:
+            return
         # НОВОЕ: Обработка UPDATE с перерасчётом времени (для одного уведомления)
         elif "UPDATE notifications SET is_active = true" in normalized and "time_to_send = $1" in normalized and "WHERE id = $2" in normalized:
             new_time = args[0]
@@ -103,6 +114,11 @@ class FakeDB:
         else:
             raise AssertionError(f"Unsupported query in FakeDB: {query}")
 
+    async def executemany(self, query: str, args_list) -> None:
+        self.executemany_calls += 1
+        for args in args_list:
+            await self.execute(query, *args)
+
     async def fetch(self, query: str, *args: Any) -> List[Dict[str, Any]]:
         normalized = " ".join(query.split())
 
@@ -114,6 +130,34 @@ class FakeDB:
                 for item in self._iter_notifications(now)
             ]
 
+        # Пакетная проверка активности (check_users_activity)
+        if "FROM user_activity_stats s" in normalized:
+            self.activity_queries += 1
+            return [
+                {
+                    "user_id": user_id,
+                    "last_activity": self.users[user_id].get("last_activity"),
+                    "first_notification": self.users[user_id].get("first_notification"),
+                    "notifications_sent": self.users[user_id].get("notifications_sent", 0),
+                }
+                for user_id in args[0]
+                if user_id in self.users
+            ]
+
+        # Профили для плейсхолдеров (user_profiles.load_profiles)
+        if "SELECT id, username, first_name, last_name FROM users" in normalized:
+            self.profile_queries += 1
+            return [
+                {
+                    "id": user_id,
+                    "username": self.users[user_id].get("username"),
+                    "first_name": self.users[user_id].get("first_name"),
+                    "last_name": self.users[user_id].get("last_name"),
+                }
+                for user_id in args[0]
+                if user_id in self.users
+            ]
+
         # НОВОЕ: Получение приостановленных уведомлений для возобновления
         if "SELECT id, label, time_to_send FROM notifications" in normalized and "pause_reason = 'inactivity'" in normalized:
             user_id = args[0]
@@ -145,10 +189,16 @@ class FakeDB:
                 for label in user_labels
             ) else 0
 
+            has_warmup = any(
+                n['user_id'] == user_id and n['label'].startswith('warmup_') and n['is_active']
+                for n in self.notifications
+            )
+
             return {
                 "timestamp_registration": datetime.now(),
                 "is_registered": is_registered,
                 "in_course_funnel": in_course_funnel,
+                "has_warmup": has_warmup,
                 "last_activity": datetime.now()
             }
 
@@ -214,25 +264,29 @@ class FakeDB:
 
     # Helpers
     async def _handle_insert(self, query: str, *args: Any) -> None:
-        user_id, send_time, label, is_active = args
+        user_id, send_time, label, is_active, *rest = args
+        funnel_name = rest[0] if rest else None
         send_time = int(send_time)
         existing = self._find_notification(user_id=user_id, label=label)
         if "DO UPDATE" in query:
             if existing:
-                existing.update(time_to_send=send_time, is_active=is_active)
+                existing.update(time_to_send=send_time, is_active=is_active, funnel_name=funnel_name)
             else:
-                self._add_notification(user_id, send_time, label, is_active)
+                self._add_notification(user_id, send_time, label, is_active, funnel_name)
         else:
             if not existing:
-                self._add_notification(user_id, send_time, label, is_active)
+                self._add_notification(user_id, send_time, label, is_active, funnel_name)
 
-    def _add_notification(self, user_id: int, send_time: int, label: str, is_active: bool) -> None:
+    def _add_notification(
+        self, user_id: int, send_time: int, label: str, is_active: bool, funnel_name: str | None = None
+    ) -> None:
         self.notifications.append({
             "id": self._next_notification_id,
             "user_id": user_id,
             "time_to_send": send_time,
             "label": label,
             "is_active": is_active,
+            "funnel_name": funnel_name,
         })
         self._next_notification_id += 1
 
@@ -281,6 +335,14 @@ class FakeDB:
         return results
 
 
+def fake_acquire(fake_db: FakeDB):
+    """Подменяет modules.acquire: отдаёт FakeDB вместо соединения из пула"""
+    @asynccontextmanager
+    async def acquire():
+        yield fake_db
+    return acquire
+
+
 # ============================================================================
 # ТЕСТЫ ДЛЯ ДОГРЕВОЧНЫХ УВЕДОМЛЕНИЙ
 # ============================================================================
@@ -297,11 +359,8 @@ def test_warmup_adds_for_new_unregistered_user(monkeypatch) -> None:
             user_funnel={}  # НЕТ в воронке
         )
 
-        async def fake_connect() -> FakeDB:
-            return fake_db
-
         notifier = SmartNotifier()
-        monkeypatch.setattr("apps.notifier.create_connect", fake_connect)
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
 
         base_timestamp = 1_700_000_000
         monkeypatch.setattr("apps.notifier.time.time", lambda: base_timestamp)
@@ -329,6 +388,9 @@ def test_warmup_adds_for_new_unregistered_user(monkeypatch) -> None:
         for expected in expected_warmup:
             assert expected in warmup_labels, f"Отсутствует {expected}"
 
+        # догрев и обычные уведомления пишутся пачками, а не INSERT на каждое
+        assert fake_db.executemany_calls == 2
+
     asyncio.run(runner())
     print("✅ Тест 1: Догрев добавляется для новых пользователей")
 
@@ -345,11 +407,8 @@ def test_warmup_not_added_for_registered_user(monkeypatch) -> None:
             user_funnel={501: ['spin']}  # В воронке
         )
 
-        async def fake_connect() -> FakeDB:
-            return fake_db
-
         notifier = SmartNotifier()
-        monkeypatch.setattr("apps.notifier.create_connect", fake_connect)
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
 
         base_timestamp = 1_700_000_000
         monkeypatch.setattr("apps.notifier.time.time", lambda: base_timestamp)
@@ -390,11 +449,8 @@ def test_warmup_not_added_for_user_in_funnel(monkeypatch) -> None:
             user_funnel={502: ['free_learning', 'spin']}  # В воронке курса
         )
 
-        async def fake_connect() -> FakeDB:
-            return fake_db
-
         notifier = SmartNotifier()
-        monkeypatch.setattr("apps.notifier.create_connect", fake_connect)
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
 
         base_timestamp = 1_700_000_000
         monkeypatch.setattr("apps.notifier.time.time", lambda: base_timestamp)
@@ -441,11 +497,8 @@ def test_warmup_not_duplicated(monkeypatch) -> None:
             ]
         )
 
-        async def fake_connect() -> FakeDB:
-            return fake_db
-
         notifier = SmartNotifier()
-        monkeypatch.setattr("apps.notifier.create_connect", fake_connect)
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
         monkeypatch.setattr("apps.notifier.time.time", lambda: base_timestamp)
 
         await notifier.add_notifications(
@@ -495,11 +548,8 @@ def test_warmup_skipped_when_user_registers(monkeypatch) -> None:
             ]
         )
 
-        async def fake_connect() -> FakeDB:
-            return fake_db
-
         notifier = SmartNotifier()
-        monkeypatch.setattr("apps.notifier.create_connect", fake_connect)
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
         monkeypatch.setattr("apps.notifier.time.time", lambda: base_timestamp)
 
         # Имитируем возобновление уведомлений
@@ -516,6 +566,127 @@ def test_warmup_skipped_when_user_registers(monkeypatch) -> None:
     print("✅ Тест 5: Догрев пропускается при возобновлении для зарегистрированных")
 
 
+# ============================================================================
+# ТЕСТЫ ПРОВЕРКИ АКТИВНОСТИ
+# ============================================================================
+
+def test_activity_checked_once_per_user_in_batch(monkeypatch) -> None:
+    """
+    Тест 6: Активность проверяется одним запросом на всю пачку, неактивный
+    пользователь ставится на паузу, активному уходят все его уведомления
+    """
+    async def runner() -> None:
+        fake_db = FakeDB(
+            users={
+                600: {"username": "active", "last_activity": datetime.now() - timedelta(days=1)},
+                601: {"username": "sleeping", "last_activity": datetime.now() - timedelta(days=90)},
+            },
+        )
+
+        notifier = SmartNotifier()
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
+
+        sent, paused = [], []
+
+        async def fake_send(notification):
+            sent.append(notification["id"])
+
+        async def fake_pause(user_id):
+            paused.append(user_id)
+
+        monkeypatch.setattr(notifier, "send_notification", fake_send)
+        monkeypatch.setattr(notifier, "pause_user_notifications", fake_pause)
+
+        notifications = [
+            {"id": 1, "user_id": 600, "label": "a", "time_to_send": 0},
+            {"id": 2, "user_id": 600, "label": "b", "time_to_send": 0},
+            {"id": 3, "user_id": 601, "label": "a", "time_to_send": 0},
+            {"id": 4, "user_id": 602, "label": "a", "time_to_send": 0},  # нет статистики - новый пользователь
+        ]
+        activity = await notifier.check_users_activity(n["user_id"] for n in notifications)
+        await notifier.process_notifications(notifications, activity)
+
+        assert fake_db.activity_queries == 1
+        assert activity == {600: True, 601: False, 602: True}
+        assert sent == [1, 2, 4]
+        assert paused == [601]
+
+    asyncio.run(runner())
+    print("✅ Тест 6: Активность проверяется пакетно")
+
+
+def test_activity_verdict_uses_utc_clock(monkeypatch) -> None:
+    """
+    Тест 6.1: last_activity хранится в UTC, поэтому проверка не зависит от часового
+    пояса сервера (локальные часы на 5 часов впереди UTC)
+    """
+    utc_now = datetime(2026, 3, 1, 12, 0)
+
+    class ShiftedClock(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return utc_now + timedelta(hours=5)
+
+        @classmethod
+        def utcnow(cls):
+            return utc_now
+
+    async def runner() -> None:
+        fake_db = FakeDB(
+            users={
+                # 14 дней 22 часа без реакции на 11 уведомлений - ещё в пределах 2 недель
+                700: {
+                    "username": "quiet",
+                    "last_activity": utc_now - timedelta(days=14, hours=22),
+                    "notifications_sent": 11,
+                },
+            },
+        )
+        notifier = SmartNotifier()
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
+        monkeypatch.setattr("apps.notifier.datetime", ShiftedClock)
+
+        assert await notifier.check_users_activity([700]) == {700: True}
+
+    asyncio.run(runner())
+
+
+def test_notification_funnel_survives_restart(monkeypatch) -> None:
+    """
+    Тест 7: Воронка уведомления пишется в строку notifications, поэтому новый
+    экземпляр рассыльщика (после рестарта) берёт её из строки, а не из памяти
+    """
+    async def runner() -> None:
+        fake_db = FakeDB(users={700: {"username": "funnel"}}, events={700: ["course_registration"]})
+
+        notifier = SmartNotifier()
+        monkeypatch.setattr("apps.notifier.acquire", fake_acquire(fake_db))
+        await notifier.add_notifications(
+            user_id=700,
+            notifications=[{"message": "mtt_reminder", "at_time": {"wait_seconds": 60}}],
+            funnel_name="MTT",
+        )
+
+        row = fake_db._find_notification(user_id=700, label="mtt_reminder")
+        assert row["funnel_name"] == "mtt"
+
+        restarted = SmartNotifier()
+        assert restarted._resolve_notification_funnel(row) == "mtt"
+        assert restarted._resolve_notification_funnel({"user_id": 700, "label": "old"}) == "default"
+
+    asyncio.run(runner())
+    print("✅ Тест 7: Воронка уведомления хранится в БД")
+
+
+def test_notification_funnel_cache_is_bounded() -> None:
+    notifier = SmartNotifier()
+    notifier.FUNNEL_CACHE_LIMIT = 3
+    for label in ("a", "b", "c", "d"):
+        notifier._remember_notification_funnel(1, label, "mtt")
+
+    assert list(notifier._notification_funnels) == [(1, "b"), (1, "c"), (1, "d")]
+
+
 # ============================================================================
 # ЗАПУСК ВСЕХ ТЕСТОВ
 # ============================================================================
@@ -533,6 +704,9 @@ if __name__ == "__main__":
     test_warmup_not_added_for_user_in_funnel(pytest.MonkeyPatch())
     test_warmup_not_duplicated(pytest.MonkeyPatch())
     test_warmup_skipped_when_user_registers(pytest.MonkeyPatch())
+    test_activity_checked_once_per_user_in_batch(pytest.MonkeyPatch())
+    test_notification_funnel_survives_restart(pytest.MonkeyPatch())
+    test_notification_funnel_cache_is_bounded()
 
     print("\n" + "="*70)
     print("ВСЕ ТЕСТЫ ДОГРЕВА ПРОЙДЕНЫ УСПЕШНО ✅")
@@ -0,0 +1,83 @@
+"""Tests for the Telegram send rate limiter (apps/rate_limiter.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+from aiogram.exceptions import TelegramRetryAfter  # noqa: E402
+from aiogram.methods import SendChatAction, SendMediaGroup, SendMessage  # noqa: E402
+from aiogram.types import InputMediaPhoto  # noqa: E402
+
+import apps.rate_limiter as rate_limiter  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_token_bucket_allows_burst_then_spaces(monkeypatch) -> None:
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "monotonic", clock)
+    bucket = rate_limiter.TokenBucket(rate=1, burst=3)
+
+    delays = [bucket.reserve("chat") for _ in range(5)]
+
+    assert delays == [0.0, 0.0, 0.0, 1.0, 2.0]
+    # другой чат не ждёт
+    assert bucket.reserve("other") == 0.0
+
+
+def test_middleware_retries_after_telegram_retry_after(monkeypatch) -> None:
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(rate_limiter.asyncio, "sleep", fake_sleep)
+    limiter = rate_limiter.TelegramRateLimiter(rate=1000, chat_rate=1000)
+    middleware = rate_limiter.RateLimitMiddleware(limiter)
+    method = SendMessage(chat_id=1, text="hi")
+    calls = []
+
+    async def make_request(bot, method):
+        calls.append(method)
+        if len(calls) == 1:
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=3)
+        return "ok"
+
+    result = asyncio.run(middleware(make_request, None, method))
+
+    assert result == "ok"
+    assert len(calls) == 2
+    # повтор ждал паузу, выставленную по retry_after
+    assert any(delay > 2 for delay in sleeps)
+
+
+def test_chat_action_is_not_limited() -> None:
+    assert not rate_limiter.is_counted(SendChatAction(chat_id=1, action="typing"))
+    assert rate_limiter.is_counted(SendMessage(chat_id=1, text="hi"))
+
+
+def test_media_group_is_charged_per_item(monkeypatch) -> None:
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "monotonic", clock)
+    album = SendMediaGroup(chat_id=1, media=[InputMediaPhoto(media=f"photo{index}") for index in range(3)])
+    assert rate_limiter.message_cost(album) == 3
+    assert rate_limiter.message_cost(SendMessage(chat_id=1, text="hi")) == 1
+
+    bucket = rate_limiter.TokenBucket(rate=1, burst=2)
+    # альбом из 3 файлов не помещается в запас из 2 - ждёт один слот
+    assert bucket.reserve("chat", cost=3) == 1.0
+    # следующее сообщение - после всех файлов альбома
+    assert bucket.reserve("chat") == 2.0
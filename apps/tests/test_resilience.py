@@ -0,0 +1,94 @@
+"""Tests for retries with backoff and the circuit breaker (apps/resilience.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import apps.resilience as resilience  # noqa: E402
+
+
+def test_backoff_is_jittered_and_capped() -> None:
+    for attempt in range(1, 10):
+        delay = resilience.backoff_delay(attempt, base=0.5, cap=4)
+        assert 0 <= delay <= min(4, 0.5 * 2 ** (attempt - 1))
+
+
+def test_breaker_opens_fails_fast_and_closes_after_probe(monkeypatch) -> None:
+    monkeypatch.setattr(resilience, "backoff_delay", lambda *args: 0)
+    clock = [100.0]
+    monkeypatch.setattr(resilience, "monotonic", lambda: clock[0])
+    breaker = resilience.CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    calls = []
+
+    async def failing():
+        calls.append("fail")
+        raise resilience.RetryableError("503")
+
+    async def healthy():
+        calls.append("ok")
+        return "done"
+
+    async def scenario():
+        with pytest.raises(resilience.RetryableError):
+            await resilience.retry(failing, breaker=breaker, attempts=3)
+        assert breaker.is_open and len(calls) == 3
+
+        # пока цепь разомкнута, запрос не выполняется
+        with pytest.raises(resilience.CircuitOpenError):
+            await resilience.retry(healthy, breaker=breaker)
+        assert len(calls) == 3
+
+        # после reset_timeout пробный запрос замыкает цепь
+        clock[0] += 31
+        assert await resilience.retry(healthy, breaker=breaker) == "done"
+        assert not breaker.is_open and breaker.failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_non_retryable_error_is_raised_immediately() -> None:
+    breaker = resilience.CircuitBreaker("test", failure_threshold=1)
+    calls = []
+
+    async def bad_request():
+        calls.append(1)
+        raise ValueError("400")
+
+    with pytest.raises(ValueError):
+        asyncio.run(resilience.retry(bad_request, breaker=breaker, attempts=3))
+    assert calls == [1] and not breaker.is_open
+
+
+def test_cancelled_probe_lets_the_next_probe_through(monkeypatch) -> None:
+    clock = [100.0]
+    monkeypatch.setattr(resilience, "monotonic", lambda: clock[0])
+    breaker = resilience.CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+
+    async def hanging():
+        await asyncio.sleep(3600)
+
+    async def healthy():
+        return "done"
+
+    async def scenario():
+        await breaker.record_failure()
+        clock[0] += 31
+        probe = asyncio.create_task(resilience.retry(hanging, breaker=breaker))
+        await asyncio.sleep(0)
+        assert breaker.probing
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert not breaker.probing
+        assert await resilience.retry(healthy, breaker=breaker) == "done"
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+"""Tests for the user profile cache (apps/user_profiles.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import apps.user_profiles as user_profiles  # noqa: E402
+
+
+class FakeDB:
+    def __init__(self, users) -> None:
+        self.users = users
+        self.queries = 0
+
+    async def fetch(self, query, user_ids):
+        self.queries += 1
+        return [{"id": user_id, **self.users[user_id]} for user_id in user_ids if user_id in self.users]
+
+
+class FakeBot:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    async def get_chat(self, user_id):
+        self.calls += 1
+        raise RuntimeError("chat not found")
+
+
+def _setup(monkeypatch, fake_db):
+    @asynccontextmanager
+    async def acquire():
+        yield fake_db
+
+    monkeypatch.setattr(user_profiles, "_profiles", user_profiles.OrderedDict())
+    monkeypatch.setattr(user_profiles, "acquire", acquire)
+
+
+def test_profile_comes_from_users_table_then_cache(monkeypatch) -> None:
+    fake_db = FakeDB({7: {"username": "Unknown", "first_name": "Вася", "last_name": None}})
+    _setup(monkeypatch, fake_db)
+    bot = FakeBot()
+
+    first = asyncio.run(user_profiles.get_profile(bot, 7))
+    second = asyncio.run(user_profiles.get_profile(bot, 7))
+
+    assert first == {"username": None, "first_name": "Вася", "last_name": None}
+    assert second == first
+    assert fake_db.queries == 1
+    assert bot.calls == 0
+
+
+def test_unknown_user_falls_back_to_default(monkeypatch) -> None:
+    _setup(monkeypatch, FakeDB({}))
+    bot = FakeBot()
+
+    profile = asyncio.run(user_profiles.get_profile(bot, 8))
+
+    assert profile == user_profiles.DEFAULT_PROFILE
+    assert bot.calls == 1
+
+
+def test_cache_expires_and_is_bounded(monkeypatch) -> None:
+    _setup(monkeypatch, FakeDB({}))
+    monkeypatch.setattr(user_profiles, "PROFILE_CACHE_LIMIT", 2)
+
+    for user_id in (1, 2, 3):
+        user_profiles.remember(user_id, first_name=str(user_id))
+    assert user_profiles.cached(1) is None
+    assert user_profiles.cached(3)["first_name"] == "3"
+
+    monkeypatch.setattr(user_profiles, "PROFILE_TTL", -1)
+    user_profiles.remember(4, first_name="4")
+    assert user_profiles.cached(4) is None
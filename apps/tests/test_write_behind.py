@@ -0,0 +1,133 @@
+"""Tests for the analytics write-behind buffer (apps/write_behind.py)."""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("BOT_TOKEN", "123456:ABCDEF")
+
+import apps.write_behind as write_behind  # noqa: E402
+
+
+class FakeDB:
+    def __init__(self) -> None:
+        self.copies = {}
+        self.statements = []
+        self.fail = False
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def copy_records_to_table(self, table, records, columns):
+        if self.fail:
+            raise RuntimeError("connection lost")
+        self.copies.setdefault(table, []).extend(records)
+
+    async def executemany(self, query, rows):
+        self.statements.append((" ".join(query.split()), list(rows)))
+
+
+def _setup(monkeypatch) -> FakeDB:
+    fake_db = FakeDB()
+
+    @asynccontextmanager
+    async def acquire():
+        yield fake_db
+
+    monkeypatch.setattr(write_behind, "acquire", acquire)
+    monkeypatch.setattr(write_behind, "_history", [])
+    monkeypatch.setattr(write_behind, "_funnel_history", [])
+    monkeypatch.setattr(write_behind, "_user_funnel", {})
+    monkeypatch.setattr(write_behind, "_events", {})
+    monkeypatch.setattr(write_behind, "_pending_users", set())
+    monkeypatch.setattr(write_behind, "_flusher_task", None)
+    return fake_db
+
+
+def test_rows_are_coalesced_and_written_in_one_flush(monkeypatch) -> None:
+    fake_db = _setup(monkeypatch)
+
+    async def runner():
+        await write_behind.add_history(1, "x" * 1000)
+        await write_behind.add_funnel_history(1, "1-start")
+        await write_behind.add_user_funnel(1, "1-start", "default")
+        await write_behind.add_user_funnel(1, "1-start", "start")
+        await write_behind.add_event(1, "send_msg", rewrite=True)
+        await write_behind.add_event(1, "send_msg", rewrite=True)
+        await write_behind.add_event(1, "start")
+        await write_behind.close()
+
+    asyncio.run(runner())
+
+    assert fake_db.copies["user_history"] == [(1, "x" * write_behind.MAX_CHARS_USERS_HISTORY)]
+    assert fake_db.copies["funnel_history"] == [(1, "1-start")]
+    user_funnel, inserts, rewrites = fake_db.statements
+    assert user_funnel[1] == [(1, "1-start", "default")]
+    assert [row[:2] for row in inserts[1]] == [(1, "start")]
+    assert [row[:2] for row in rewrites[1]] == [(1, "send_msg")]
+    assert "DO UPDATE" in rewrites[0]
+    assert write_behind.pending() == 0
+
+
+def test_failed_flush_keeps_rows(monkeypatch) -> None:
+    fake_db = _setup(monkeypatch)
+    fake_db.fail = True
+
+    async def noop(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(write_behind.logger, "error", noop)
+
+    async def runner():
+        await write_behind.add_history(1, "first")
+        await write_behind.flush()
+        assert write_behind.pending() == 1
+        # строки вернулись в буфер - юзер снова считается с незаписанными строками
+        assert write_behind.has_pending(1)
+        await write_behind.add_history(1, "second")
+        fake_db.fail = False
+        await write_behind.close()
+
+    asyncio.run(runner())
+
+    assert fake_db.copies["user_history"] == [(1, "first"), (1, "second")]
+
+
+def test_full_buffer_applies_backpressure(monkeypatch) -> None:
+    fake_db = _setup(monkeypatch)
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_LIMIT", 3)
+
+    async def runner():
+        for number in range(3):
+            await write_behind.add_history(1, str(number))
+        # третья строка упёрлась в лимит - записана сразу, не дожидаясь таймера
+        assert write_behind.pending() == 0
+        await write_behind.close()
+
+    asyncio.run(runner())
+
+    assert len(fake_db.copies["user_history"]) == 3
+
+
+def test_flush_user_writes_only_when_user_has_rows(monkeypatch) -> None:
+    fake_db = _setup(monkeypatch)
+
+    async def runner():
+        await write_behind.add_event(2, "start")
+        # у юзера 1 в буфере ничего нет - запись не нужна
+        await write_behind.flush_user(1)
+        assert write_behind.pending() == 1
+        await write_behind.flush_user(2)
+        assert write_behind.pending() == 0
+        await write_behind.close()
+
+    asyncio.run(runner())
+
+    assert [row[:2] for row in fake_db.statements[0][1]] == [(2, "start")]
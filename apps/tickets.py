@@ -1,11 +1,11 @@
 from aiogram import Router
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
 
-import aiohttp
 from json import loads, JSONDecodeError
-from modules import headers, get_host, check_ticket, create_connect, TicketState
+from modules import headers, get_host, check_ticket, acquire, TicketState
 import apps.logger as logger
 import apps.funcs as funcs
+import apps.http_clients as http_clients
 
 router = Router()
 
@@ -54,9 +54,9 @@ async def create_ticket_handler(message, state, bot):
         'question': message.text
     }
 
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.post(get_host()+'/tickets/add', json=body) as response:
-            data = loads(await response.text())
+    session = http_clients.session("backend")
+    async with session.post(get_host()+'/tickets/add', json=body, headers=headers) as response:
+        data = loads(await response.text())
 
     await state.update_data(id=data.get("id", "0"))
 
@@ -87,16 +87,16 @@ async def create_ticket_message_handler(message, state, bot):
         }
     }
 
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.post(get_host()+'/tickets/add-message', json=body) as response:
-            text = await response.text()
-            try:
-                r = loads(text)
-            except JSONDecodeError:
-                print('ERROR SEND',text)
-                await bot.send_message(message.from_user.id, 'Сообщение не доставлено из-за ошибки на сервере #034')
-            if r.get('resultCode') == 2:
-                await state.clear()
+    session = http_clients.session("backend")
+    async with session.post(get_host()+'/tickets/add-message', json=body, headers=headers) as response:
+        text = await response.text()
+        try:
+            r = loads(text)
+        except JSONDecodeError:
+            print('ERROR SEND',text)
+            await bot.send_message(message.from_user.id, 'Сообщение не доставлено из-за ошибки на сервере #034')
+        if r.get('resultCode') == 2:
+            await state.clear()
 
 
 @router.callback_query(lambda c: c.data and c.data.startswith('close_ticket-') and TicketState.ACTIVE)
@@ -108,19 +108,18 @@ async def close_ticket(call, state, bot):
     if not ticket_id.isdigit():
         return
 
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(get_host()+f'/tickets/close-ticket/{ticket_id}') as response:
-            data = loads(await response.text())
+    session = http_clients.session("backend")
+    async with session.get(get_host()+f'/tickets/close-ticket/{ticket_id}', headers=headers) as response:
+        data = loads(await response.text())
 
     if data['status'] != 'ok':
         return
     else:
-        db = await create_connect()
-        await db.execute(
-            """INSERT INTO user_history (user_id, text) VALUES ($1, $2)""", call.from_user.id,
-            f"Пользователь закрыл тикет #{ticket_id}"
-        )
-        await db.close()
+        async with acquire() as db:
+            await db.execute(
+                """INSERT INTO user_history (user_id, text) VALUES ($1, $2)""", call.from_user.id,
+                f"Пользователь закрыл тикет #{ticket_id}"
+            )
 
     try:
         await bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
@@ -0,0 +1,85 @@
+"""
+Кэш профилей пользователей (username, first_name, last_name) для плейсхолдеров сообщений.
+
+Заполняется из входящих апдейтов (UserProfileMiddleware) и из таблицы users, поэтому
+уведомлениям и квизам не нужен bot.get_chat перед каждой отправкой. bot.get_chat остаётся
+запасным вариантом для пользователей, которых нет ни в кэше, ни в БД.
+"""
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+
+import apps.logger as logger
+from modules import acquire
+
+# сколько секунд профиль считается свежим
+PROFILE_TTL = float(getenv('user_profile_ttl', 86400))
+# сколько профилей держим в памяти (самые давно использованные вытесняются)
+PROFILE_CACHE_LIMIT = int(getenv('user_profile_cache_limit', 50000))
+
+DEFAULT_PROFILE = {"username": "unknown", "first_name": "друг", "last_name": ""}
+
+# user_id -> (время протухания, профиль)
+_profiles = OrderedDict()
+
+
+def remember(user_id: int, username=None, first_name=None, last_name=None) -> dict:
+    """Кладёт профиль в кэш и возвращает его"""
+    profile = {"username": username, "first_name": first_name, "last_name": last_name}
+    _profiles[user_id] = (monotonic() + PROFILE_TTL, profile)
+    _profiles.move_to_end(user_id)
+    while len(_profiles) > PROFILE_CACHE_LIMIT:
+        _profiles.popitem(last=False)
+    return profile
+
+
+def remember_user(user) -> None:
+    """Профиль из апдейта (message.from_user, call.from_user)"""
+    remember(user.id, user.username, user.first_name, user.last_name)
+
+
+def cached(user_id: int) -> dict | None:
+    """Профиль из кэша или None, если его нет или он устарел"""
+    item = _profiles.get(user_id)
+    if item is None:
+        return None
+    expires_at, profile = item
+    if expires_at < monotonic():
+        del _profiles[user_id]
+        return None
+    _profiles.move_to_end(user_id)
+    return profile
+
+
+async def load_profiles(db, user_ids) -> int:
+    """Загружает в кэш профили пользователей из таблицы users одним запросом"""
+    rows = await db.fetch("""
+        SELECT id, username, first_name, last_name
+        FROM users
+        WHERE id = ANY($1::bigint[])
+    """, list(user_ids))
+    for row in rows:
+        # при записи в users пустой username заменяется на "Unknown"
+        username = row['username'] if row['username'] != "Unknown" else None
+        remember(row['id'], username, row['first_name'], row['last_name'])
+    return len(rows)
+
+
+async def get_profile(bot, user_id: int) -> dict:
+    """Профиль пользователя: кэш -> таблица users -> bot.get_chat"""
+    if (profile := cached(user_id)) is not None:
+        return profile
+
+    try:
+        async with acquire() as db:
+            if await load_profiles(db, [user_id]):
+                return cached(user_id)
+    except Exception as e:
+        await logger.error(f'Ошибка загрузки профиля пользователя {user_id} из БД: {e}')
+
+    try:
+        user = await bot.get_chat(user_id)
+        return remember(user_id, user.username, user.first_name, user.last_name)
+    except Exception as e:
+        await logger.error(f'Ошибка получения информации о пользователе: {e}')
+        return dict(DEFAULT_PROFILE)
@@ -7,7 +7,8 @@ import random
 # 
 from modules import ENCRYPTION_KEY, ENCRYPTION_IV, MYSQL_CONFIG
 import apps.logger as logger
-from modules import create_connect
+import apps.write_behind as write_behind
+from modules import acquire
 from apps.funcs import send_message, check_subs
 
 results = [
@@ -51,18 +52,19 @@ async def vk_quiz_results(bot, message, quiz_string):
             await logger.debug("Запись не найдена или не обновлена")
         conn.commit()
 
-        db = await create_connect()
-        rows = await db.fetch(
-            """
-            SELECT event_id FROM events
-            WHERE user_id = $1
-            AND event_type = $2
-            """,
-            telegram_id,
-            "iq_quiz_vk"
-        )
+        # events пишутся отложенно - дописываем перед проверкой
+        await write_behind.flush()
+        async with acquire() as db:
+            rows = await db.fetch(
+                """
+                SELECT event_id FROM events
+                WHERE user_id = $1
+                AND event_type = $2
+                """,
+                telegram_id,
+                "iq_quiz_vk"
+            )
 
-        await db.close()
         # возвращаем список словарей
         from_vk = len(rows) > 0
 
@@ -71,16 +73,15 @@ async def vk_quiz_results(bot, message, quiz_string):
             is_subscribe = await check_subs(channel=-1002218639494, user_id=telegram_id, bot=bot)
             chance = random.randint(0, 1)
             if not is_subscribe and chance == 1:
-                db = await create_connect()
-                await db.execute(
-                    """
-                    INSERT INTO funnel_history (user_id, label)
-                    VALUES ($1, $2)
-                    """,
-                    telegram_id,
-                    "произошёл запрос подписаться на канал (50/50 шаннс) для получения iq-результатов"
-                )
-                await db.close()
+                async with acquire() as db:
+                    await db.execute(
+                        """
+                        INSERT INTO funnel_history (user_id, label)
+                        VALUES ($1, $2)
+                        """,
+                        telegram_id,
+                        "произошёл запрос подписаться на канал (50/50 шаннс) для получения iq-результатов"
+                    )
                 msg_data = {
                             "text": "Мы тебя не нашли в подписчиках, подпишись, и мы предоставим тебе результаты и возможность узнать о интересной профессии...\n\nПодпишись и жми на кнопку ниже 👇",
                             "buttons": [
@@ -96,27 +97,25 @@ async def vk_quiz_results(bot, message, quiz_string):
                     )
                 return
             else:
-                db = await create_connect()
-                rows = await db.execute(
-                    """
-                    DELETE FROM events
-                    WHERE user_id = $1
-                    AND event_type = $2
-                    """,
-                    telegram_id,
-                    "iq_quiz_vk"
-                )
-                if chance == 1:
-                    await db.execute(
+                async with acquire() as db:
+                    rows = await db.execute(
                         """
-                        INSERT INTO funnel_history (user_id, label)
-                        VALUES ($1, $2)
+                        DELETE FROM events
+                        WHERE user_id = $1
+                        AND event_type = $2
                         """,
                         telegram_id,
-                        "подписался на канал для получения резов iq-квиза"
+                        "iq_quiz_vk"
                     )
-                await db.close()
-
+                    if chance == 1:
+                        await db.execute(
+                            """
+                            INSERT INTO funnel_history (user_id, label)
+                            VALUES ($1, $2)
+                            """,
+                            telegram_id,
+                            "подписался на канал для получения резов iq-квиза"
+                        )
 
 
         # Извлечение iq_score
@@ -0,0 +1,185 @@
+"""
+Отложенная запись аналитики: user_history, funnel_history, user_funnel, events.
+
+Эти записи не влияют на то, что пользователь увидит дальше, поэтому обработчик апдейта
+не ждёт их: строки копятся в памяти и пишутся пачками (COPY / executemany) раз в
+WRITE_BEHIND_INTERVAL_MS или как только набралось WRITE_BEHIND_BATCH строк.
+Повторы схлопываются: user_funnel и events с одинаковым ключом пишутся один раз.
+
+Если буфер переполнен (WRITE_BEHIND_LIMIT строк), добавляющий ждёт записи пачки.
+Код, который читает эти таблицы сразу после записи, вызывает flush() (квизы) или
+flush_user() (уведомления: пишет, только если в буфере есть строки этого юзера).
+При остановке бота close() дописывает всё, что осталось.
+"""
+import asyncio
+from datetime import datetime
+from os import getenv
+
+import apps.logger as logger
+from modules import MAX_CHARS_USERS_HISTORY, acquire
+
+# как часто пишем накопленное (мс) и сколько строк пишем сразу, не дожидаясь таймера
+WRITE_BEHIND_INTERVAL_MS = int(getenv('write_behind_interval_ms', 500))
+WRITE_BEHIND_BATCH = int(getenv('write_behind_batch', 500))
+# сколько строк максимум держим в памяти (дальше добавляющий ждёт записи)
+WRITE_BEHIND_LIMIT = int(getenv('write_behind_limit', 20000))
+
+# user_history и funnel_history - журналы, пишем все строки по порядку
+_history = []
+_funnel_history = []
+# user_funnel: (user_id, label) -> name (ON CONFLICT DO NOTHING - важна первая строка)
+_user_funnel = {}
+# events: (user_id, event_type) -> (rewrite, event_date)
+_events = {}
+# юзеры, у которых есть строки в буфере (flush_user проверяет их без обхода буферов)
+_pending_users = set()
+
+_flush_lock = asyncio.Lock()
+_wakeup = None
+_flusher_task = None
+_flusher_loop = None
+
+
+def pending() -> int:
+    """Сколько строк ждут записи"""
+    return len(_history) + len(_funnel_history) + len(_user_funnel) + len(_events)
+
+
+def _ensure_flusher(loop):
+    global _wakeup, _flusher_task, _flusher_loop
+    if _flusher_loop is loop and _flusher_task is not None and not _flusher_task.done():
+        return
+    _flusher_loop = loop
+    _wakeup = asyncio.Event()
+    _flusher_task = logger.create_background_task(_flusher(), loop)
+
+
+async def _flusher():
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), WRITE_BEHIND_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        if pending():
+            # shield: остановка (close) не обрывает пачку на середине записи
+            await asyncio.shield(flush())
+
+
+async def _added(user_id):
+    """Будит запись при полной пачке; при переполнении буфера ждёт записи (backpressure)"""
+    _pending_users.add(user_id)
+    count = pending()
+    if count >= WRITE_BEHIND_LIMIT:
+        await flush()
+        return
+    _ensure_flusher(asyncio.get_running_loop())
+    if count >= WRITE_BEHIND_BATCH:
+        _wakeup.set()
+
+
+async def add_history(user_id, text):
+    _history.append((user_id, str(text)[:MAX_CHARS_USERS_HISTORY]))
+    await _added(user_id)
+
+
+async def add_funnel_history(user_id, label):
+    _funnel_history.append((user_id, label))
+    await _added(user_id)
+
+
+async def add_user_funnel(user_id, label, name):
+    _user_funnel.setdefault((user_id, label), name)
+    await _added(user_id)
+
+
+async def add_event(user_id, event, rewrite=False):
+    key = (user_id, event)
+    if rewrite:
+        _events[key] = (True, datetime.utcnow())
+    else:
+        # без rewrite существующая запись не меняется, поэтому повтор не нужен
+        _events.setdefault(key, (False, datetime.utcnow()))
+    await _added(user_id)
+
+
+def has_pending(user_id) -> bool:
+    """Есть ли в буфере строки юзера"""
+    return user_id in _pending_users
+
+
+async def flush_user(user_id):
+    """Перед чтением таблиц по юзеру: пишет буфер, только если там есть его строки (или идёт запись)"""
+    # во время записи строки уже вынуты из буфера, но ещё не в БД - дожидаемся её через flush()
+    if _flush_lock.locked() or has_pending(user_id):
+        await flush()
+
+
+async def flush():
+    """Пишет в БД всё накопленное. При ошибке строки возвращаются в буфер"""
+    global _history, _funnel_history, _user_funnel, _events, _pending_users
+    async with _flush_lock:
+        if not pending():
+            return
+        history, funnel_history, user_funnel, events = _history, _funnel_history, _user_funnel, _events
+        _history, _funnel_history, _user_funnel, _events = [], [], {}, {}
+        _pending_users = set()
+        try:
+            await _write(history, funnel_history, user_funnel, events)
+        except Exception as error:
+            await logger.error(f"Не удалось записать аналитику ({len(history) + len(funnel_history) + len(user_funnel) + len(events)} строк): {error}")
+            # возвращаем строки (старые - перед новыми), лишнее сверх лимита отбрасываем
+            _history = (history + _history)[-WRITE_BEHIND_LIMIT:]
+            _funnel_history = (funnel_history + _funnel_history)[-WRITE_BEHIND_LIMIT:]
+            # user_funnel: остаётся первая строка; events: более новый rewrite важнее старой записи
+            _user_funnel = {**_user_funnel, **user_funnel}
+            for key, value in _events.items():
+                if value[0] or key not in events:
+                    events[key] = value
+            _events = events
+            # строки вернулись в буфер (часть могла быть отброшена по лимиту) - пересобираем юзеров
+            _pending_users = (
+                {row[0] for row in _history} | {row[0] for row in _funnel_history}
+                | {key[0] for key in _user_funnel} | {key[0] for key in _events}
+            )
+
+
+async def _write(history, funnel_history, user_funnel, events):
+    # одна транзакция: при ошибке пачка повторяется целиком, без дублей в журналах
+    async with acquire() as db, db.transaction():
+        if history:
+            await db.copy_records_to_table("user_history", records=history, columns=["user_id", "text"])
+        if funnel_history:
+            await db.copy_records_to_table("funnel_history", records=funnel_history, columns=["user_id", "label"])
+        if user_funnel:
+            await db.executemany("""
+                INSERT INTO user_funnel (user_id, label, name)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id, label)
+                DO NOTHING
+            """, [(user_id, label, name) for (user_id, label), name in user_funnel.items()])
+        inserts = [(user_id, event, date) for (user_id, event), (rewrite, date) in events.items() if not rewrite]
+        rewrites = [(user_id, event, date) for (user_id, event), (rewrite, date) in events.items() if rewrite]
+        if inserts:
+            await db.executemany("""
+                INSERT INTO events (user_id, event_type, event_date)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id, event_type)
+                DO NOTHING
+            """, inserts)
+        if rewrites:
+            await db.executemany("""
+                INSERT INTO events (user_id, event_type, event_date)
+                VALUES ($1, $2, $3)
+                ON CONFLICT (user_id, event_type)
+                DO UPDATE SET event_date = EXCLUDED.event_date
+            """, rewrites)
+
+
+async def close():
+    """Останавливает фоновую запись и дописывает остаток (вызывать до закрытия пула БД)"""
+    global _flusher_task
+    if _flusher_task is not None:
+        _flusher_task.cancel()
+        _flusher_task = None
+    await flush()
@@ -7,8 +7,11 @@ from aiogram.filters.command import Command
 from aiogram.filters import ChatMemberUpdatedFilter, KICKED, MEMBER
 from modules import (
     DEFAULT_FUNNEL,
+    acquire,
     bot,
-    create_connect,
+    close_db_pool,
+    db_pool_stats,
+    init_db_pool,
     dp,
     get_data,
     normalize_funnel_name,
@@ -26,8 +29,18 @@ import apps.ph_notifier as notifier
 import apps.logic_core as logic_core
 import apps.auth_pokerhub as auth_pokerhub
 import apps.funcs as funcs
+import apps.file_id_uploader as file_uploader
+import apps.media_prewarm as media_prewarm
+import apps.funnel_reloader as funnel_reloader
+import apps.write_behind as write_behind
+import apps.activity_tracker as activity_tracker
+import apps.http_clients as http_clients
+import apps.history_batcher as history_batcher
+import apps.jivo_relay as jivo_relay
 import apps.logger as logger
 from apps.bot_info import bot_info
+from apps.middlewares import DBConnectionMiddleware, LoggingMiddleware, TelegramTimingMiddleware, UserProfileMiddleware
+from apps.rate_limiter import RateLimitMiddleware
 from apps.iq_quiz import quiz_results
 from apps.vk_iq_quiz import vk_quiz_results
 from apps.select_quiz import quiz_results as select_quiz_results
@@ -43,13 +56,12 @@ router = Router()
 @dp.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=KICKED))
 async def process_user_blocked_bot(event: types.ChatMemberUpdated):
     # print(f'Пользователь {event.from_user.id} заблокировал бота')
-    db = await create_connect()
-    await db.execute(
-        """INSERT INTO funnel_history (user_id, label)
-            VALUES ($1, $2)""",
-        event.from_user.id, "Заблокировал бота"
-    )
-    await db.close()
+    async with acquire() as db:
+        await db.execute(
+            """INSERT INTO funnel_history (user_id, label)
+                VALUES ($1, $2)""",
+            event.from_user.id, "Заблокировал бота"
+        )
     await notificator.blocked(user_id=event.from_user.id, is_blocked=True)
     await funcs.touch_user_activity(event.from_user.id)
 
@@ -58,13 +70,12 @@ async def process_user_blocked_bot(event: types.ChatMemberUpdated):
 @dp.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=MEMBER))
 async def user_unblocked_bot(event: types.ChatMemberUpdated):
     # print(f'Пользователь {event.from_user.id} разблокировал бота')
-    db = await create_connect()
-    await db.execute(
-        """INSERT INTO funnel_history (user_id, label)
-            VALUES ($1, $2)""",
-        event.from_user.id, "Разблокировал бота"
-    )
-    await db.close()
+    async with acquire() as db:
+        await db.execute(
+            """INSERT INTO funnel_history (user_id, label)
+                VALUES ($1, $2)""",
+            event.from_user.id, "Разблокировал бота"
+        )
     await notificator.blocked(user_id=event.from_user.id, is_blocked=False)
 
     # ДОБАВЛЕНО: Возобновляем уведомления при разблокировке
@@ -116,17 +127,12 @@ async def process_start_command(message: types.Message, bot):
     set_current_funnel(funnel_name)
     await logger.info(f"Бот запущен пользователем {message.from_user.username}, id={user_id}, data={data}")
 
-    db = await create_connect()
-    # проверяем, есть-ли такой юзер в БД
-    existing_user = await db.fetchrow(
-        """SELECT id FROM users WHERE id = $1""", user_id
-    )
     # По дефолту ставим unknown, далее если у него есть аватарка - это значение поменяется
     avatar = f'unknown_user.jpg'
-    # Проверяем, есть-ли на диске аватарка юзера
-    if not exists(join(getenv('static_folder'), 'img',
-                    'avatars', f'avatar_{user_id}.jpg')
-                    ):
+    # Проверяем, есть-ли на диске аватарка юзера (скачиваем её до работы с БД,
+    # чтобы не держать соединение из пула, пока идут запросы к Telegram)
+    avatar_missing = not exists(join(getenv('static_folder'), 'img', 'avatars', f'avatar_{user_id}.jpg'))
+    if avatar_missing:
         profile_pictures = await bot.get_user_profile_photos(user_id, limit=1)
         avatars = profile_pictures.photos
         # Если у юзера есть фото профиля
@@ -139,86 +145,105 @@ async def process_start_command(message: types.Message, bot):
 
             avatar = f'avatar_{user_id}.jpg'
 
+    async with acquire() as db:
+        # проверяем, есть-ли такой юзер в БД
+        existing_user = await db.fetchrow(
+            """SELECT id FROM users WHERE id = $1""", user_id
+        )
+        if avatar_missing:
+            await db.execute(
+                """INSERT INTO users (id, username, last_name, first_name, photo_code)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (id)
+                DO UPDATE SET
+                    username = EXCLUDED.username,
+                    last_name = EXCLUDED.last_name,
+                    first_name = EXCLUDED.first_name,
+                    photo_code = EXCLUDED.photo_code""",
+                user_id, message.from_user.username or "Unknown",
+                message.from_user.last_name, message.from_user.first_name, avatar
+            )
+
+        # статистика активности для рассыльщика (последний запуск бота, время в UTC)
         await db.execute(
-            """INSERT INTO users (id, username, last_name, first_name, photo_code)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT (id)
+            """INSERT INTO user_activity_stats (user_id, last_start, last_activity)
+            VALUES ($1, timezone('UTC', now()), timezone('UTC', now()))
+            ON CONFLICT (user_id)
             DO UPDATE SET
-                username = EXCLUDED.username,
-                last_name = EXCLUDED.last_name,
-                first_name = EXCLUDED.first_name,
-                photo_code = EXCLUDED.photo_code""",
-            user_id, message.from_user.username or "Unknown",
-            message.from_user.last_name, message.from_user.first_name, avatar
+                last_start = EXCLUDED.last_start,
+                last_activity = EXCLUDED.last_activity""",
+            user_id
         )
 
-    # если он есть, значит запускал бота
-    if existing_user:
-        # print(f"Этот юзер уже запускал бота: {existing_user.get('id', None)}")
+        # если он есть, значит запускал бота
+        if existing_user:
+            # print(f"Этот юзер уже запускал бота: {existing_user.get('id', None)}")
 
-        # ДОБАВЛЕНО: Записываем активность существующего пользователя
-        await db.execute(
-            """INSERT INTO user_history (user_id, text)
-            VALUES ($1, $2)""",
-            user_id, "Пользователь запустил бота"
-        )
+            # ДОБАВЛЕНО: Записываем активность существующего пользователя
+            await db.execute(
+                """INSERT INTO user_history (user_id, text)
+                VALUES ($1, $2)""",
+                user_id, "Пользователь запустил бота"
+            )
 
-        # ДОБАВЛЕНО: Возобновляем уведомления при повторном запуске
-        await notificator.resume_user_notifications(user_id)
+            # ДОБАВЛЕНО: Возобновляем уведомления при повторном запуске
+            await notificator.resume_user_notifications(user_id)
 
-        # # временной решение для отладки (ЗАКОММЕНТИТЬ ИЛИ УДАЛИТЬ ПРИ ФИНАЛЬНОМ ДЕПЛОЕ)
-        # await db.execute(
-        #     """UPDATE lead_resources
-        #     SET campaign = $2, source = $3, medium = $4, term = $5, content = $6, direction_id = (SELECT id FROM directions WHERE code=$7 LIMIT 1)
-        #     WHERE user_id = $1""",
-        #     user_id, data.get('campaign'), data.get('source'), data.get('medium'), data.get('term'), data.get('content'), data.get('land').upper() if data.get('land') else None
-        # )
+            # # временной решение для отладки (ЗАКОММЕНТИТЬ ИЛИ УДАЛИТЬ ПРИ ФИНАЛЬНОМ ДЕПЛОЕ)
+            # await db.execute(
+            #     """UPDATE lead_resources
+            #     SET campaign = $2, source = $3, medium = $4, term = $5, content = $6, direction_id = (SELECT id FROM directions WHERE code=$7 LIMIT 1)
+            #     WHERE user_id = $1""",
+            #     user_id, data.get('campaign'), data.get('source'), data.get('medium'), data.get('term'), data.get('content'), data.get('land').upper() if data.get('land') else None
+            # )
 
-        # получаем из БД utm-метки юзера, которые были при первом его запуске бота
-        user_utm = await db.fetchrow(
-            """SELECT campaign, source, medium, term, content, direction_id FROM lead_resources WHERE user_id = $1""", user_id
-        )
-        # Преобразуем объект Record в словарь
-        user_utm = dict(user_utm.items()) if user_utm else {}
-
-        # если метки из БД не Null
-        if (user_utm.get("campaign", None)) or (user_utm.get("source", None)):
-            # присваиваем метки из БД в data, если это не авторизация на ПХ
-            if not auth_code:
-                data = user_utm
-        # print(f"UTM-метки из БД: {user_utm}")
-    else:
-        # print("Это новый юзер")
-        # Сохраняем в БД запись в users
+            # получаем из БД utm-метки юзера, которые были при первом его запуске бота
+            user_utm = await db.fetchrow(
+                """SELECT campaign, source, medium, term, content, direction_id FROM lead_resources WHERE user_id = $1""", user_id
+            )
+            # Преобразуем объект Record в словарь
+            user_utm = dict(user_utm.items()) if user_utm else {}
+
+            # если метки из БД не Null
+            if (user_utm.get("campaign", None)) or (user_utm.get("source", None)):
+                # присваиваем метки из БД в data, если это не авторизация на ПХ
+                if not auth_code:
+                    data = user_utm
+            # print(f"UTM-метки из БД: {user_utm}")
+        else:
+            # print("Это новый юзер")
+            # Сохраняем в БД запись в users
 
-        if auth_code:
-            # platform заменил на source
-            data["s"] = "auth_pokerhub"
+            if auth_code:
+                # platform заменил на source
+                data["s"] = "auth_pokerhub"
 
-        await db.execute(
-            """INSERT INTO users (id, username, last_name, first_name, photo_code) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (id) DO NOTHING""",
-            user_id, message.from_user.username or "Unknown",
-            message.from_user.last_name, message.from_user.first_name, avatar
-        )
+            await db.execute(
+                """INSERT INTO users (id, username, last_name, first_name, photo_code) VALUES ($1, $2, $3, $4, $5) ON CONFLICT (id) DO NOTHING""",
+                user_id, message.from_user.username or "Unknown",
+                message.from_user.last_name, message.from_user.first_name, avatar
+            )
 
-        await db.execute(
-            """INSERT INTO user_history (user_id, text) VALUES ($1, $2)""", user_id,
-            f"Начал пользоваться ботом." + "" if data == {} else f"\nСсылка перехода в бота: {raw_data}"
-        )
+            await db.execute(
+                """INSERT INTO user_history (user_id, text) VALUES ($1, $2)""", user_id,
+                f"Начал пользоваться ботом." + "" if data == {} else f"\nСсылка перехода в бота: {raw_data}"
+            )
 
+    if not existing_user:
+        # запрос к ПХ - вне работы с БД, соединение на это время возвращается в пул
         auth_user_data = await auth_pokerhub.get_user_data_auth(auth_code=auth_code)
         referer_url = auth_user_data.get('referer', None)
 
-        # записываем в БД utm-метки (если они уже там есть - запрос будет проигнорирован)
-        # Было: platform, company, content
-        # Стало: campaign (ca), source (s), medium (m), term (t), content (co)
-        await db.execute(
-            """INSERT INTO lead_resources (user_id, campaign, source, medium, term, content, direction_id, referer_url, raw_link)
-            VALUES ($1, $2, $3, $4, $6, $7, (SELECT id FROM directions WHERE code=$5 LIMIT 1), $8, $9) ON CONFLICT (user_id) DO NOTHING""",
-            user_id, data.get('ca'), data.get('s'), data.get('m'), data.get('t'), data.get('co'), data.get('land').upper() if data.get('land') else None, referer_url, raw_data
-        )
+        async with acquire() as db:
+            # записываем в БД utm-метки (если они уже там есть - запрос будет проигнорирован)
+            # Было: platform, company, content
+            # Стало: campaign (ca), source (s), medium (m), term (t), content (co)
+            await db.execute(
+                """INSERT INTO lead_resources (user_id, campaign, source, medium, term, content, direction_id, referer_url, raw_link)
+                VALUES ($1, $2, $3, $4, $6, $7, (SELECT id FROM directions WHERE code=$5 LIMIT 1), $8, $9) ON CONFLICT (user_id) DO NOTHING""",
+                user_id, data.get('ca'), data.get('s'), data.get('m'), data.get('t'), data.get('co'), data.get('land').upper() if data.get('land') else None, referer_url, raw_data
+            )
 
-    await db.close()
     await funcs.touch_user_activity(user_id)
 
     # если был передан параметр для авторизации на покерхаб
@@ -256,7 +281,6 @@ async def process_start_command(message: types.Message, bot):
 async def message_handler(message, state, bot):
     message_text = message.text
     user_full_name = message.from_user.full_name
-    username = message.from_user.username or None
     user_id = message.from_user.id
 
     # добавляем в историю event отправку юзером сообщения
@@ -303,16 +327,9 @@ async def message_handler(message, state, bot):
                     text=answer_text
                 )
             await logger.debug(f"Сообщение успешно доставлено пользователю {user_full_name}")
-            # Сохраняем сообщение в историю сообщений
-            saved = await funcs.add_msg_to_history(content=message_text, chat_id=user_id, author_id=user_id)
-            if not saved:
-                await logger.error(f'Сообщение от user_id={message.from_user.id} не записан в БД в историю сообщений!')
-            # делаем небольшую задержку
-            await asyncio.sleep(0.5)
-            # Сохраняем сообщение в историю сообщений
-            saved = await funcs.add_msg_to_history(content=f"Ответ от ИИ: {answer_text}", chat_id=user_id, author_id="-1")
-            if not saved:
-                await logger.error('Ответ от ИИ-ассистента не записан в БД в историю сообщений!')
+            # Сохраняем сообщение и ответ ИИ в историю сообщений (по порядку, ошибки записи логирует history_batcher)
+            await funcs.add_msg_to_history(content=message_text, chat_id=user_id, author_id=user_id)
+            await funcs.add_msg_to_history(content=f"Ответ от ИИ: {answer_text}", chat_id=user_id, author_id="-1")
         # Если ответа от RAG не вернулся - отправляем сообщение об этом
         else:
             await bot.send_message(
@@ -324,94 +341,8 @@ async def message_handler(message, state, bot):
 
     # Если сообщение должно идти в живую поддержку
     elif dialogue_type == "support":
-
-        # Пытаемся извлечь сообщения из таблицы jivo_integration_queue, и сначала отправить их
-        queue_msgs = await funcs.get_msgs_to_jivo_integration_queue(user_id=user_id)
-        # Получаем дату последнего сообщения в jivo_integration_queue
-        last_create_at = queue_msgs[-1]['create_at'] if queue_msgs else None
-        # Добавляем \n\n\n в конец, чтобы визуально проще различать сообщения
-        for item in queue_msgs:
-            item['text'] += '\n\n\n'
-        # Если есть текстовое сообщение от юзера
-        if message_text:
-            # Добавляем ласт сообщение (которое от юзера)
-            queue_msgs += [{'text': message_text, 'create_at': None}]
-
-        # Проверяем наличие вложений
-        attachments = []
-
-        if message.photo:
-            # for photo in message.photo:
-            photo = message.photo[-1]
-            file = await bot.get_file(photo.file_id)
-            file_name = "photo.jpg"
-            attachments.append({"file_type": "photo", "file_path": file.file_path, "file_name": file_name})
-        if message.video:
-            file = await bot.get_file(message.video.file_id)
-            file_name = message.video.file_name or "video.mp4"
-            attachments.append({"file_type": "video", "file_path": file.file_path, "file_name": file_name})
-        if message.document:
-            file = await bot.get_file(message.document.file_id)
-            file_name = message.document.file_name or "document"
-            attachments.append({"file_type": "document", "file_path": file.file_path, "file_name": file_name})
-        if message.voice:
-            file = await bot.get_file(message.voice.file_id)
-            file_name = "voice.ogg"
-            attachments.append({"file_type": "audio", "file_path": file.file_path, "file_name": file_name})
-
-        # Отправляем сначала файлы, если они есть
-        for attachment in attachments:
-            # Отправляем в JIVO
-            result = await funcs.send_to_jivo(
-                user_id=user_id,
-                # thumb=attachment.get("url") if attachment.get("type") == "photo" else None,
-                # file=attachment.get("url") if attachment.get("type") == "document" or attachment.get("type") == "photo" else None,
-                # video=attachment.get("url") if attachment.get("type") == "video" else None,
-                file_path=attachment.get("file_path", None),
-                file_type=attachment.get("file_type", None),
-                file_name=attachment.get("file_name", None),
-                name=f"{user_full_name}",
-                intent=f"Обращение из телеграм @{bot_info.get_username()}" + (f" https://t.me/{username}" if username else ""),
-                invite=f"Для просмотра истории переписки с пользователем, можете посетить: https://telegram.pokerhub.pro/profile/{user_id}",
-                photo=f"https://telegram.pokerhub.pro/api/static/img/avatars/avatar_{user_id}.jpg"
-            )
-            if not result:
-                await logger.error(f"Сообщение от юзера {user_full_name} ({user_id}) не доставлено в JIVO!")
-            else:
-                # Сохраняем сообщение в историю сообщений
-                file_name = result.get('file_name', None)
-                original_file_name = result.get('original_file_name', None)
-                if file_name and original_file_name:
-                    saved = await funcs.add_msg_to_history(content=original_file_name,
-                                                            name=file_name,
-                                                            type=attachment.get('file_type'),
-                                                            chat_id=user_id,
-                                                            author_id=user_id)
-                    if not saved:
-                        await logger.error(f'Сообщение от user_id={message.from_user.id} не записан в БД в историю сообщений!')
-                else:
-                    await logger.error(f"Не удалось получить имя файла, сохраненного на сервере! result={result}")
-        for msg in queue_msgs:
-            # Отправляем в JIVO
-            result = await funcs.send_to_jivo(
-                text=msg.get('text'),
-                user_id=user_id,
-                name=f"{user_full_name}",
-                intent=f"Обращение из телеграм @{bot_info.get_username()}" + (f" https://t.me/{username}" if username else ""),
-                invite=f"Для просмотра истории переписки с пользователем, можете посетить: https://telegram.pokerhub.pro/profile/{user_id}",
-                photo=f"https://telegram.pokerhub.pro/api/static/img/avatars/avatar_{user_id}.jpg"
-            )
-            if not result:
-                await logger.error(f"Сообщение от юзера {user_full_name} ({user_id}) не доставлено в JIVO!")
-            else:
-                # Сохраняем сообщение в историю сообщений
-                saved = await funcs.add_msg_to_history(content=message_text, chat_id=user_id, author_id=user_id)
-                if not saved:
-                    await logger.error(f'Сообщение от user_id={message.from_user.id} не записан в БД в историю сообщений!')
-
-        # Деактивируем сообщения в jivo_integration_queue если отправили их
-        if last_create_at:
-            await funcs.deactivate_msgs_for_user(user_id=user_id, end_date=last_create_at)
+        # пересылка в JIVO идёт в фоне, по порядку для каждого юзера (apps/jivo_relay.py)
+        jivo_relay.enqueue(bot=bot, message=message)
 
 
 async def start_notifier():
@@ -429,6 +360,16 @@ async def main():
         router
     )
 
+    # время обработки апдейта (всего / БД / HTTP / Telegram) в лог
+    dp.update.outer_middleware(LoggingMiddleware())
+    # одно соединение с БД на весь апдейт
+    dp.update.outer_middleware(DBConnectionMiddleware())
+    # профиль отправителя в кэш (имя для плейсхолдеров без bot.get_chat)
+    dp.update.outer_middleware(UserProfileMiddleware())
+    # лимиты Telegram на отправку сообщений (общий и на чат) + повтор после RetryAfter
+    bot.session.middleware(RateLimitMiddleware())
+    bot.session.middleware(TelegramTimingMiddleware())
+
     # запускаем модуль уведомлений после запуска бота
     dp.startup.register(start_notifier)
 
@@ -437,8 +378,37 @@ async def main():
     bot_info.set_id(id=bot_information.id)
     bot_info.set_username(username=bot_information.username)
     await logger.info(f"Bot started, ID: {bot_info.get_id()}, name: @{bot_info.get_username()}")
+    # создаём общий пул соединений с БД
+    await init_db_pool()
     await funcs.update_funnel_db()
-    await dp.start_polling(bot)
+    # file_id загруженных медиа держим в памяти
+    await file_uploader.load_uploaded_files()
+    await file_uploader.start_uploaded_files_listener()
+    # проверяем воронки и перечитываем их по SIGHUP / при изменении файлов
+    await funnel_reloader.check_funnels()
+    funnel_reloader.start_funnel_reloader()
+    # досылаем в JIVO сообщения, отложенные пока он был недоступен
+    jivo_relay.start_queue_drainer()
+    # заранее загружаем медиа воронок в служебный чат (в фоне, polling не ждёт)
+    prewarm_task = asyncio.create_task(media_prewarm.prewarm_media()) if media_prewarm.MEDIA_PREWARM_CHAT else None
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await logger.info(f"Остановка бота, статистика пула БД: {db_pool_stats()}")
+        if prewarm_task and not prewarm_task.done():
+            prewarm_task.cancel()
+        funnel_reloader.stop_funnel_reloader()
+        jivo_relay.stop_queue_drainer()
+        await file_uploader.stop_uploaded_files_listener()
+        # досылаем сообщения в JIVO, дописываем отложенную активность и аналитику до закрытия пула
+        await jivo_relay.close()
+        await activity_tracker.close()
+        await write_behind.close()
+        await close_db_pool()
+        # дописываем историю сообщений и закрываем HTTP-сессии внешних сервисов
+        await history_batcher.close()
+        await http_clients.close()
+        await logger.flush()
 
 
 if __name__ == '__main__':
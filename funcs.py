@@ -104,6 +104,7 @@ bot_lead_stages = {
     "doge2_username_done": "doge2.5-done",
     "doge2_followup_program": "doge2.6",
     "doge2_followup_cases": "doge2.7",
+}
 
 # этот класс нужен для безопасного использования format, чтобы не возникали исключения
 # в случаях, когда плейсхолдера переданного в параметры format() в строке нет
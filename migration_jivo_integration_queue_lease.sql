@@ -0,0 +1,15 @@
+-- Миграция: lease для сообщений jivo_integration_queue
+-- Бот берёт сообщения в работу коротким запросом (claimed_until = время окончания lease)
+-- и отправляет их в JIVO без открытой транзакции. Если процесс упал во время отправки,
+-- после окончания lease сообщения возьмёт другой процесс.
+-- Выполнить в PostgreSQL базе данных (после migration_jivo_integration_queue_spill.sql)
+
+ALTER TABLE jivo_integration_queue
+    ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ DEFAULT NULL;
+
+COMMENT ON COLUMN jivo_integration_queue.claimed_until IS 'До какого времени сообщение отправляет один из процессов бота (NULL - свободно)';
+
+-- фоновый разборщик ищет юзеров с отложенными сообщениями
+CREATE INDEX IF NOT EXISTS idx_jivo_integration_queue_active
+    ON jivo_integration_queue (user_id, id)
+    WHERE is_active = TRUE;
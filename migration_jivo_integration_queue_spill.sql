@@ -0,0 +1,17 @@
+-- Миграция: отложенная доставка сообщений в JIVO
+-- Если интегратор JIVO недоступен, сообщение юзера (текст или вложение) сохраняется в
+-- jivo_integration_queue с source = 'relay' и отправляется повторно позже.
+-- Триггерные сообщения ПХ по-прежнему пишутся с source = 'ph'.
+-- Выполнить в PostgreSQL базе данных
+
+ALTER TABLE jivo_integration_queue
+    ADD COLUMN IF NOT EXISTS source VARCHAR(16) NOT NULL DEFAULT 'ph',
+    ADD COLUMN IF NOT EXISTS file_type VARCHAR(16) DEFAULT NULL,
+    ADD COLUMN IF NOT EXISTS file_path TEXT DEFAULT NULL,
+    ADD COLUMN IF NOT EXISTS file_name TEXT DEFAULT NULL;
+
+-- у отложенных вложений текста нет
+ALTER TABLE jivo_integration_queue ALTER COLUMN text DROP NOT NULL;
+
+COMMENT ON COLUMN jivo_integration_queue.source IS 'ph - триггерное сообщение ПХ, relay - сообщение юзера, не доставленное в JIVO';
+COMMENT ON COLUMN jivo_integration_queue.file_path IS 'Путь вложения в Telegram (для отложенных вложений)';
@@ -0,0 +1,28 @@
+-- Миграция для планировщика уведомлений (SmartNotifier.main)
+-- Рассыльщик больше не опрашивает таблицу каждые 0.5 сек и не закрывает уведомления
+-- прошедших воронку на каждом цикле: он спит до ближайшего time_to_send и забирает
+-- наступившие уведомления пачками через FOR UPDATE SKIP LOCKED.
+-- Выполнить в PostgreSQL базе данных
+
+-- =====================================================
+-- 1. Закрываем уведомления тех, кто уже прошёл воронку
+-- =====================================================
+-- (новые прохождения закрывает save_funnel_passed)
+UPDATE notifications
+SET is_active = FALSE
+WHERE is_active = TRUE
+AND user_id IN (
+    SELECT user_id FROM funnel_passed
+    WHERE funnel_name = 'default' AND passed = TRUE
+);
+
+-- =====================================================
+-- 2. Индексы
+-- =====================================================
+
+-- idx_notifications_active_time уже создан в migration_pause_notifications.sql
+
+-- Проверка NOT EXISTS по funnel_passed при выборке уведомлений
+CREATE INDEX IF NOT EXISTS idx_funnel_passed_user
+ON funnel_passed(user_id, funnel_name)
+WHERE passed = TRUE;
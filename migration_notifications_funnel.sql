@@ -0,0 +1,10 @@
+-- Миграция: воронка уведомления хранится в самой строке notifications
+-- Раньше соответствие (user_id, label) -> воронка жило только в памяти процесса
+-- (SmartNotifier._notification_funnels) и терялось при рестарте - после этого
+-- уведомление уходило из воронки default.
+-- Выполнить в PostgreSQL базе данных
+
+ALTER TABLE notifications
+ADD COLUMN IF NOT EXISTS funnel_name VARCHAR(100) DEFAULT NULL;
+
+COMMENT ON COLUMN notifications.funnel_name IS 'Воронка, из которой берётся сообщение уведомления (NULL - default)';
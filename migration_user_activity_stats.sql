@@ -0,0 +1,45 @@
+-- Миграция: денормализованная статистика активности пользователя
+-- Проверка активности перед рассылкой (SmartNotifier.check_users_activity) читает одну
+-- строку по первичному ключу вместо LIKE-поиска по user_history.
+-- Строку обновляют touch_user_activity, process_start_command и send_notification.
+-- Выполнить в PostgreSQL базе данных
+
+-- =====================================================
+-- 1. Таблица статистики
+-- =====================================================
+CREATE TABLE IF NOT EXISTS user_activity_stats (
+    user_id BIGINT PRIMARY KEY,
+    last_start TIMESTAMP DEFAULT NULL,
+    last_activity TIMESTAMP DEFAULT NULL,
+    notifications_sent_at TIMESTAMP[] NOT NULL DEFAULT '{}',
+    first_active_notification TIMESTAMP DEFAULT NULL
+);
+
+COMMENT ON COLUMN user_activity_stats.last_start IS 'Последний запуск бота (/start)';
+COMMENT ON COLUMN user_activity_stats.last_activity IS 'Последняя активность пользователя';
+COMMENT ON COLUMN user_activity_stats.notifications_sent_at IS 'Время отправки уведомлений за последние 2 месяца (старые отсекаются при записи)';
+COMMENT ON COLUMN user_activity_stats.first_active_notification IS 'Начало текущей серии уведомлений (NULL - активных уведомлений нет)';
+
+-- =====================================================
+-- 2. Заполняем по существующим данным
+-- =====================================================
+INSERT INTO user_activity_stats (user_id, last_start, last_activity, notifications_sent_at, first_active_notification)
+SELECT
+    u.id,
+    (SELECT MAX(timestamp) FROM user_history
+     WHERE user_id = u.id AND text LIKE '%запустил бота%'),
+    COALESCE(
+        u.last_activity,
+        (SELECT MAX(timestamp) FROM user_history WHERE user_id = u.id)
+    ),
+    ARRAY(
+        SELECT timestamp FROM user_history
+        WHERE user_id = u.id
+        AND text LIKE 'Получил уведомление%'
+        AND timestamp > NOW() - INTERVAL '2 months'
+        ORDER BY timestamp
+    ),
+    (SELECT MIN(created_at) FROM notifications
+     WHERE user_id = u.id AND is_active = true)
+FROM users u
+ON CONFLICT (user_id) DO NOTHING;
@@ -1,5 +1,8 @@
 import re
+import asyncio
+from contextlib import asynccontextmanager
 from contextvars import ContextVar
+from time import monotonic
 from pathlib import Path
 from os.path import join
 from os import getenv
@@ -14,6 +17,7 @@ from aiogram import Dispatcher
 from aiogram import Bot
 #
 from apps.msg_deleter import MessageManager
+from apps.funnel_compiler import compile_funnel
 
 # Это для iq-квиза
 ENCRYPTION_KEY = b'jkb342j3b98u32hrh98ewhfroi3u98r0'  # 32 байта для AES-256
@@ -50,7 +54,11 @@ def normalize_funnel_name(name: str | None) -> str | None:
     return FUNNEL_ALIASES.get(normalized, normalized)
 
 
-def _load_funnels() -> dict:
+def _load_funnels(errors: list | None = None) -> dict:
+    """
+    Читает и компилирует все воронки. Файлы, которые не удалось прочитать, пропускаются,
+    а текст ошибки добавляется в errors (если передан)
+    """
     funnels: dict[str, dict] = {}
 
     if FUNNELS_DIR.exists() and FUNNELS_DIR.is_dir():
@@ -59,15 +67,29 @@ def _load_funnels() -> dict:
                 funnels[funnel_file.stem] = loads(
                     funnel_file.read_text(encoding="utf-8")
                 )
-            except Exception:
+            except Exception as error:
+                if errors is not None:
+                    errors.append(f"{funnel_file.name}: {error}")
                 continue
 
     if not funnels and FALLBACK_MAP_PATH.exists():
-        funnels["default"] = loads(
-            FALLBACK_MAP_PATH.read_text(encoding="utf-8")
-        )
+        try:
+            funnels["default"] = loads(
+                FALLBACK_MAP_PATH.read_text(encoding="utf-8")
+            )
+        except Exception as error:
+            if errors is None:
+                raise
+            errors.append(f"{FALLBACK_MAP_PATH.name}: {error}")
 
-    return funnels
+    # узлы компилируются один раз: шаблоны, клавиатуры, actions (apps/funnel_compiler.py)
+    return {name: compile_funnel(funnel) for name, funnel in funnels.items()}
+
+
+def funnel_files() -> list[Path]:
+    """Файлы, из которых собираются воронки (за ними следит apps/funnel_reloader.py)"""
+    files = sorted(FUNNELS_DIR.glob("*.json")) if FUNNELS_DIR.is_dir() else []
+    return files + [FALLBACK_MAP_PATH]
 
 
 FUNNELS = _load_funnels()
@@ -108,6 +130,17 @@ try:
 except KeyError:
     MAP = {}
 
+
+def swap_funnels(funnels: dict) -> None:
+    """
+    Подменяет снимок воронок целиком. Вызывается без await между присваиваниями, поэтому
+    апдейт видит либо старый, либо новый снимок (обработчик берёт воронку один раз через get_funnel)
+    """
+    global FUNNELS, MAP
+    FUNNELS = funnels
+    MAP = funnels.get("default") or funnels.get(_current_funnel.get()) or {}
+
+
 DEFAULT_FUNNEL = "default"
 
 # Токен доступа к локальной ragflow
@@ -117,6 +150,15 @@ ragflow_url = getenv("ragflow_url")
 
 # JIVO-backend базовый адрес моего бекенда-интегратора с JIVO
 JIVO_INTEGRATOR_URL = getenv("JIVO_INTEGRATOR_URL", "http://localhost:9200")
+# сколько раз пытаемся доставить сообщение в JIVO (с растущей задержкой между попытками)
+JIVO_SEND_ATTEMPTS = int(getenv("jivo_send_attempts", 3))
+# после скольких сбоев подряд интегратор считается недоступным и на сколько секунд
+JIVO_BREAKER_FAILURES = int(getenv("jivo_breaker_failures", 5))
+JIVO_BREAKER_RESET = float(getenv("jivo_breaker_reset", 30))
+# на сколько секунд сообщения из jivo_integration_queue берутся в работу (потом их может
+# взять другой процесс) и сколько сообщений юзера берётся за раз
+JIVO_QUEUE_LEASE = float(getenv("jivo_queue_lease", 600))
+JIVO_QUEUE_CLAIM_LIMIT = int(getenv("jivo_queue_claim_limit", 20))
 
 # токен доступа к АМО
 AMO_TOKEN = getenv("AMO_TOKEN")
@@ -187,15 +229,216 @@ def get_data(payload: str) -> dict:
     return data
 
 
-# для соединения с БД
-async def create_connect():
-    return await asyncpg.connect(
-        host=getenv('db_host'),
-        port=getenv('db_port'),
-        database=getenv('db_name'),
-        user=getenv('db_user'),
-        password=getenv('db_password')
+# настройки пула соединений с БД (можно переопределить переменными окружения)
+DB_POOL_MIN_SIZE = int(getenv('db_pool_min_size', 2))
+DB_POOL_MAX_SIZE = int(getenv('db_pool_max_size', 20))
+# сколько подготовленных запросов кэшируется на одно соединение (0 - кэш отключен, нужно для pgbouncer)
+DB_STATEMENT_CACHE_SIZE = int(getenv('db_statement_cache_size', 100))
+# через сколько секунд простоя соединение закрывается пулом
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(getenv('db_max_inactive_connection_lifetime', 300))
+
+# лимиты отправки сообщений в Telegram (apps/rate_limiter.py)
+# общий лимит бота ~30 сообщений в секунду
+TG_RATE_LIMIT = float(getenv('tg_rate_limit', 25))
+# в один чат - не чаще 1 сообщения в секунду, с небольшим запасом на серию (медиа + текст)
+TG_CHAT_RATE_LIMIT = float(getenv('tg_chat_rate_limit', 1))
+TG_CHAT_BURST = int(getenv('tg_chat_burst', 3))
+# сколько пользователей рассыльщик обрабатывает одновременно (не больше размера пула БД)
+NOTIFY_CONCURRENCY = int(getenv('notify_concurrency', 10))
+
+# как часто (сек) проверять, не изменились ли файлы воронок (0 - только по SIGHUP)
+FUNNEL_RELOAD_INTERVAL = float(getenv('funnel_reload_interval', 10))
+
+# слушать изменения uploaded_files от других процессов бота (LISTEN/NOTIFY), 1 - включено
+UPLOADED_FILES_LISTEN = getenv('uploaded_files_listen', '0') == '1'
+
+# общий на весь процесс пул соединений. Создаётся при старте бота (bot.main -> init_db_pool)
+_db_pool = None
+_db_pool_lock = asyncio.Lock()
+# счётчики для метрик загруженности пула
+_db_pool_metrics = {
+    "acquired": 0,  # сколько раз брали соединение
+    "waiting": 0,  # сколько корутин сейчас ждут свободное соединение
+    "max_waiting": 0,  # максимум одновременно ждущих
+    "wait_time_total": 0.0,  # суммарное время ожидания соединения (сек)
+    "wait_time_max": 0.0,  # максимальное время ожидания соединения (сек)
+}
+
+
+def _db_params() -> dict:
+    return {
+        "host": getenv('db_host'),
+        "port": getenv('db_port'),
+        "database": getenv('db_name'),
+        "user": getenv('db_user'),
+        "password": getenv('db_password'),
+    }
+
+
+async def init_db_pool():
+    """Создаёт пул соединений с БД (если он ещё не создан) и возвращает его"""
+    global _db_pool
+    async with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = await asyncpg.create_pool(
+                **_db_params(),
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            )
+    return _db_pool
+
+
+def _add_db_time(seconds):
+    # время работы с БД попадает в контекст лога апдейта (db_ms, см. apps/middlewares.py).
+    # Считается в самой задаче, а не в query logger asyncpg: тот вызывается через call_soon,
+    # уже после того, как обработчик мог завершиться и записать лог
+    import apps.logger as logger
+    logger.add_timing("db", seconds)
+
+
+async def connect_db():
+    """Отдельное соединение вне пула (для LISTEN: пул его не должен забирать и возвращать)"""
+    return await asyncpg.connect(**_db_params())
+
+
+async def close_db_pool():
+    """Корректно закрывает пул соединений (вызывается при остановке бота)"""
+    global _db_pool
+    async with _db_pool_lock:
+        if _db_pool is not None:
+            pool, _db_pool = _db_pool, None
+            await pool.close()
+
+
+class _BoundConnection:
+    """Соединение, привязанное к обработке одного апдейта (см. bind_connection)"""
+    def __init__(self):
+        # задача, которая обрабатывает апдейт. Задачи, порождённые из неё (create_task),
+        # наследуют контекст, но берут свои соединения из пула
+        self.owner = asyncio.current_task()
+        self.connection = None
+        # пул, из которого взято соединение (туда же его и возвращаем)
+        self.pool = None
+        # сколько блоков acquire() сейчас используют соединение
+        self.depth = 0
+
+    async def release(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await self.pool.release(connection)
+
+
+# соединение текущего апдейта (если есть)
+_bound_connection: ContextVar[_BoundConnection | None] = ContextVar(
+    "bound_connection",
+    default=None,
+)
+# выполняется ли сейчас блок acquire() (для подсчёта db_ms)
+_inside_acquire: ContextVar[bool] = ContextVar("inside_acquire", default=False)
+
+
+async def _acquire_from_pool():
+    pool = _db_pool or await init_db_pool()
+    metrics = _db_pool_metrics
+    metrics["waiting"] += 1
+    metrics["max_waiting"] = max(metrics["max_waiting"], metrics["waiting"])
+    started = monotonic()
+    try:
+        connection = await pool.acquire()
+    finally:
+        waited = monotonic() - started
+        metrics["waiting"] -= 1
+        metrics["wait_time_total"] += waited
+        metrics["wait_time_max"] = max(metrics["wait_time_max"], waited)
+    metrics["acquired"] += 1
+    return pool, connection
+
+
+# для соединения с БД. Использование:
+#   async with acquire() as db:
+#       await db.execute(...)
+# Внутри bind_connection() все вызовы переиспользуют одно соединение
+@asynccontextmanager
+async def acquire():
+    # время считаем только для внешнего блока: вложенные уже входят в него
+    outermost = not _inside_acquire.get()
+    token = _inside_acquire.set(True)
+    started = monotonic()
+    try:
+        bound = _bound_connection.get()
+        if bound is not None and bound.owner is asyncio.current_task():
+            if bound.connection is None:
+                bound.pool, bound.connection = await _acquire_from_pool()
+            bound.depth += 1
+            try:
+                yield bound.connection
+            finally:
+                bound.depth -= 1
+            return
+
+        pool, connection = await _acquire_from_pool()
+        try:
+            yield connection
+        finally:
+            await pool.release(connection)
+    finally:
+        _inside_acquire.reset(token)
+        if outermost:
+            _add_db_time(monotonic() - started)
+
+
+@asynccontextmanager
+async def bind_connection():
+    """
+    Привязывает к текущей задаче одно соединение из пула: все acquire() внутри блока
+    получают его же. Соединение берётся из пула при первом обращении к БД и
+    возвращается при выходе из блока (т.е. апдейт без запросов к БД пул не занимает).
+    На время запросов к внешним сервисам (Telegram, HTTP) соединение тоже возвращается
+    в пул (release_bound_connection), следующий acquire() возьмёт новое
+    """
+    current = _bound_connection.get()
+    if current is not None and current.owner is asyncio.current_task():
+        yield
+        return
+
+    bound = _BoundConnection()
+    token = _bound_connection.set(bound)
+    try:
+        yield
+    finally:
+        _bound_connection.reset(token)
+        await bound.release()
+
+
+async def release_bound_connection():
+    """
+    Возвращает в пул соединение апдейта, если сейчас оно не используется ни одним
+    блоком acquire(). Вызывается перед запросами к внешним сервисам, чтобы медленный
+    ответ Telegram или HTTP-сервиса не держал соединение из пула
+    """
+    bound = _bound_connection.get()
+    if bound is not None and bound.owner is asyncio.current_task() and bound.depth == 0:
+        await bound.release()
+
+
+def db_pool_stats() -> dict:
+    """Метрики загруженности пула соединений"""
+    stats = dict(_db_pool_metrics)
+    if _db_pool is None:
+        return stats
+    size = _db_pool.get_size()
+    in_use = size - _db_pool.get_idle_size()
+    stats.update(
+        size=size,
+        min_size=_db_pool.get_min_size(),
+        max_size=_db_pool.get_max_size(),
+        in_use=in_use,
+        # доля занятых соединений от максимума пула (1.0 - пул исчерпан)
+        saturation=round(in_use / _db_pool.get_max_size(), 3),
     )
+    return stats
 
 
 # регистрируем универсальное состояние для сообщений